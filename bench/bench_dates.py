@@ -0,0 +1,94 @@
+# coding: utf-8
+#
+# bench_dates - micro-benchmark of date validation and normalization per cell call
+# Copyright © 2022  Dave Hocker (email: Qalydon17@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Usage (from the repository root):
+#
+# python3 bench/bench_dates.py
+#
+# Compares the date handling done for every cell call before and after
+# resolve_date() was introduced. The old path validated the date with
+# normalize_date() and strptime() and then normalized it again in the lookup.
+#
+
+import os
+import sys
+import datetime
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from qf_extn_helper import resolve_date, normalize_date
+
+CALLS = 100000
+
+
+def _old_float_to_date_str(float_date):
+    seconds = (int(float_date) - 25569) * 86400
+    d = datetime.datetime.utcfromtimestamp(seconds)
+    return d.strftime("%Y-%m-%d")
+
+
+def _old_normalize_date(tgtdate):
+    if type(tgtdate) == float:
+        return _old_float_to_date_str(tgtdate)
+    try:
+        datetime.datetime.strptime(tgtdate, "%Y-%m-%d")
+        return tgtdate
+    except Exception:
+        pass
+    dt = datetime.datetime.strptime(tgtdate, "%m/%d/%y")
+    return dt.strftime("%Y-%m-%d")
+
+
+def old_cell_call(fordate):
+    """
+    Validation in QFImpl followed by normalization in the lookup (before)
+    """
+    if type(fordate) == float:
+        dt = datetime.datetime.strptime(_old_normalize_date(fordate), "%Y-%m-%d")
+    else:
+        try:
+            dt = datetime.datetime.strptime(fordate, "%Y-%m-%d")
+        except Exception:
+            dt = datetime.datetime.strptime(fordate, "%m/%d/%y")
+    d = datetime.date(dt.year, dt.month, dt.day)
+    valid = datetime.date.today() > d
+    return valid, _old_normalize_date(fordate)
+
+
+def new_cell_call(fordate):
+    """
+    One resolve_date in QFImpl; the lookup normalizes the ISO string (a memo hit)
+    """
+    d, iso_date = resolve_date(fordate)
+    valid = datetime.date.today() > d
+    return valid, normalize_date(iso_date)
+
+
+def main():
+    samples = [("float", 44712.0), ("iso", "2022-05-31"), ("us", "5/31/22")]
+    print("{0:>6} {1:>12} {2:>12} {3:>8}".format("date", "before us", "after us", "speedup"))
+    for name, value in samples:
+        assert old_cell_call(value) == new_cell_call(value)
+        # Prime the table and memo so the steady state is measured
+        new_cell_call(value)
+        before = timeit.timeit(lambda: old_cell_call(value), number=CALLS) / CALLS * 1e6
+        after = timeit.timeit(lambda: new_cell_call(value), number=CALLS) / CALLS * 1e6
+        print("{0:>6} {1:>12.2f} {2:>12.2f} {3:>7.1f}x".format(name, before, after, before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+# coding: utf-8
+#
+# bench_import - extension cold start benchmark
+# Copyright © 2022  Dave Hocker (email: Qalydon17@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Usage (from the repository root):
+#
+# python3 bench/bench_import.py [runs]
+#
+# qf_impl can only be imported inside LibreOffice, so the benchmark replays what
+# it does in a fresh interpreter: load the modules qf_impl imports, then make the
+# first function call (a cached closing price). Each run uses a scratch home
+# folder with a one record cache.
+#
+# Two measurements are reported:
+#   import time - from python -X importtime, the modules with the largest cumulative time
+#   first result - wall time from interpreter start to the first cell value
+#
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+# What qf_impl does at load time followed by the first cell call
+FIRST_CALL = """
+import qf_app_logger
+import qf_extn_helper
+import qf_configuration
+import qf_hist_quote
+print(qf_hist_quote.closing_price("IBM", "stock", "2022-05-31"))
+"""
+
+
+def _make_home():
+    """
+    Create a scratch home folder with a configuration file and a one record cache
+    :return: Path of the folder (with trailing separator)
+    """
+    home = tempfile.mkdtemp(prefix="qf-bench-") + os.sep
+    with open(home + "qf.conf", "w") as cf:
+        json.dump({"loglevel": "info", "cachedb": home}, cf)
+    with open(home + "symbol_date.csv", "w") as cf:
+        cf.write("Symbol,Date,Open,High,Low,Close,Volume,Adj_Close\n")
+        cf.write("IBM,2022-05-31,138.0,139.7,137.8,138.8,6500000,0.0\n")
+    return home
+
+
+def _run(args, home):
+    env = dict(os.environ)
+    env["QF_LOCALC_LOG_DIR"] = home
+    env["PYTHONPATH"] = SRC
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable] + args, env=env, cwd=SRC,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    return time.perf_counter() - start, result
+
+
+def import_times(top=15):
+    """
+    Run the first call under -X importtime
+    :param top: Number of modules to report
+    :return: List of (cumulative us, self us, module) sorted by cumulative time
+    """
+    home = _make_home()
+    try:
+        _, result = _run(["-X", "importtime", "-c", FIRST_CALL], home)
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        parts = line[len("import time:"):].split("|")
+        rows.append((int(parts[1]), int(parts[0]), parts[2].rstrip()))
+    rows.sort(reverse=True)
+    return rows[:top]
+
+
+def first_result(runs):
+    """
+    Time from interpreter start to the first cell value
+    :param runs: Number of runs
+    :return: List of times in seconds
+    """
+    times = []
+    for i in range(runs):
+        home = _make_home()
+        try:
+            elapsed, result = _run(["-c", FIRST_CALL], home)
+        finally:
+            shutil.rmtree(home, ignore_errors=True)
+        if result.stdout.strip() != "138.8":
+            print("Unexpected result:", result.stdout, result.stderr)
+        times.append(elapsed)
+    return times
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    print("Largest cumulative import times")
+    print("{0:>12} {1:>10}  {2}".format("cumul us", "self us", "module"))
+    for cumulative, self_time, module in import_times():
+        print("{0:>12} {1:>10}  {2}".format(cumulative, self_time, module))
+
+    times = sorted(first_result(runs))
+    print()
+    print("Time to first result over {0} runs: min {1:.1f} ms, median {2:.1f} ms".format(
+        runs, times[0] * 1000.0, times[len(times) // 2] * 1000.0))
+
+
+if __name__ == '__main__':
+    main()
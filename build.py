@@ -104,9 +104,17 @@ if not os.path.exists("build"):
 if not os.path.exists("build/META-INF"):
     print ("Creating build/META-INF folder")
     os.mkdir("build/META-INF")
+if not os.path.exists("build/Scripts/python"):
+    print ("Creating build/Scripts/python folder")
+    os.makedirs("build/Scripts/python")
 
 # Compile idl
-subprocess.run(["idlc", "-w", "idl/xqf.idl"], stdout=sys.stdout, stderr=sys.stderr)
+# The IDL includes LibreOffice types (e.g. XVolatileResult) from the SDK
+idlc_cmd = ["idlc", "-w"]
+if "OO_SDK_HOME" in os.environ:
+    idlc_cmd.append("-I" + os.path.join(os.environ["OO_SDK_HOME"], "idl"))
+idlc_cmd.append("idl/xqf.idl")
+subprocess.run(idlc_cmd, stdout=sys.stdout, stderr=sys.stderr)
 subprocess.run(["regmerge", "-v", "build/xqf.rdb", "UCR", "idl/xqf.urd"])
 os.remove("idl/xqf.urd")
 
@@ -131,6 +139,19 @@ shutil.copy("src/qf_app_logger.py", "build/")
 shutil.copy("src/qf_configuration.py", "build/")
 shutil.copy("src/qf_extn_helper.py", "build/")
 shutil.copy("src/qf_url_helpers.py", "build/")
+shutil.copy("src/qf_deadline.py", "build/")
+shutil.copy("src/qf_quota.py", "build/")
+shutil.copy("src/qf_date_bulk.py", "build/")
+shutil.copy("src/qf_workers.py", "build/")
+shutil.copy("src/qf_async.py", "build/")
+shutil.copy("src/qf_prefetch.py", "build/")
+shutil.copy("src/qf_scanner.py", "build/")
+shutil.copy("src/qf_analytics.py", "build/")
+shutil.copy("src/qf_portfolio.py", "build/")
+shutil.copy("src/qf_metrics.py", "build/")
+shutil.copy("src/qf_profiler.py", "build/")
+shutil.copy("src/qf_scanner_macro.py", "build/Scripts/python/")
+shutil.copy("src/qf_profile_macro.py", "build/Scripts/python/")
 shutil.copy("src/qf_cache_db.py", "build/")
 shutil.copy("src/qf_dialog_box.py", "build/")
 shutil.copy("src/qf_home.py", "build/")
@@ -188,6 +209,192 @@ xcu.add_function("QFTTMDividend", "Get the trailing 12 months dividend",
                      ('symbol', 'The stock ticker symbol for the dividend'),
                      ('fordate', 'The ending date of the 12 month period YYYY-MM-DD')
                  ])
+xcu.add_function("QFTTMDividendSeries", "Get the trailing 12 months dividend for a range of dates",
+                 [
+                     ('symbol', 'The stock ticker symbol for the dividends'),
+                     ('dates', 'A range of ending dates of the 12 month periods')
+                 ])
+xcu.add_function("QFDividendYield", "Get the trailing 12 months dividend yield",
+                 [
+                     ('symbol', 'The stock ticker symbol for the yield'),
+                     ('fordate', 'The ending date of the 12 month period YYYY-MM-DD')
+                 ])
+xcu.add_function("QFDividendYieldSeries", "Get the trailing 12 months dividend yield for a range of dates",
+                 [
+                     ('symbol', 'The stock ticker symbol for the yields'),
+                     ('dates', 'A range of ending dates of the 12 month periods')
+                 ])
+xcu.add_function("QFClosingPriceAsOf", "Get the closing price on or before a date",
+                 [
+                     ('symbol', 'The stock ticker symbol for the price'),
+                     ('category', 'stock, etf, mutf, or index'),
+                     ('fordate', 'The date YYYY-MM-DD')
+                 ])
+xcu.add_function("QFOpeningPriceAsOf", "Get the opening price on or before a date",
+                 [
+                     ('symbol', 'The stock ticker symbol for the price'),
+                     ('category', 'stock, etf, mutf, or index'),
+                     ('fordate', 'The date YYYY-MM-DD')
+                 ])
+xcu.add_function("QFHighPriceAsOf", "Get the high price on or before a date",
+                 [
+                     ('symbol', 'The stock ticker symbol for the price'),
+                     ('category', 'stock, etf, mutf, or index'),
+                     ('fordate', 'The date YYYY-MM-DD')
+                 ])
+xcu.add_function("QFLowPriceAsOf", "Get the low price on or before a date",
+                 [
+                     ('symbol', 'The stock ticker symbol for the price'),
+                     ('category', 'stock, etf, mutf, or index'),
+                     ('fordate', 'The date YYYY-MM-DD')
+                 ])
+xcu.add_function("QFDayVolumeAsOf", "Get the trading volume on or before a date",
+                 [
+                     ('symbol', 'The stock ticker symbol for the volume'),
+                     ('category', 'stock, etf, mutf, or index'),
+                     ('fordate', 'The date YYYY-MM-DD')
+                 ])
+xcu.add_function("QFClosingPriceAsync", "Get the closing price for a date without blocking",
+                 [
+                     ('symbol', 'The stock ticker symbol for the price'),
+                     ('category', 'stock, etf, mutf, or index'),
+                     ('fordate', 'The date YYYY-MM-DD')
+                 ])
+xcu.add_function("QFOpeningPriceAsync", "Get the opening price for a date without blocking",
+                 [
+                     ('symbol', 'The stock ticker symbol for the price'),
+                     ('category', 'stock, etf, mutf, or index'),
+                     ('fordate', 'The date YYYY-MM-DD')
+                 ])
+xcu.add_function("QFHighPriceAsync", "Get the high price for a date without blocking",
+                 [
+                     ('symbol', 'The stock ticker symbol for the price'),
+                     ('category', 'stock, etf, mutf, or index'),
+                     ('fordate', 'The date YYYY-MM-DD')
+                 ])
+xcu.add_function("QFLowPriceAsync", "Get the low price for a date without blocking",
+                 [
+                     ('symbol', 'The stock ticker symbol for the price'),
+                     ('category', 'stock, etf, mutf, or index'),
+                     ('fordate', 'The date YYYY-MM-DD')
+                 ])
+xcu.add_function("QFDayVolumeAsync", "Get the trading volume for a date without blocking",
+                 [
+                     ('symbol', 'The stock ticker symbol for the volume'),
+                     ('category', 'stock, etf, mutf, or index'),
+                     ('fordate', 'The date YYYY-MM-DD')
+                 ])
+xcu.add_function("QFTTMDividendAsync", "Get the trailing 12 months dividend without blocking",
+                 [
+                     ('symbol', 'The stock ticker symbol for the dividend'),
+                     ('fordate', 'The ending date of the 12 month period YYYY-MM-DD')
+                 ])
+xcu.add_function("QFClosingPrices", "Get the closing prices for a range of symbols on a date",
+                 [
+                     ('symbols', 'A range of stock ticker symbols'),
+                     ('category', 'stock, etf, mutf, or index'),
+                     ('fordate', 'The date YYYY-MM-DD')
+                 ])
+xcu.add_function("QFOpeningPrices", "Get the opening prices for a range of symbols on a date",
+                 [
+                     ('symbols', 'A range of stock ticker symbols'),
+                     ('category', 'stock, etf, mutf, or index'),
+                     ('fordate', 'The date YYYY-MM-DD')
+                 ])
+xcu.add_function("QFHighPrices", "Get the high prices for a range of symbols on a date",
+                 [
+                     ('symbols', 'A range of stock ticker symbols'),
+                     ('category', 'stock, etf, mutf, or index'),
+                     ('fordate', 'The date YYYY-MM-DD')
+                 ])
+xcu.add_function("QFLowPrices", "Get the low prices for a range of symbols on a date",
+                 [
+                     ('symbols', 'A range of stock ticker symbols'),
+                     ('category', 'stock, etf, mutf, or index'),
+                     ('fordate', 'The date YYYY-MM-DD')
+                 ])
+xcu.add_function("QFDayVolumes", "Get the trading volumes for a range of symbols on a date",
+                 [
+                     ('symbols', 'A range of stock ticker symbols'),
+                     ('category', 'stock, etf, mutf, or index'),
+                     ('fordate', 'The date YYYY-MM-DD')
+                 ])
+xcu.add_function("QFPrefetch", "Load prices for a range of symbols and dates into the cache",
+                 [
+                     ('symbols', 'A range of stock ticker symbols'),
+                     ('startdate', 'The first date YYYY-MM-DD'),
+                     ('enddate', 'The last date YYYY-MM-DD'),
+                     ('[category]', 'stock, etf, mutf, or index')
+                 ])
+xcu.add_function("QFPriceHistory", "Get a block of historical prices for a date range",
+                 [
+                     ('symbol', 'The stock ticker symbol for the prices'),
+                     ('category', 'stock, etf, mutf, or index'),
+                     ('startdate', 'The first date YYYY-MM-DD'),
+                     ('enddate', 'The last date YYYY-MM-DD'),
+                     ('[fields]', 'Comma separated list of date, open, high, low, close, volume, adj_close'),
+                     ('[frequency]', 'd (daily), w (weekly) or m (monthly)')
+                 ])
+xcu.add_function("QFReturn", "Get the price return for a date range",
+                 [
+                     ('symbol', 'The stock ticker symbol'),
+                     ('startdate', 'The first date YYYY-MM-DD'),
+                     ('enddate', 'The last date YYYY-MM-DD'),
+                     ('[category]', 'stock, etf, mutf, or index')
+                 ])
+xcu.add_function("QFVolatility", "Get the annualized volatility of daily returns for a date range",
+                 [
+                     ('symbol', 'The stock ticker symbol'),
+                     ('startdate', 'The first date YYYY-MM-DD'),
+                     ('enddate', 'The last date YYYY-MM-DD'),
+                     ('[window]', 'Number of daily returns in a rolling window'),
+                     ('[category]', 'stock, etf, mutf, or index')
+                 ])
+xcu.add_function("QFMovingAverage", "Get the moving average of closing prices for a date range",
+                 [
+                     ('symbol', 'The stock ticker symbol'),
+                     ('startdate', 'The first date YYYY-MM-DD'),
+                     ('enddate', 'The last date YYYY-MM-DD'),
+                     ('window', 'Number of closing prices in each average'),
+                     ('[category]', 'stock, etf, mutf, or index')
+                 ])
+xcu.add_function("QFMaxDrawdown", "Get the maximum drawdown for a date range",
+                 [
+                     ('symbol', 'The stock ticker symbol'),
+                     ('startdate', 'The first date YYYY-MM-DD'),
+                     ('enddate', 'The last date YYYY-MM-DD'),
+                     ('[window]', 'Number of closing prices in a rolling window'),
+                     ('[category]', 'stock, etf, mutf, or index')
+                 ])
+xcu.add_function("QFTotalReturn", "Get the total return with dividends reinvested for a date range",
+                 [
+                     ('symbol', 'The stock ticker symbol'),
+                     ('startdate', 'The first date YYYY-MM-DD'),
+                     ('enddate', 'The last date YYYY-MM-DD'),
+                     ('[category]', 'stock, etf, mutf, or index')
+                 ])
+xcu.add_function("QFTotalReturnSeries", "Get a total return index for a date range",
+                 [
+                     ('symbol', 'The stock ticker symbol'),
+                     ('startdate', 'The first date YYYY-MM-DD'),
+                     ('enddate', 'The last date YYYY-MM-DD'),
+                     ('[category]', 'stock, etf, mutf, or index')
+                 ])
+xcu.add_function("QFPortfolioValue", "Get the value of a range of holdings on a date",
+                 [
+                     ('symbols', 'A range of stock ticker symbols'),
+                     ('quantities', 'A range of quantities, one for each symbol'),
+                     ('fordate', 'The date YYYY-MM-DD'),
+                     ('[category]', 'stock, etf, mutf, or index')
+                 ])
+xcu.add_function("QFRank", "Rank a range of symbols on a statistic for a date range",
+                 [
+                     ('symbols', 'A range of stock ticker symbols'),
+                     ('metric', 'return, totalreturn, volatility or maxdrawdown'),
+                     ('startdate', 'The first date YYYY-MM-DD'),
+                     ('enddate', 'The last date YYYY-MM-DD'),
+                     ('[category]', 'stock, etf, mutf, or index')
+                 ])
 # xcu.add_function("IexHistoricalQuote", "Get a closing quote for a date",
 #                  [
 #                      ('symbol', 'The stock ticker symbol for the quote'),
@@ -0,0 +1,388 @@
+# coding: utf-8
+#
+# qf_analytics - returns and rolling statistics over cached closing prices
+# Copyright © 2022  Dave Hocker (email: Qalydon17@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import math
+import datetime
+from collections import deque
+from qf_app_logger import AppLogger
+from qf_configuration import QConfiguration
+from qf_cache_db import CacheDB
+from qf_extn_helper import normalize_date, iso_to_float_date, add_days
+from qf_hist_quote import ensure_price_range
+from qf_deadline import cell_deadline, DeadlineExceeded, TIMEOUT_RESULT
+
+# Logger init
+the_app_logger = AppLogger("qf-extension")
+logger = the_app_logger.getAppLogger()
+
+# Used to annualize the volatility of daily returns
+TRADING_DAYS_PER_YEAR = 252
+
+# NumPy is not part of every LibreOffice embedded Python. It is loaded
+# on first use and the pure Python versions are used without it.
+_numpy_module = None
+_numpy_checked = False
+
+
+def _numpy():
+    """
+    Return the numpy module or None if it is not installed
+    """
+    global _numpy_module, _numpy_checked
+    if not _numpy_checked:
+        try:
+            import numpy
+            _numpy_module = numpy
+        except ImportError:
+            _numpy_module = None
+        _numpy_checked = True
+    return _numpy_module
+
+
+def _parse_window(window, required=False):
+    """
+    Parse the optional window argument
+    :param window: Number of trading days. Omitted arguments arrive as None or "".
+    :param required: True if the window can not be omitted
+    :return: The window as an int, 0 when omitted
+    """
+    if window is None or window == "":
+        if required:
+            raise ValueError("Invalid window")
+        return 0
+    try:
+        window = int(float(window))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid window")
+    if window < 0 or (required and window == 0):
+        raise ValueError("Invalid window")
+    return window
+
+
+def normalize_range(start_date, end_date):
+    """
+    Normalize a date range and clamp it to the completed days
+    :param start_date: Either ISO format or LibreOffice date as a float
+    :param end_date: Either ISO format or LibreOffice date as a float
+    :return: (start date, end date) in ISO format
+    """
+    start_date = normalize_date(start_date)
+    end_date = normalize_date(end_date)
+    if not start_date or not end_date:
+        raise ValueError("Invalid date")
+    # Only completed days are cached
+    yesterday = (datetime.date.today() - datetime.timedelta(days=1)).isoformat()
+    end_date = min(end_date, yesterday)
+    if start_date > end_date:
+        raise ValueError("Invalid date range")
+    return start_date, end_date
+
+
+def get_close_series(ticker, category, start_date, end_date, events=False):
+    """
+    Return the cached closing prices for a date range. Only the parts of the
+    range that are not in the cache are fetched.
+    :param ticker: Equity ticker symbol
+    :param category: stock, etf, mutf, index
+    :param start_date: Either ISO format or LibreOffice date as a float
+    :param end_date: Either ISO format or LibreOffice date as a float
+    :param events: If True, the dividends of the range are fetched as well
+    :return: (list of ISO dates, list of closing prices) in date order
+    """
+    start_date, end_date = normalize_range(start_date, end_date)
+    ticker = ticker.upper()
+    with cell_deadline(QConfiguration.get_cell_deadline()):
+        ensure_price_range(ticker, category, start_date, end_date, events=events)
+    return cached_close_series(ticker, start_date, end_date)
+
+
+def cached_close_series(ticker, start_date, end_date):
+    """
+    Return the closing prices for a date range from the cache only
+    :param ticker: Equity ticker symbol (upper case)
+    :param start_date: ISO format date
+    :param end_date: ISO format date
+    :return: (list of ISO dates, list of closing prices) in date order
+    """
+    dates = []
+    closes = []
+    for p in CacheDB.lookup_prices(ticker, start_date, end_date):
+        # Placeholder records have a zero close
+        if p["close"] > 0.0:
+            dates.append(p["date"])
+            closes.append(p["close"])
+    return dates, closes
+
+
+def _log_returns(closes):
+    return [math.log(closes[i] / closes[i - 1]) for i in range(1, len(closes))]
+
+
+def rolling_mean(values, window):
+    """
+    Mean of each window of values, computed in one pass
+    :param values: List of floats
+    :param window: Window length
+    :return: List of len(values) - window + 1 means
+    """
+    if len(values) < window:
+        return []
+    np = _numpy()
+    if np is not None:
+        c = np.cumsum(np.concatenate(([0.0], np.asarray(values, dtype=float))))
+        return ((c[window:] - c[:-window]) / window).tolist()
+
+    means = []
+    total = sum(values[0:window])
+    means.append(total / window)
+    for i in range(window, len(values)):
+        total += values[i] - values[i - window]
+        means.append(total / window)
+    return means
+
+
+def rolling_std(values, window):
+    """
+    Sample standard deviation of each window of values, computed in one pass
+    :param values: List of floats
+    :param window: Window length (at least 2)
+    :return: List of len(values) - window + 1 standard deviations
+    """
+    if len(values) < window or window < 2:
+        return []
+    np = _numpy()
+    if np is not None:
+        x = np.asarray(values, dtype=float)
+        s1 = np.cumsum(np.concatenate(([0.0], x)))
+        s2 = np.cumsum(np.concatenate(([0.0], x * x)))
+        total = s1[window:] - s1[:-window]
+        total_sq = s2[window:] - s2[:-window]
+        var = (total_sq - total * total / window) / (window - 1)
+        return np.sqrt(np.maximum(var, 0.0)).tolist()
+
+    def std(total, total_sq):
+        var = (total_sq - total * total / window) / (window - 1)
+        # Rounding can push a zero variance slightly negative
+        return math.sqrt(max(var, 0.0))
+
+    total = sum(values[0:window])
+    total_sq = sum(v * v for v in values[0:window])
+    stds = [std(total, total_sq)]
+    for i in range(window, len(values)):
+        old = values[i - window]
+        total += values[i] - old
+        total_sq += values[i] * values[i] - old * old
+        stds.append(std(total, total_sq))
+    return stds
+
+
+def rolling_drawdown(values, window):
+    """
+    Drop of each value from the highest value of its trailing window. The
+    window high is kept with a monotonic queue, so the pass is O(n).
+    :param values: List of prices
+    :param window: Window length
+    :return: List of len(values) - window + 1 drawdowns (0 or negative fractions)
+    """
+    drawdowns = []
+    highs = deque()
+    for i, v in enumerate(values):
+        while highs and values[highs[-1]] <= v:
+            highs.pop()
+        highs.append(i)
+        if highs[0] <= i - window:
+            highs.popleft()
+        if i >= window - 1:
+            drawdowns.append(v / values[highs[0]] - 1.0)
+    return drawdowns
+
+
+def max_drawdown_of(values):
+    """
+    Largest drop from a running high over the whole series
+    :param values: List of prices
+    :return: The drawdown as 0 or a negative fraction
+    """
+    np = _numpy()
+    if np is not None:
+        x = np.asarray(values, dtype=float)
+        return float(np.min(x / np.maximum.accumulate(x) - 1.0))
+
+    peak = values[0]
+    worst = 0.0
+    for v in values:
+        if v > peak:
+            peak = v
+        worst = min(worst, v / peak - 1.0)
+    return worst
+
+
+def _series_rows(dates, values):
+    """
+    Format a series as (LO Calc date, value) rows
+    """
+    return tuple((iso_to_float_date(d), v) for d, v in zip(dates, values))
+
+
+def total_return_index(ticker, dates, closes):
+    """
+    Growth of 1 invested at the first close with dividends reinvested. Each
+    dividend is credited on the first trading day on or after its ex-date.
+    :param ticker: Equity ticker symbol (upper case)
+    :param dates: ISO dates of the closes
+    :param closes: Closing prices in date order
+    :return: List of index values, one per close
+    """
+    dividends = CacheDB.lookup_dividend_events(ticker, add_days(dates[0], 1), dates[-1])
+    index = [1.0]
+    d = 0
+    for i in range(1, len(closes)):
+        # The dividends are in date order, so one pointer walks them with the closes
+        paid = 0.0
+        while d < len(dividends) and dividends[d][0] <= dates[i]:
+            paid += dividends[d][1]
+            d += 1
+        index.append(index[-1] * (closes[i] + paid) / closes[i - 1])
+    return index
+
+
+def _annual_volatility(closes):
+    """
+    Annualized volatility of the daily log returns of a series
+    :return: The volatility or None if there are too few closes
+    """
+    returns = _log_returns(closes)
+    if len(returns) < 2:
+        return None
+    return rolling_std(returns, len(returns))[0] * math.sqrt(TRADING_DAYS_PER_YEAR)
+
+
+# Single value statistics of a close series by name: (function(ticker, dates, closes), needs dividends)
+METRICS = {
+    "return": (lambda ticker, dates, closes: closes[-1] / closes[0] - 1.0, False),
+    "totalreturn": (lambda ticker, dates, closes: total_return_index(ticker, dates, closes)[-1] - 1.0, True),
+    "volatility": (lambda ticker, dates, closes: _annual_volatility(closes), False),
+    "maxdrawdown": (lambda ticker, dates, closes: max_drawdown_of(closes), False),
+}
+
+
+def _run(ticker, category, start_date, end_date, compute, events=False):
+    """
+    Fetch the close series and compute a result from it
+    :param compute: Callable taking (dates, closes) and returning a tuple of rows
+    :param events: If True, the dividends of the range are fetched as well
+    :return: Tuple of row tuples. Errors are returned as a single cell.
+    """
+    try:
+        dates, closes = get_close_series(ticker, category, start_date, end_date, events=events)
+        if len(closes) < 2:
+            return (("N/A",),)
+        return compute(dates, closes)
+    except DeadlineExceeded:
+        return ((TIMEOUT_RESULT,),)
+    except Exception as ex:
+        logger.error("Exception %s", ex)
+        return ((str(ex),),)
+
+
+def price_return(ticker, category, start_date, end_date):
+    """
+    Price return from the first to the last close in a date range
+    :return: The return as a fraction or an error string
+    """
+    metric = METRICS["return"][0]
+    return _run(ticker, category, start_date, end_date,
+                lambda dates, closes: ((metric(ticker, dates, closes),),))[0][0]
+
+
+def volatility(ticker, category, start_date, end_date, window):
+    """
+    Annualized volatility of daily log returns. Without a window the result is
+    one value for the whole range. With a window it is a (date, volatility)
+    row for every window of daily returns.
+    :param window: Number of daily returns in each window (optional)
+    :return: Tuple of row tuples
+    """
+    def compute(dates, closes):
+        w = _parse_window(window)
+        if w == 0:
+            v = _annual_volatility(closes)
+            return ((v if v is not None else "N/A",),)
+        stds = rolling_std(_log_returns(closes), w)
+        if not stds:
+            return (("N/A",),)
+        # Return i is for dates[i + 1]
+        scale = math.sqrt(TRADING_DAYS_PER_YEAR)
+        return _series_rows(dates[w:], [s * scale for s in stds])
+    return _run(ticker, category, start_date, end_date, compute)
+
+
+def moving_average(ticker, category, start_date, end_date, window):
+    """
+    Simple moving average of the closes as (date, average) rows
+    :param window: Number of closes in each average
+    :return: Tuple of row tuples
+    """
+    def compute(dates, closes):
+        w = _parse_window(window, required=True)
+        means = rolling_mean(closes, w)
+        if not means:
+            return (("N/A",),)
+        return _series_rows(dates[w - 1:], means)
+    return _run(ticker, category, start_date, end_date, compute)
+
+
+def max_drawdown(ticker, category, start_date, end_date, window):
+    """
+    Without a window, the largest drop from a running high over the range.
+    With a window, a (date, drawdown) row giving the drop of each close from
+    the high of its trailing window.
+    :param window: Number of closes in each window (optional)
+    :return: Tuple of row tuples
+    """
+    def compute(dates, closes):
+        w = _parse_window(window)
+        if w == 0:
+            return ((max_drawdown_of(closes),),)
+        drawdowns = rolling_drawdown(closes, w)
+        if not drawdowns:
+            return (("N/A",),)
+        return _series_rows(dates[w - 1:], drawdowns)
+    return _run(ticker, category, start_date, end_date, compute)
+
+
+def total_return(ticker, category, start_date, end_date):
+    """
+    Total return (price change plus reinvested dividends) over a date range
+    :return: The return as a fraction or an error string
+    """
+    metric = METRICS["totalreturn"][0]
+    return _run(ticker, category, start_date, end_date,
+                lambda dates, closes: ((metric(ticker.upper(), dates, closes),),),
+                events=True)[0][0]
+
+
+def total_return_series(ticker, category, start_date, end_date):
+    """
+    Total return index as (date, value) rows. The index starts at 1.0 on the
+    first trading day of the range.
+    :return: Tuple of row tuples
+    """
+    return _run(ticker, category, start_date, end_date,
+                lambda dates, closes: _series_rows(dates, total_return_index(ticker.upper(), dates, closes)),
+                events=True)
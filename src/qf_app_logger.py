@@ -1,90 +1,186 @@
-# coding: utf-8
-#
-# Python logging
-# Copyright © 2018, 2020 Dave Hocker as Qalydon (qalydon17@gmail.com)
-#
-# This program is free software: you can redistribute it and/or modify
-# it under the terms of the GNU General Public License as published by
-# the Free Software Foundation, version 3 of the License.
-#
-# See the LICENSE.md file for more details.
-#
-
-import logging
-import logging.handlers
-import os
-from qf_home import find_home
-
-
-class AppLogger:
-    # All of the created loggers
-    logger_list = []
-
-    def __init__(self, logname):
-        self.logger = None
-        self.EnableLogging(logname)
-
-    ########################################################################
-    # Enable logging for the extension
-    def EnableLogging(self, logname):
-        if not logname in AppLogger.logger_list:
-            # Default overrides
-            logformat = '%(asctime)s, %(module)s, %(levelname)s, %(message)s'
-            logdateformat = '%Y-%m-%d %H:%M:%S'
-
-            self.logger = logging.getLogger(logname)
-
-            # Default logging to DEBUG until the level is set from the configuration
-            self.logger.setLevel(logging.DEBUG)
-
-            formatter = logging.Formatter(logformat, datefmt=logdateformat)
-
-            # Log to a file
-            # Make logfile location OS specific
-            file_path = find_home()
-            logfile = file_path + logname + ".log"
-
-            # Create directory if it doesn't exist
-            if not os.path.exists(file_path):
-                os.makedirs(file_path, exist_ok=True)
-
-            fh = logging.handlers.TimedRotatingFileHandler(logfile, when='midnight', backupCount=3)
-            fh.setFormatter(formatter)
-            self.logger.addHandler(fh)
-            self.logger.debug("New logger %s created: %s", logname, str(self.logger))
-            self.logger.debug("%s logging to file: %s", logname, logfile)
-
-            # Note that this logname has been defined
-            AppLogger.logger_list.append(logname)
-        else:
-            # Use the logger that has been previously defined
-            self.logger = logging.getLogger(logname)
-
-    def getAppLogger(self):
-        """
-        Return an instance of the default logger for this app.
-        :return: logger instance
-        """
-        return self.logger
-
-    def set_log_level(self, loglevel):
-        # Logging level override (defaults to INFO)
-        loglevel_setting = logging.INFO
-        if loglevel:
-            loglevel = loglevel.upper()
-            if loglevel == "DEBUG":
-                loglevel_setting = logging.DEBUG
-            elif loglevel == "INFO":
-                loglevel_setting = logging.INFO
-            elif loglevel == "WARNING":
-                loglevel_setting = logging.WARNING
-            elif loglevel == "ERROR":
-                loglevel_setting = logging.ERROR
-
-        self.logger.setLevel(loglevel_setting)
-        self.logger.debug("Log level set to %s", loglevel)
-
-    # Controlled logging shutdown
-    def Shutdown(self):
-        self.getAppLogger().debug("Logging shutdown")
-        logging.shutdown()
+# coding: utf-8
+#
+# Python logging
+# Copyright © 2018, 2020 Dave Hocker as Qalydon (qalydon17@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# See the LICENSE.md file for more details.
+#
+
+import logging
+import logging.handlers
+import os
+import gzip
+import queue
+import shutil
+import atexit
+import threading
+from qf_home import find_home
+
+
+def _gzip_namer(name):
+    """
+    Name rotated log files with a .gz extension
+    :param name: The default rotated file name
+    :return: The compressed file name
+    """
+    return name + ".gz"
+
+
+def _gzip_rotator(source, dest):
+    """
+    Compress a rotated log file. Runs on the queue listener thread.
+    :param source: The log file being rotated
+    :param dest: The compressed file name
+    :return: None
+    """
+    with open(source, "rb") as sf, gzip.open(dest, "wb") as df:
+        shutil.copyfileobj(sf, df)
+    os.remove(source)
+
+
+class AppLogger:
+    # All of the created loggers
+    logger_list = []
+    # The queue, queue listener, file handler and log file of each created logger,
+    # and whether its listener is running. Records are put on the queue by the
+    # calling thread. The listener thread writes them to the file, so file I/O
+    # (and rotation) never holds up a cell.
+    listeners = {}
+    _lock = threading.Lock()
+
+    def __init__(self, logname):
+        self.logger = None
+        self.EnableLogging(logname)
+
+    ########################################################################
+    # Enable logging for the extension
+    def EnableLogging(self, logname):
+        if not logname in AppLogger.logger_list:
+            # Default overrides
+            logformat = '%(asctime)s, %(module)s, %(levelname)s, %(message)s'
+            logdateformat = '%Y-%m-%d %H:%M:%S'
+
+            self.logger = logging.getLogger(logname)
+
+            # Default logging to INFO until the level is set from the configuration
+            self.logger.setLevel(logging.INFO)
+
+            formatter = logging.Formatter(logformat, datefmt=logdateformat)
+
+            # Log to a file
+            # Make logfile location OS specific
+            file_path = find_home()
+            logfile = file_path + logname + ".log"
+
+            # Create directory if it doesn't exist
+            if not os.path.exists(file_path):
+                os.makedirs(file_path, exist_ok=True)
+
+            # The file is written by a queue listener thread
+            fh = AppLogger._create_file_handler(logfile, formatter, None)
+            log_queue = queue.Queue(-1)
+            self.logger.addHandler(logging.handlers.QueueHandler(log_queue))
+            listener = logging.handlers.QueueListener(log_queue, fh)
+            listener.start()
+            with AppLogger._lock:
+                if not AppLogger.listeners:
+                    # Flush the queue before logging shuts down
+                    atexit.register(AppLogger.stop_listeners)
+                AppLogger.listeners[logname] = (log_queue, listener, fh, logfile, True)
+            self.logger.debug("New logger %s created: %s", logname, self.logger)
+            self.logger.debug("%s logging to file: %s", logname, logfile)
+
+            # Note that this logname has been defined
+            AppLogger.logger_list.append(logname)
+        else:
+            # Use the logger that has been previously defined
+            self.logger = logging.getLogger(logname)
+
+    @staticmethod
+    def _create_file_handler(logfile, formatter, log_conf):
+        """
+        Create the log file handler
+        :param logfile: Full path of the log file
+        :param formatter: Formatter for the log records
+        :param log_conf: The logconf section of qf.conf. None for the defaults.
+        :return: A rotating file handler
+        """
+        if log_conf is None:
+            log_conf = {}
+        backup_count = int(log_conf.get("backupcount", 3))
+        if log_conf.get("rotation", "midnight") == "size":
+            fh = logging.handlers.RotatingFileHandler(logfile,
+                                                      maxBytes=int(log_conf.get("maxbytes", 5 * 1024 * 1024)),
+                                                      backupCount=backup_count)
+        else:
+            fh = logging.handlers.TimedRotatingFileHandler(logfile, when='midnight', backupCount=backup_count)
+        if log_conf.get("compress", False):
+            fh.namer = _gzip_namer
+            fh.rotator = _gzip_rotator
+        fh.setFormatter(formatter)
+        return fh
+
+    def set_log_file(self, log_conf):
+        """
+        Replace the log file handler with one that rotates the log file
+        as set in the logconf section of qf.conf
+        :param log_conf: The logconf dict
+        :return: None
+        """
+        logname = self.logger.name
+        with AppLogger._lock:
+            log_queue, listener, fh, logfile, started = AppLogger.listeners[logname]
+            new_fh = AppLogger._create_file_handler(logfile, fh.formatter, log_conf)
+            # Stopping the listener writes everything already queued to the old handler
+            if started:
+                listener.stop()
+            fh.close()
+            listener = logging.handlers.QueueListener(log_queue, new_fh)
+            listener.start()
+            AppLogger.listeners[logname] = (log_queue, listener, new_fh, logfile, True)
+
+    @classmethod
+    def stop_listeners(cls):
+        """
+        Write out any queued log records and stop the listener threads
+        :return: None
+        """
+        with cls._lock:
+            for logname, (log_queue, listener, fh, logfile, started) in cls.listeners.items():
+                if started:
+                    listener.stop()
+                    cls.listeners[logname] = (log_queue, listener, fh, logfile, False)
+
+    def getAppLogger(self):
+        """
+        Return an instance of the default logger for this app.
+        :return: logger instance
+        """
+        return self.logger
+
+    def set_log_level(self, loglevel):
+        # Logging level override (defaults to INFO)
+        loglevel_setting = logging.INFO
+        if loglevel:
+            loglevel = loglevel.upper()
+            if loglevel == "DEBUG":
+                loglevel_setting = logging.DEBUG
+            elif loglevel == "INFO":
+                loglevel_setting = logging.INFO
+            elif loglevel == "WARNING":
+                loglevel_setting = logging.WARNING
+            elif loglevel == "ERROR":
+                loglevel_setting = logging.ERROR
+
+        self.logger.setLevel(loglevel_setting)
+        self.logger.debug("Log level set to %s", loglevel)
+
+    # Controlled logging shutdown
+    def Shutdown(self):
+        self.getAppLogger().debug("Logging shutdown")
+        AppLogger.stop_listeners()
+        logging.shutdown()
@@ -0,0 +1,168 @@
+# coding: utf-8
+#
+# qf_async - asynchronous cell results using XVolatileResult
+# Copyright © 2022  Dave Hocker (email: Qalydon17@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# References
+# https://api.libreoffice.org/docs/idl/ref/interfacecom_1_1sun_1_1star_1_1sheet_1_1XVolatileResult.html
+#
+
+import threading
+from collections import OrderedDict
+import uno
+import unohelper
+from com.sun.star.sheet import XVolatileResult
+from qf_app_logger import AppLogger
+from qf_workers import get_executor
+from qf_deadline import TIMEOUT_RESULT
+
+# Logger init
+the_app_logger = AppLogger("qf-extension")
+logger = the_app_logger.getAppLogger()
+
+# The value shown in a cell while its data is being fetched
+PENDING_RESULT = "Pending"
+# Values that are fetched again when the cell is recalculated
+RETRY_RESULTS = [TIMEOUT_RESULT, "N/A"]
+
+
+class QFVolatileResult(unohelper.Base, XVolatileResult):
+    """
+    A cell value that can change after it has been returned to LO Calc.
+    LO Calc registers a listener for each cell using the result. When the
+    value changes, every listener gets a ResultEvent with the new value.
+    """
+    def __init__(self, value):
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._value = value
+        # True while a worker is fetching the value
+        self.pending = False
+
+    def addResultListener(self, listener):
+        with self._lock:
+            self._listeners.append(listener)
+            value = self._value
+        # A new listener is told the current value right away
+        listener.modified(self._make_event(value))
+
+    def removeResultListener(self, listener):
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    @property
+    def value(self):
+        return self._value
+
+    def set_value(self, value):
+        """
+        Change the value and push it to every cell that uses this result
+        :param value: The new cell value
+        :return: None
+        """
+        with self._lock:
+            self._value = value
+            listeners = list(self._listeners)
+        event = self._make_event(value)
+        for listener in listeners:
+            try:
+                listener.modified(event)
+            except Exception as ex:
+                logger.error("Unable to update listener: %s", str(ex))
+
+    def _make_event(self, value):
+        event = uno.createUnoStruct("com.sun.star.sheet.ResultEvent")
+        event.Source = self
+        event.Value = value
+        return event
+
+
+class AsyncResults:
+    """
+    Singleton. Registry of volatile results keyed by function and arguments.
+    LO Calc calls a function again whenever a cell is recalculated, so the same
+    result must be returned for the same arguments. A result whose fetch came up
+    empty (Timeout or N/A) is fetched again the next time it is asked for.
+    """
+    # Upper limit on the number of results kept
+    MAX_RESULTS = 10000
+
+    _lock = threading.Lock()
+    _results = OrderedDict()
+
+    @classmethod
+    def get_result(cls, key, probe, fetch):
+        """
+        Return the volatile result for a function call
+        :param key: A hashable key made from the function name and its arguments
+        :param probe: A callable returning the cached value or None. It is called
+        on the LO Calc thread, so it must not go to the network.
+        :param fetch: A callable that produces the value (it may take a while).
+        It runs on a worker thread.
+        :return: A QFVolatileResult
+        """
+        with cls._lock:
+            result = cls._results.get(key)
+            if result is not None:
+                cls._results.move_to_end(key)
+                if result.pending or result.value not in RETRY_RESULTS:
+                    return result
+                # The last fetch came up empty, try again
+                result.pending = True
+            else:
+                value = probe()
+                result = QFVolatileResult(value if value is not None else PENDING_RESULT)
+                cls._results[key] = result
+                cls._trim()
+                if value is not None:
+                    return result
+                result.pending = True
+
+        get_executor().submit(cls._run_fetch, key, result, fetch)
+        return result
+
+    @classmethod
+    def completed_result(cls, value):
+        """
+        Return a result that already has its final value (e.g. a validation error)
+        :param value: The cell value
+        :return: A QFVolatileResult
+        """
+        return QFVolatileResult(value)
+
+    @classmethod
+    def _run_fetch(cls, key, result, fetch):
+        """
+        Worker thread. Fetch a value and push it to the result.
+        :return: None
+        """
+        try:
+            value = fetch()
+        except Exception as ex:
+            value = str(ex)
+        logger.debug("Async result for %s: %s", key, value)
+        result.set_value(value)
+        with cls._lock:
+            result.pending = False
+
+    @classmethod
+    def _trim(cls):
+        """
+        Drop the least recently used results. Must be called with the lock held.
+        :return: None
+        """
+        while len(cls._results) > cls.MAX_RESULTS:
+            cls._results.popitem(last=False)
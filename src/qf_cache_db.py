@@ -19,7 +19,9 @@
 from qf_app_logger import AppLogger
 from qf_configuration import QConfiguration
 from qf_csv_cache_file import QFCSVCacheFile
+from qf_extn_helper import add_days
 import os
+import threading
 
 # Logger init
 the_app_logger = AppLogger("qf-extension")
@@ -36,12 +38,30 @@ class CacheDB:
     # Singleton instances of CSV cache files
     price_cache = None
     dividend_cache = None
+    dividend_event_cache = None
+    split_cache = None
+    coverage_cache = None
+    current_dividend_cache = None
 
     PRICE_CACHE_KEYS = ['Open', 'High', 'Low', 'Close', 'Volume', 'Adj_Close']
     DIVIDEND_CACHE_KEYS = ['Amount']
+    DIVIDEND_EVENT_CACHE_KEYS = ['Amount']
+    SPLIT_CACHE_KEYS = ['Numerator', 'Denominator']
+    COVERAGE_CACHE_KEYS = ['EndDate', 'Source', 'Events']
+    CURRENT_DIVIDEND_CACHE_KEYS = ['Amount', 'Source']
+
+    # Serializes opening the cache files when lookups run on worker threads
+    _open_lock = threading.Lock()
 
     @classmethod
-    def _open_price_cache(cls):
+    def _open_cache_file(cls, file_name, value_date, value_keys):
+        """
+        Open (and create if necessary) a CSV cache file in the cache folder
+        :param file_name: Name of the CSV file (e.g. symbol_date.csv)
+        :param value_date: Name of the date column
+        :param value_keys: Names of the value columns
+        :return: A loaded QFCSVCacheFile instance
+        """
         # Determine cache location based on underlying OS
         # TODO Replace/remove DB from configuration
         full_file_path = QConfiguration.qf_cache_db
@@ -51,46 +71,63 @@ class CacheDB:
         if not os.path.exists(file_path):
             logger.info("Create directory")
             os.makedirs(file_path)
-        full_file_path = os.path.join(file_path, "symbol_date.csv")
-
-        if cls.price_cache is None:
-            logger.debug("Opening price cache file %s", full_file_path)
-            cls.price_cache = QFCSVCacheFile(full_file_path,
-                                         symbol="Symbol", value_date="Date",
-                                         value_keys=cls.PRICE_CACHE_KEYS)
-            # Create the CSV file if it does not exist
-            if not os.path.exists(full_file_path):
-                cls.price_cache.create_csv()
-                logger.debug("Created %s", full_file_path)
-            cls.price_cache.load_csv()
+        full_file_path = os.path.join(file_path, file_name)
 
+        logger.debug("Opening cache file %s", full_file_path)
+        cache_file = QFCSVCacheFile(full_file_path,
+                                    symbol="Symbol", value_date=value_date,
+                                    value_keys=value_keys)
+        # Create the CSV file if it does not exist
+        if not os.path.exists(full_file_path):
+            cache_file.create_csv()
+            logger.debug("Created %s", full_file_path)
+        cache_file.load_csv()
+
+        return cache_file
+
+    @classmethod
+    def _open_price_cache(cls):
+        with cls._open_lock:
+            if cls.price_cache is None:
+                cls.price_cache = cls._open_cache_file("symbol_date.csv", "Date", cls.PRICE_CACHE_KEYS)
         return cls.price_cache
 
     @classmethod
     def _open_dividend_cache(cls):
-        # Determine cache location based on underlying OS
-        # TODO Replace/remove DB from configuration
-        full_file_path = QConfiguration.qf_cache_db
-        file_path = os.path.dirname(full_file_path)
+        with cls._open_lock:
+            if cls.dividend_cache is None:
+                cls.dividend_cache = cls._open_cache_file("ttmdividends.csv", "CalcDate", cls.DIVIDEND_CACHE_KEYS)
+        return cls.dividend_cache
 
-        # Make the folder if it does not exist
-        if not os.path.exists(file_path):
-            logger.info("Create directory")
-            os.makedirs(file_path)
-        full_file_path = os.path.join(file_path, "ttmdividends.csv")
-
-        if cls.dividend_cache is None:
-            logger.debug("Opening dividend cache file %s", full_file_path)
-            cls.dividend_cache = QFCSVCacheFile(full_file_path,
-                                         symbol="Symbol", value_date="CalcDate",
-                                         value_keys=cls.DIVIDEND_CACHE_KEYS)
-            # If the CSV file does not exist, create it
-            if not os.path.exists(full_file_path):
-                cls.dividend_cache.create_csv()
-                logger.debug("Created %s", full_file_path)
-            cls.dividend_cache.load_csv()
+    @classmethod
+    def _open_dividend_event_cache(cls):
+        with cls._open_lock:
+            if cls.dividend_event_cache is None:
+                cls.dividend_event_cache = cls._open_cache_file("dividends.csv", "ExDate",
+                                                                cls.DIVIDEND_EVENT_CACHE_KEYS)
+        return cls.dividend_event_cache
 
-        return cls.dividend_cache
+    @classmethod
+    def _open_split_cache(cls):
+        with cls._open_lock:
+            if cls.split_cache is None:
+                cls.split_cache = cls._open_cache_file("splits.csv", "Date", cls.SPLIT_CACHE_KEYS)
+        return cls.split_cache
+
+    @classmethod
+    def _open_coverage_cache(cls):
+        with cls._open_lock:
+            if cls.coverage_cache is None:
+                cls.coverage_cache = cls._open_cache_file("coverage.csv", "StartDate", cls.COVERAGE_CACHE_KEYS)
+        return cls.coverage_cache
+
+    @classmethod
+    def _open_current_dividend_cache(cls):
+        with cls._open_lock:
+            if cls.current_dividend_cache is None:
+                cls.current_dividend_cache = cls._open_cache_file("current_ttmdividends.csv", "CalcDate",
+                                                                  cls.CURRENT_DIVIDEND_CACHE_KEYS)
+        return cls.current_dividend_cache
 
     @classmethod
     def lookup_closing_price_by_date(cls, symbol, tgtdate):
@@ -148,6 +185,53 @@ class CacheDB:
         }
         cache_file.add_cache_record(symbol, tgtdate, values)
 
+    @classmethod
+    def lookup_prices(cls, symbol, start_date, end_date):
+        """
+        Look up the cached prices for a symbol in a date range.
+        :param symbol:
+        :param start_date: yyyy-mm-dd
+        :param end_date: yyyy-mm-dd
+        :return: A list of dicts in date order with keys date, open, high, low,
+        close, volume and adj_close. Values are floats.
+        """
+        cache_file = cls._open_price_cache()
+        prices = []
+        for d, r in cache_file.get_symbol_records(symbol, start_date, end_date):
+            prices.append(cls._float_price_record(d, r))
+        return prices
+
+    @classmethod
+    def lookup_price_on_or_before(cls, symbol, tgtdate):
+        """
+        Look up the latest cached price record for a symbol on or before a date.
+        :param symbol:
+        :param tgtdate: yyyy-mm-dd
+        :return: A dict with keys date, open, high, low, close, volume and adj_close
+        or None if there is no record on or before the date.
+        """
+        cache_file = cls._open_price_cache()
+        dr = cache_file.get_last_record_on_or_before(symbol, tgtdate)
+        if dr is None:
+            return None
+        return cls._float_price_record(dr[0], dr[1])
+
+    @classmethod
+    def _float_price_record(cls, d, r):
+        """
+        Convert a price cache record to a dict with lower case keys and float values
+        :param d: yyyy-mm-dd
+        :param r: The cache record
+        :return: dict with keys date, open, high, low, close, volume and adj_close
+        """
+        p = {"date": d}
+        for key in cls.PRICE_CACHE_KEYS:
+            try:
+                p[key.lower()] = float(r[key])
+            except (ValueError, TypeError):
+                p[key.lower()] = 0.0
+        return p
+
     @classmethod
     def lookup_ttm_dividend_by_date(cls, symbol, tgtdate):
         """
@@ -160,6 +244,37 @@ class CacheDB:
         r = cache_file.get_cache_record(symbol, tgtdate)
         return r
 
+    @classmethod
+    def lookup_current_ttm_dividend_on_or_before(cls, symbol, tgtdate, source):
+        """
+        Look up the latest TTM dividend a current only data source cached
+        for a symbol on or before a date.
+        :param symbol:
+        :param tgtdate: yyyy-mm-dd
+        :param source: Data source name (e.g. cnbc)
+        :return: A (date, record) tuple or None if there is no such record.
+        """
+        cache_file = cls._open_current_dividend_cache()
+        for d, r in reversed(cache_file.get_symbol_records(symbol, end_date=tgtdate)):
+            if r["Source"] == source:
+                return d, r
+        return None
+
+    @classmethod
+    def insert_current_ttm_dividend(cls, symbol, tgtdate, dividend, source):
+        """
+        Record a TTM dividend returned by a current only data source, along
+        with the source, so it can be served stale for later dates.
+        :param symbol:
+        :param tgtdate: yyyy-mm-dd
+        :param dividend: TTM dividend amount
+        :param source: Data source name
+        :return: None
+        """
+        cache_file = cls._open_current_dividend_cache()
+        values = {"Amount": dividend, "Source": source}
+        cache_file.add_cache_record(symbol, tgtdate, values)
+
     @classmethod
     def insert_ttm_dividend(cls, symbol, tgtdate, dividend, source):
         """
@@ -174,3 +289,161 @@ class CacheDB:
         cache_file = cls._open_dividend_cache()
         values = {"Amount": dividend}
         cache_file.add_cache_record(symbol, tgtdate, values)
+
+    @classmethod
+    def insert_ohlc_prices(cls, symbol, prices, data_source):
+        """
+        Insert a batch of OHLC records into the cache DB with a single write.
+        Dates that are already cached are skipped.
+        :param symbol:
+        :param prices: A list of dicts with keys date (yyyy-mm-dd), open, high,
+        low, close and optionally volume and adj_close.
+        :param data_source: text
+        :return: The number of records added
+        """
+        cache_file = cls._open_price_cache()
+        records = []
+        for r in prices:
+            values = {
+                "Open": r["open"],
+                "High": r["high"],
+                "Low": r["low"],
+                "Close": r["close"],
+                "Volume": r.get("volume", 0),
+                "Adj_Close": r.get("adj_close", 0.0)
+            }
+            records.append((r["date"], values))
+        return cache_file.add_cache_records(symbol, records)
+
+    @classmethod
+    def insert_dividend_events(cls, symbol, dividends):
+        """
+        Insert a batch of dividend distributions (ex-date and amount).
+        :param symbol:
+        :param dividends: A list of dicts with keys date (yyyy-mm-dd) and amount
+        :return: The number of records added
+        """
+        cache_file = cls._open_dividend_event_cache()
+        records = [(d["date"], {"Amount": d["amount"]}) for d in dividends]
+        return cache_file.add_cache_records(symbol, records)
+
+    @classmethod
+    def insert_splits(cls, symbol, splits):
+        """
+        Insert a batch of stock splits.
+        :param symbol:
+        :param splits: A list of dicts with keys date (yyyy-mm-dd), numerator and denominator
+        :return: The number of records added
+        """
+        cache_file = cls._open_split_cache()
+        records = [(r["date"], {"Numerator": r["numerator"], "Denominator": r["denominator"]})
+                   for r in splits]
+        return cache_file.add_cache_records(symbol, records)
+
+    @classmethod
+    def insert_coverage(cls, symbol, start_date, end_date, data_source, events):
+        """
+        Record that a date range has been fetched for a symbol. Every trading day
+        in the range is in the price cache. If events is True, every dividend and
+        split in the range is in the event caches.
+        :param symbol:
+        :param start_date: yyyy-mm-dd
+        :param end_date: yyyy-mm-dd
+        :param data_source: text
+        :param events: True if dividends and splits were fetched with the prices
+        :return: None
+        """
+        cache_file = cls._open_coverage_cache()
+        cr = cache_file.get_cache_record(symbol, start_date)
+        if cr:
+            cr_events = str(cr["Events"]) == "True"
+            if cr["EndDate"] >= end_date and (cr_events or not events):
+                # Already covered
+                return
+            if cr_events and not events:
+                # Keep the event coverage. Only the extension is price only coverage.
+                cls.insert_coverage(symbol, add_days(cr["EndDate"], 1), end_date, data_source, False)
+                return
+            if events and cr["EndDate"] > end_date:
+                # The new record replaces a longer price only record. The part
+                # of it past the new record is kept as its own record.
+                cls.insert_coverage(symbol, add_days(end_date, 1), cr["EndDate"], cr["Source"], False)
+        values = {"EndDate": end_date, "Source": data_source, "Events": events}
+        cache_file.add_cache_record(symbol, start_date, values)
+
+    @classmethod
+    def insert_price_range(cls, symbol, price_range, start_date, end_date, data_source):
+        """
+        Cache everything returned by a price range request: prices, dividends, splits
+        and the coverage of the range.
+        :param symbol:
+        :param price_range: dict with prices, dividends and splits lists
+        (see DataSourceBase.get_historical_price_range)
+        :param start_date: yyyy-mm-dd
+        :param end_date: yyyy-mm-dd
+        :param data_source: text
+        :return: None
+        """
+        added = cls.insert_ohlc_prices(symbol, price_range["prices"], data_source)
+        events = "dividends" in price_range.keys()
+        if events:
+            cls.insert_dividend_events(symbol, price_range["dividends"])
+            cls.insert_splits(symbol, price_range.get("splits", []))
+        cls.insert_coverage(symbol, start_date, end_date, data_source, events)
+        logger.debug("Cached %d prices for %s %s to %s from %s", added, symbol, start_date, end_date, data_source)
+
+    @classmethod
+    def lookup_dividend_events(cls, symbol, start_date, end_date):
+        """
+        Look up the cached dividend distributions for a symbol in a date range.
+        :param symbol:
+        :param start_date: yyyy-mm-dd, first ex-date to include
+        :param end_date: yyyy-mm-dd, last ex-date to include
+        :return: A list of (ex-date, amount) tuples in date order
+        """
+        cache_file = cls._open_dividend_event_cache()
+        return [(d, float(r["Amount"])) for d, r in cache_file.get_symbol_records(symbol, start_date, end_date)]
+
+    @classmethod
+    def get_uncovered_ranges(cls, symbol, start_date, end_date, events=False):
+        """
+        Find the parts of a date range that have not been fetched for a symbol
+        :param symbol:
+        :param start_date: yyyy-mm-dd
+        :param end_date: yyyy-mm-dd
+        :param events: If True, only count ranges that were fetched with dividends and splits
+        :return: A list of (start date, end date) tuples. An empty list means
+        the range is completely covered.
+        """
+        cache_file = cls._open_coverage_cache()
+        intervals = []
+        for d, r in cache_file.get_symbol_records(symbol):
+            if events and str(r["Events"]) != "True":
+                continue
+            intervals.append((d, r["EndDate"]))
+
+        gaps = []
+        next_uncovered = start_date
+        for covered_start, covered_end in sorted(intervals):
+            if covered_start > next_uncovered:
+                if covered_start > end_date:
+                    break
+                gaps.append((next_uncovered, add_days(covered_start, -1)))
+            if covered_end >= next_uncovered:
+                next_uncovered = add_days(covered_end, 1)
+            if next_uncovered > end_date:
+                return gaps
+        gaps.append((next_uncovered, end_date))
+        return gaps
+
+    @classmethod
+    def is_range_covered(cls, symbol, start_date, end_date, events=False):
+        """
+        Answers the question: has every date in the range been fetched for a symbol?
+        :param symbol:
+        :param start_date: yyyy-mm-dd
+        :param end_date: yyyy-mm-dd
+        :param events: If True, dividends and splits must have been fetched as well
+        :return: True or False
+        """
+        return not cls.get_uncovered_ranges(symbol, start_date, end_date, events=events)
@@ -20,8 +20,10 @@ import json
 import re
 import time
 import datetime
+import threading
 import urllib.request
 from qf_app_logger import AppLogger
+from qf_url_helpers import open_url, read_content
 from qf_data_source_base import DataSourceBase
 from qf_configuration import QConfiguration
 
@@ -32,10 +34,11 @@ logger = the_app_logger.getAppLogger()
 
 class CNBCDataSource(DataSourceBase):
     # Pacing control, hopefully to avoid getting throttled or banned
-    # This value is shared across all instances of the data source
-    # and NO attempt is made to syncrhonize access to it. The
-    # worst outcome is that extra pacing will occur.
+    # This value is shared across all instances of the data source.
+    # Batch lookups run requests on worker threads, so access is
+    # serialized by the pacing lock.
     _last_request_time = datetime.datetime.now()
+    _pacing_lock = threading.Lock()
     _pause = float(QConfiguration.qf_cnbc_conf["pacing"]) # float, seconds (e.g. 0.200)
 
     # Not sure we need the Connection header.
@@ -62,6 +65,19 @@ class CNBCDataSource(DataSourceBase):
 
         return {}
 
+    def is_current_only(self):
+        """
+        The CNBC quote page only has the current TTM dividend
+        :return: True
+        """
+        return True
+
+    def get_freshness_days(self):
+        """
+        :return: The cnbcconf freshdays setting
+        """
+        return int(QConfiguration.qf_cnbc_conf.get("freshdays", 7))
+
     def get_dividend_data(self, symbol, for_date, period):
         """
         Essentially a page scrape of a CNBC page containing current data.
@@ -85,16 +101,17 @@ class CNBCDataSource(DataSourceBase):
         logger.debug("Calling %s", url)
 
         # Apply pacing, avoid getting throttled
-        elapsed = datetime.datetime.now() - CNBCDataSource._last_request_time
-        if elapsed.total_seconds() < CNBCDataSource._pause:
-            time.sleep(CNBCDataSource._pause)
-            logger.debug("Pacing %f...", CNBCDataSource._pause)
-        CNBCDataSource._last_request_time = datetime.datetime.now()
+        with CNBCDataSource._pacing_lock:
+            elapsed = datetime.datetime.now() - CNBCDataSource._last_request_time
+            if elapsed.total_seconds() < CNBCDataSource._pause:
+                time.sleep(CNBCDataSource._pause)
+                logger.debug("Pacing %f...", CNBCDataSource._pause)
+            CNBCDataSource._last_request_time = datetime.datetime.now()
 
         # Send the request and read the response
         try:
-            with urllib.request.urlopen(req) as page_source:
-                resp = page_source.read().decode()
+            with open_url(req, "cnbc") as page_source:
+                resp = read_content(page_source, "cnbc")
         except Exception as ex:
             logger.error(ex)
             raise ex
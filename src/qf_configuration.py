@@ -23,7 +23,6 @@ import inspect
 import datetime
 import json
 from qf_app_logger import AppLogger
-from qf_url_helpers import setup_cacerts
 from qf_home import find_home
 
 # Logger init
@@ -60,13 +59,79 @@ class QConfiguration:
         "tickerpostfix": ".us"
     }
     qf_tiingo_conf = {
-        "apitoken": ""
+        "apitoken": "",
+        "rangemode": True
     }
     qf_yahoo_conf = {
-        "pacing": 0.200
+        "pacing": 0.200,
+        "rangemonths": 3
     }
     qf_cnbc_conf = {
-        "pacing": 0.200
+        "pacing": 0.200,
+        "freshdays": 7
+    }
+    # Network timeouts in seconds. The connect and read timeouts can be
+    # overridden in any data source configuration (e.g. yahooconf).
+    # The cell deadline is the total time allowed for a single cell
+    # across all of the data sources in a category list.
+    qf_timeout_conf = {
+        "connecttimeout": 5.0,
+        "readtimeout": 15.0,
+        "celldeadline": 30.0
+    }
+    # Retry policy for throttled (429), failed (5xx) and reset requests.
+    # Any data source configuration can override maxretries.
+    # Delays are in seconds.
+    qf_retry_conf = {
+        "maxretries": 2,
+        "backoff": 0.5,
+        "maxbackoff": 8.0
+    }
+    # Worker threads used for concurrent fetches (e.g. QFClosingPrices)
+    qf_workers_conf = {
+        "maxworkers": 8
+    }
+    # Date-major bulk fetching. When threshold different symbols miss the
+    # cache for the same date, the whole day is downloaded from a data source
+    # that supports it. Up to maxdays downloaded days are kept in memory.
+    # A threshold of 0 turns bulk fetching off.
+    qf_bulk_conf = {
+        "threshold": 5,
+        "maxdays": 4
+    }
+    # Request quotas for data sources with request limits.
+    # Each quota can have perminute, hourly and daily limits.
+    # reserve is the number of requests held back from each limit.
+    # maxdefer is the longest time (seconds) a request will wait for room
+    # before moving on to the next data source.
+    qf_quota_conf = {
+        "tiingo": {
+            "hourly": 50,
+            "daily": 1000,
+            "reserve": 2,
+            "maxdefer": 0.0
+        }
+    }
+    # Log file rotation. rotation is midnight (a new file every day) or size
+    # (a new file when the log reaches maxbytes). Rotated files are gzip
+    # compressed when compress is true.
+    qf_log_conf = {
+        "rotation": "midnight",
+        "maxbytes": 5 * 1024 * 1024,
+        "backupcount": 3,
+        "compress": False
+    }
+    # Latency histograms. When enabled, the histograms are written to
+    # qf-metrics.json in the home directory every interval seconds.
+    qf_metrics_conf = {
+        "enabled": False,
+        "interval": 60
+    }
+    # Profiling of QF function calls. Setting the QF_LOCALC_PROFILE environment
+    # variable to 1 also turns it on. interval is the stack sampling period (seconds).
+    qf_profile_conf = {
+        "enabled": False,
+        "interval": 0.005
     }
     # Default data sources in priority order
     qf_data_sources = {
@@ -74,7 +139,7 @@ class QConfiguration:
         "mutf": ["wsj", "stooq", "tiingo", "yahoo"],
         "etf": ["wsj", "stooq", "tiingo", "yahoo"],
         "index": ["stooq", "wsj", "yahoo"],
-        "dividend": ["yahoo", "cnbc"]
+        "dividend": ["yahoo", "cnbc", "tiingo"]
     }
 
 
@@ -134,6 +199,40 @@ class QConfiguration:
             if "cnbcconf" in cfj:
                 cls.qf_cnbc_conf = cfj["cnbcconf"]
 
+            # Timeout configuration, overlays the defaults
+            if "timeoutconf" in cfj:
+                cls.qf_timeout_conf.update(cfj["timeoutconf"])
+
+            # Retry configuration, overlays the defaults
+            if "retryconf" in cfj:
+                cls.qf_retry_conf.update(cfj["retryconf"])
+
+            # Worker configuration, overlays the defaults
+            if "workersconf" in cfj:
+                cls.qf_workers_conf.update(cfj["workersconf"])
+
+            # Bulk configuration, overlays the defaults
+            if "bulkconf" in cfj:
+                cls.qf_bulk_conf.update(cfj["bulkconf"])
+
+            # Quota configuration, overlays the defaults by data source
+            if "quotaconf" in cfj:
+                # Merged one data source at a time so a partial override keeps the default limits
+                for dsn, quota in cfj["quotaconf"].items():
+                    cls.qf_quota_conf.setdefault(dsn, {}).update(quota)
+
+            # Log file configuration, overlays the defaults
+            if "logconf" in cfj:
+                cls.qf_log_conf.update(cfj["logconf"])
+
+            # Metrics configuration, overlays the defaults
+            if "metricsconf" in cfj:
+                cls.qf_metrics_conf.update(cfj["metricsconf"])
+
+            # Profile configuration, overlays the defaults
+            if "profileconf" in cfj:
+                cls.qf_profile_conf.update(cfj["profileconf"])
+
             # New list of prioritized data sources
             if "datasources" in cfj:
                 # Overlay the defaults with config file settings
@@ -164,13 +263,17 @@ class QConfiguration:
             # This may not be necessary in Windows
             cls.cacerts = "{0}\\cacert.pem".format(cls.cwd)
         logger.debug("Path to cacert.pem: %s", cls.cacerts)
-        # Attach the certs file to the URL processor
-        setup_cacerts(cls.cacerts)
+        # The certs file is attached to the URL processor when the first
+        # request is made (see qf_url_helpers.open_url). Building the SSL
+        # context is expensive and a cache hit never needs it.
+
+        # Log file rotation is set up once the configuration is known
+        the_app_logger.set_log_file(cls.qf_log_conf)
 
         # If no qf.conf file exists, create one with all defaults
         if not cls.qf_conf_exists:
             QConfiguration.save()
-            # The logger defaults to debug level logging.
+            # The logger defaults to info level logging.
             # This sets the log level to whatever default was set above.
             the_app_logger.set_log_level(cls.loglevel)
 
@@ -192,6 +295,16 @@ class QConfiguration:
         conf["datasources"] = cls.qf_data_sources
         conf["stooqconf"] = cls.qf_stooq_conf
         conf["tiingoconf"] = cls.qf_tiingo_conf
+        conf["yahooconf"] = cls.qf_yahoo_conf
+        conf["cnbcconf"] = cls.qf_cnbc_conf
+        conf["timeoutconf"] = cls.qf_timeout_conf
+        conf["retryconf"] = cls.qf_retry_conf
+        conf["workersconf"] = cls.qf_workers_conf
+        conf["bulkconf"] = cls.qf_bulk_conf
+        conf["quotaconf"] = cls.qf_quota_conf
+        conf["logconf"] = cls.qf_log_conf
+        conf["metricsconf"] = cls.qf_metrics_conf
+        conf["profileconf"] = cls.qf_profile_conf
 
         logger.debug("Saving configuration to %s", cls.full_file_path)
         cf = open(cls.full_file_path, "w")
@@ -218,8 +331,53 @@ class QConfiguration:
             return cls.qf_data_sources["stock"]
         if category in ["mutf", "mutualfund"]:
             return cls.qf_data_sources["mutf"]
+        if category == "dividend" and not cls.qf_tiingo_conf.get("apitoken"):
+            # Dividends never prompt for a Tiingo API key
+            return [dsn for dsn in cls.qf_data_sources["dividend"] if dsn != "tiingo"]
         return cls.qf_data_sources[category]
 
+    @classmethod
+    def get_timeouts(cls, data_source_name):
+        """
+        Return the connect and read timeouts for a data source. The data source
+        configuration can override the global timeout configuration.
+        :param data_source_name: wsj, stooq, tiingo, yahoo, cnbc
+        :return: Tuple (connect timeout, read timeout) in seconds
+        """
+        source_conf = getattr(cls, "qf_{0}_conf".format(data_source_name), {})
+        connect_timeout = source_conf.get("connecttimeout", cls.qf_timeout_conf["connecttimeout"])
+        read_timeout = source_conf.get("readtimeout", cls.qf_timeout_conf["readtimeout"])
+        return float(connect_timeout), float(read_timeout)
+
+    @classmethod
+    def get_retry_policy(cls, data_source_name):
+        """
+        Return the retry policy for a data source. The data source
+        configuration can override the number of retries.
+        :param data_source_name: wsj, stooq, tiingo, yahoo, cnbc
+        :return: Tuple (max retries, backoff base, max backoff)
+        """
+        source_conf = getattr(cls, "qf_{0}_conf".format(data_source_name), {})
+        max_retries = source_conf.get("maxretries", cls.qf_retry_conf["maxretries"])
+        return int(max_retries), float(cls.qf_retry_conf["backoff"]), float(cls.qf_retry_conf["maxbackoff"])
+
+    @classmethod
+    def get_cell_deadline(cls):
+        """
+        Return the total time allowed for a single cell
+        :return: Seconds as a float
+        """
+        return float(cls.qf_timeout_conf["celldeadline"])
+
+    @classmethod
+    def get_quota(cls, data_source_name):
+        """
+        Return the request quota for a data source
+        :param data_source_name: wsj, stooq, tiingo, yahoo, cnbc
+        :return: The quota as a dict or None if the data source has no quota
+        """
+        return cls.qf_quota_conf.get(data_source_name)
+
     @classmethod
     def is_configured(cls):
         """
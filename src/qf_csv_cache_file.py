@@ -17,6 +17,9 @@
 #
 
 import csv
+import bisect
+import threading
+from qf_metrics import Metrics
 
 
 class QFCSVCacheFile():
@@ -27,6 +30,9 @@ class QFCSVCacheFile():
 
 
     Each record in the CSV file has the following columns: ticker symbol, date, value-1,...,value-n.
+
+    Batch lookups fetch on worker threads, so the file and the in-memory
+    cache are guarded by a lock.
     """
     def __init__(self, csv_file_path, symbol="", value_date="", value_keys=None):
         """
@@ -50,6 +56,9 @@ class QFCSVCacheFile():
         self._csv_field_names.extend(self._value_keys)
 
         self._cache = None
+        # Sorted dates for each symbol, built on first use
+        self._symbol_index = None
+        self._lock = threading.RLock()
 
     def get_cache_record(self, symbol, value_date):
         """
@@ -81,12 +90,67 @@ class QFCSVCacheFile():
             return None
         return cr[value_key]
 
+    def get_symbol_records(self, symbol, start_date=None, end_date=None):
+        """
+        Return the cache records for a symbol in date order
+        :param symbol: Ticker symbol
+        :param start_date: Optional ISO format date yyyy-mm-dd. The first date to return.
+        :param end_date: Optional ISO format date yyyy-mm-dd. The last date to return.
+        :return: A list of (date, record) tuples
+        """
+        with self._lock:
+            dates = self._get_symbol_dates(symbol)
+            lo = 0 if start_date is None else bisect.bisect_left(dates, start_date)
+            hi = len(dates) if end_date is None else bisect.bisect_right(dates, end_date)
+            return [(d, self._cache[QFCSVCacheFile._make_key(symbol, d)]) for d in dates[lo:hi]]
+
+    def get_last_record_on_or_before(self, symbol, value_date):
+        """
+        Return the latest cache record for a symbol on or before a date
+        :param symbol: Ticker symbol
+        :param value_date: ISO format date yyyy-mm-dd
+        :return: A (date, record) tuple or None if there is no such record
+        """
+        with self._lock:
+            dates = self._get_symbol_dates(symbol)
+            i = bisect.bisect_right(dates, value_date)
+            if i == 0:
+                return None
+            d = dates[i - 1]
+            return d, self._cache[QFCSVCacheFile._make_key(symbol, d)]
+
+    def _get_symbol_dates(self, symbol):
+        """
+        Return the sorted list of cached dates for a symbol
+        :param symbol: Ticker symbol
+        :return: list of ISO format dates
+        """
+        if self._symbol_index is None:
+            self._symbol_index = {}
+            for key in self._cache.keys():
+                sym, d = QFCSVCacheFile._split_key(key)
+                self._symbol_index.setdefault(sym, []).append(d)
+            for dates in self._symbol_index.values():
+                dates.sort()
+        return self._symbol_index.get(symbol, [])
+
+    def _index_date(self, symbol, value_date):
+        """
+        Add a new date to the symbol index (if the index has been built)
+        :param symbol: Ticker symbol
+        :param value_date: ISO format date yyyy-mm-dd
+        :return: None
+        """
+        if self._symbol_index is not None:
+            bisect.insort(self._symbol_index.setdefault(symbol, []), value_date)
+
     def load_csv(self):
         """
         Load a history CSV file
         :return: Returns a dict containing all of the records from the CSV file.
         """
         self._cache = {}
+        self._symbol_index = None
         csv_file = open(self._csv_file_path, "r", newline='')
         reader = csv.DictReader(csv_file)
         for r in reader:
@@ -108,6 +172,7 @@ class QFCSVCacheFile():
         csv_file.close()
 
         self._cache = {}
+        self._symbol_index = None
 
     def add_cache_record(self, symbol, value_date, values):
         """
@@ -123,17 +188,51 @@ class QFCSVCacheFile():
         for k in self._value_keys:
             row[k] = values[k]
 
-        # Open CSV file for appending
-        csv_file = open(self._csv_file_path, "a", newline='')
+        with self._lock, Metrics.timer("cache.append"):
+            # Open CSV file for appending
+            csv_file = open(self._csv_file_path, "a", newline='')
 
-        # Append the new record to cache file
-        writer = csv.DictWriter(csv_file, fieldnames=self._csv_field_names)
-        writer.writerow(row)
-        csv_file.close()
+            # Append the new record to cache file
+            writer = csv.DictWriter(csv_file, fieldnames=self._csv_field_names)
+            writer.writerow(row)
+            csv_file.close()
 
-        # Add to in-memory cache
-        key = QFCSVCacheFile._make_key(symbol, value_date)
-        self._cache[key] = values
+            # Add to in-memory cache. The record looks just like one loaded from the CSV file.
+            key = QFCSVCacheFile._make_key(symbol, value_date)
+            if key not in self._cache.keys():
+                self._index_date(symbol, value_date)
+            self._cache[key] = row
+
+    def add_cache_records(self, symbol, records):
+        """
+        Append a batch of new CSV records with a single write. Records
+        that are already in the cache are skipped.
+        :param symbol:
+        :param records: A list of (value_date, values) tuples. The keys of
+        values MUST match the value_keys used to create the CSVCacheFile instance.
+        :return: The number of records added
+        """
+        rows = []
+        with self._lock:
+            for value_date, values in records:
+                key = QFCSVCacheFile._make_key(symbol, value_date)
+                if key in self._cache.keys():
+                    continue
+                row = {self._symbol: symbol, self._value_date: value_date}
+                for k in self._value_keys:
+                    row[k] = values[k]
+                rows.append(row)
+                self._cache[key] = row
+                self._index_date(symbol, value_date)
+
+            if rows:
+                with Metrics.timer("cache.append"):
+                    csv_file = open(self._csv_file_path, "a", newline='')
+                    writer = csv.DictWriter(csv_file, fieldnames=self._csv_field_names)
+                    writer.writerows(rows)
+                    csv_file.close()
+
+        return len(rows)
 
     @staticmethod
     def _make_key(symbol, value_date):
@@ -145,3 +244,12 @@ class QFCSVCacheFile():
         """
         return symbol + ":" + value_date
 
+    @staticmethod
+    def _split_key(key):
+        """
+        Split a compound key into its parts
+        :param key: symbol:date
+        :return: Tuple (symbol, date)
+        """
+        i = key.rfind(":")
+        return key[:i], key[i + 1:]
@@ -41,6 +41,77 @@ class DataSourceBase:
         """
         return {}
 
+    def get_price_range_window(self, for_date):
+        """
+        Range mode. A data source that can return many days in one request
+        returns the window of dates to request in place of a single date.
+        :param for_date: yyyy-mm-dd ISO format
+        :return: (start_date, end_date) as yyyy-mm-dd or None if range mode is not used
+        """
+        return None
+
+    def is_current_only(self):
+        """
+        A data source that only has current data (e.g. a quote page) can not
+        answer for past dates. Its cached values are served stale while a
+        background refresh gets the current value.
+        :return: True if the data source only returns current data
+        """
+        return False
+
+    def get_freshness_days(self):
+        """
+        For a current only data source, how old a cached value can be and
+        still be served for a later date.
+        :return: Number of days
+        """
+        return 0
+
+    def get_dividend_range_window(self, for_date):
+        """
+        Range mode for dividends. A data source that returns dividends with its
+        price ranges returns the window to request for the TTM period ending on a date.
+        :param for_date: yyyy-mm-dd ISO format
+        :return: (start_date, end_date) as yyyy-mm-dd or None if range mode is not used
+        """
+        return None
+
+    def get_historical_price_range(self, ticker, category, start_date, end_date):
+        """
+        Get historical price data for every trading day in a date range
+        :param ticker: djia, spx, comp for common indices. Otherwise, a stock symbol.
+        :param category: stock, etf, mutf or mutualfund, index.
+        :param start_date: yyyy-mm-dd ISO format
+        :param end_date: yyyy-mm-dd ISO format
+        :return: A dict with the keys
+            prices: list of dicts with keys date, open, high, low, close, volume, adj_close
+            dividends: list of dicts with keys date and amount
+            splits: list of dicts with keys date, numerator and denominator
+        The dividends and splits keys are only present if the data source returns
+        corporate actions with the prices.
+        """
+        raise NotImplementedError("This data source does not support price ranges")
+
+    def get_bulk_symbol(self, ticker, category):
+        """
+        Date-major bulk mode. A data source that can return every symbol for
+        a single date in one request returns the key it uses for a ticker in
+        the result of get_historical_price_bulk().
+        :param ticker: djia, spx, comp for common indices. Otherwise, a stock symbol.
+        :param category: stock, etf, mutf or mutualfund, index.
+        :return: The bulk key or None if the ticker/category is not available in bulk
+        """
+        return None
+
+    def get_historical_price_bulk(self, for_date):
+        """
+        Get the prices of every symbol the data source has for a single date
+        :param for_date: yyyy-mm-dd ISO format
+        :return: A dict keyed by bulk symbol (see get_bulk_symbol()). Each value is
+        a dict with keys date, open, high, low, close, volume.
+        """
+        raise NotImplementedError("This data source does not support bulk downloads")
+
     def get_dividend_data(self, symbol, for_date, period):
         """
         Get dividend distributions for the given symbol and period
@@ -16,13 +16,8 @@
 # along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from qf_configuration import QConfiguration
-from qf_wsj import WSJDataSource
-# from qf_iex import IEXDataSource
-from qf_cnbc import CNBCDataSource
-from qf_stooq import StooqDataSource
-from qf_tiingo import TiingoDataSource
-from qf_yahoo import YahooDataSource
+import importlib
+import threading
 from qf_app_logger import AppLogger
 
 
@@ -33,23 +28,36 @@ logger = the_app_logger.getAppLogger()
 
 class DataSourceMgr:
     """
-    Singleton
+    Singleton. Data sources are imported and created on first use,
+    so a sheet that only hits the cache never loads any of them.
     """
     qf_data_source_obj = None
-    _sources = {
-        "wsj": WSJDataSource(),
-        # "iex": IEXDataSource(),
-        "cnbc": CNBCDataSource(),
-        "stooq": StooqDataSource(),
-        "tiingo": TiingoDataSource(),
-        "yahoo": YahooDataSource()
+    # Module and class of each data source
+    _source_classes = {
+        "wsj": ("qf_wsj", "WSJDataSource"),
+        # "iex": ("qf_iex", "IEXDataSource"),
+        "cnbc": ("qf_cnbc", "CNBCDataSource"),
+        "stooq": ("qf_stooq", "StooqDataSource"),
+        "tiingo": ("qf_tiingo", "TiingoDataSource"),
+        "yahoo": ("qf_yahoo", "YahooDataSource")
     }
+    # Data source instances created so far
+    _sources = {}
+    _lock = threading.Lock()
 
     @classmethod
     def get_data_source(cls, data_source_name):
-        if data_source_name in cls._sources.keys():
+        if data_source_name in cls._source_classes.keys():
             logger.debug("Data source returned: %s", data_source_name)
-            return cls._sources[data_source_name]
+            data_source = cls._sources.get(data_source_name)
+            if data_source is None:
+                with cls._lock:
+                    if data_source_name not in cls._sources:
+                        module_name, class_name = cls._source_classes[data_source_name]
+                        module = importlib.import_module(module_name)
+                        cls._sources[data_source_name] = getattr(module, class_name)()
+                    data_source = cls._sources[data_source_name]
+            return data_source
         else:
             logger.error("Unrecognized data source name %s", data_source_name)
             raise ValueError("Unrecognized data source name {0}".format(data_source_name))
@@ -0,0 +1,183 @@
+# coding: utf-8
+#
+# qf_date_bulk - date-major bulk fetching of prices for many symbols
+# Copyright © 2022  Dave Hocker (email: Qalydon17@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import threading
+import time
+import datetime
+from collections import OrderedDict
+from qf_app_logger import AppLogger
+from qf_configuration import QConfiguration
+from qf_data_source_mgr import DataSourceMgr
+from qf_cache_db import CacheDB
+from qf_quota import QuotaLedger
+from qf_deadline import DeadlineExceeded
+
+# Logger init
+the_app_logger = AppLogger("qf-extension")
+logger = the_app_logger.getAppLogger()
+
+
+class DateBulkFetcher:
+    """
+    Singleton. A sheet that asks for many symbols on the same date (e.g. a month end
+    valuation) is better served by one download of the whole day than by a request
+    per symbol. The fetcher counts the symbols that miss the cache for each date.
+    Once the count reaches the bulk threshold, the day is downloaded from the first
+    data source in the category list that supports bulk downloads. The downloaded
+    day is kept in memory so every later symbol for the date comes from it.
+    """
+    # How long to wait before trying a failed download again (seconds)
+    RETRY_FAILED = 5 * 60
+
+    _lock = threading.Lock()
+    # Symbols that missed the cache, keyed by date. A date is dropped
+    # once its day has been downloaded or evicted.
+    _misses = {}
+    # Downloaded days keyed by (data source name, date), oldest first
+    _days = OrderedDict()
+    # Time of the last failed download keyed by (data source name, date)
+    _failed = {}
+    # One download lock per (data source name, date) so concurrent cells wait for one download
+    _download_locks = {}
+
+    @classmethod
+    def get_price_record(cls, ticker, category, for_date):
+        """
+        Return the price record for a symbol from a bulk download of its date
+        :param ticker: Equity ticker symbol (upper case)
+        :param category: stock, etf, mutf, index
+        :param for_date: ISO format date
+        :return: The price record as a dict or None if bulk mode does not apply
+        """
+        threshold = int(QConfiguration.qf_bulk_conf.get("threshold", 0))
+        if threshold <= 0:
+            return None
+        # Bulk files are only published for completed days
+        if for_date >= datetime.date.today().isoformat():
+            return None
+
+        dsn, bulk_symbol = cls._find_bulk_source(ticker, category)
+        if dsn is None:
+            return None
+
+        key = (dsn, for_date)
+        with cls._lock:
+            day = cls._days.get(key)
+            if day is None:
+                symbols = cls._misses.setdefault(for_date, set())
+                symbols.add(ticker)
+                if len(symbols) < threshold:
+                    return None
+                download_lock = cls._download_locks.setdefault(key, threading.Lock())
+
+        if day is None:
+            day = cls._download_day(dsn, for_date, download_lock)
+            if day is None:
+                return None
+
+        r = day.get(bulk_symbol)
+        if r is None:
+            logger.debug("%s is not in the %s bulk download for %s", ticker, dsn, for_date)
+            return None
+
+        CacheDB.insert_ohlc_price(ticker, for_date,
+                                  r["open"], r["high"], r["low"], r["close"], r.get("volume", 0),
+                                  0.0, dsn)
+        return dict(r)
+
+    @classmethod
+    def get_price_records(cls, tickers, category, for_date):
+        """
+        Batch form of get_price_record. All of the tickers count toward the
+        bulk threshold before any of them is looked up.
+        :param tickers: List of equity ticker symbols (upper case)
+        :param category: stock, etf, mutf, index
+        :param for_date: ISO format date
+        :return: dict of price records keyed by ticker. Tickers that were
+        not found in a bulk download are left out.
+        """
+        with cls._lock:
+            # Once the day is downloaded, its misses no longer need counting
+            if not any(k[1] == for_date for k in cls._days.keys()):
+                cls._misses.setdefault(for_date, set()).update(tickers)
+        records = {}
+        for ticker in tickers:
+            r = cls.get_price_record(ticker, category, for_date)
+            if r:
+                records[ticker] = r
+        return records
+
+    @classmethod
+    def _find_bulk_source(cls, ticker, category):
+        """
+        Find the first data source for the category that can download a whole day
+        :param ticker: Equity ticker symbol
+        :param category: stock, etf, mutf, index
+        :return: (data source name, bulk symbol) or (None, None)
+        """
+        for dsn in QConfiguration.get_datasources_list(category):
+            try:
+                bulk_symbol = DataSourceMgr.get_data_source(dsn).get_bulk_symbol(ticker, category)
+            except Exception as ex:
+                logger.error("Exception %s", str(ex))
+                continue
+            if bulk_symbol:
+                return dsn, bulk_symbol
+        return None, None
+
+    @classmethod
+    def _download_day(cls, dsn, for_date, download_lock):
+        """
+        Download a day unless another thread already has
+        :param dsn: Data source name
+        :param for_date: ISO format date
+        :param download_lock: Lock serializing downloads of this day
+        :return: The day as a dict keyed by bulk symbol or None if it is not available
+        """
+        key = (dsn, for_date)
+        with download_lock:
+            with cls._lock:
+                if key in cls._days:
+                    return cls._days[key]
+                if time.time() - cls._failed.get(key, 0.0) < cls.RETRY_FAILED:
+                    return None
+
+            if not QuotaLedger.acquire(dsn):
+                return None
+            try:
+                day = DataSourceMgr.get_data_source(dsn).get_historical_price_bulk(for_date)
+            except DeadlineExceeded:
+                raise
+            except Exception as ex:
+                logger.error("Bulk download from %s for %s failed: %s", dsn, for_date, str(ex))
+                day = None
+
+            with cls._lock:
+                if not day:
+                    cls._failed[key] = time.time()
+                    return None
+                cls._failed.pop(key, None)
+                cls._days[key] = day
+                cls._misses.pop(for_date, None)
+                # Keep only the most recent days
+                while len(cls._days) > int(QConfiguration.qf_bulk_conf.get("maxdays", 4)):
+                    old_key, _ = cls._days.popitem(last=False)
+                    cls._download_locks.pop(old_key, None)
+                    cls._misses.pop(old_key[1], None)
+            logger.info("Bulk download from %s for %s returned %d symbols", dsn, for_date, len(day))
+            return day
@@ -0,0 +1,90 @@
+# coding: utf-8
+#
+# qf_deadline - per cell time budget shared by all data sources
+# Copyright © 2018, 2022  Dave Hocker (email: Qalydon17@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import threading
+import time
+from contextlib import contextmanager
+
+# The deadline is kept per thread. LO Calc calls the extension on its own thread,
+# but background workers each get their own deadline.
+_local = threading.local()
+
+# The value returned to a cell when its deadline runs out
+TIMEOUT_RESULT = "Timeout"
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when the time budget for a cell has been used up
+    """
+    def __init__(self, msg=TIMEOUT_RESULT):
+        super(DeadlineExceeded, self).__init__(msg)
+
+
+@contextmanager
+def cell_deadline(seconds):
+    """
+    Establish a deadline for the current thread. If a deadline is already
+    in effect (e.g. a nested lookup), the outer deadline is kept.
+    :param seconds: Time budget in seconds. None or 0 means no deadline.
+    :return: None
+    """
+    if getattr(_local, "expires", None) is not None or not seconds:
+        yield
+        return
+
+    _local.expires = time.monotonic() + float(seconds)
+    try:
+        yield
+    finally:
+        _local.expires = None
+
+
+def remaining():
+    """
+    Return the time left before the current deadline
+    :return: Seconds remaining or None if there is no deadline in effect
+    """
+    expires = getattr(_local, "expires", None)
+    if expires is None:
+        return None
+    return expires - time.monotonic()
+
+
+def check_deadline():
+    """
+    Raise DeadlineExceeded if the current deadline has run out
+    :return: None
+    """
+    left = remaining()
+    if left is not None and left <= 0.0:
+        raise DeadlineExceeded()
+
+
+def clip_timeout(timeout):
+    """
+    Clip a socket timeout to the time remaining in the current deadline
+    :param timeout: Timeout in seconds
+    :return: The smaller of timeout and the remaining time
+    """
+    left = remaining()
+    if left is None:
+        return timeout
+    if left <= 0.0:
+        raise DeadlineExceeded()
+    return min(timeout, left)
@@ -16,11 +16,19 @@
 #
 
 from qf_app_logger import AppLogger
-from qf_extn_helper import normalize_date
+from qf_extn_helper import normalize_date, resolve_date, ttm_start_date
 from qf_cache_db import CacheDB
 from qf_data_source_mgr import DataSourceMgr
 from qf_configuration import QConfiguration
+from qf_quota import QuotaLedger
+from qf_deadline import cell_deadline, check_deadline, remaining, DeadlineExceeded, TIMEOUT_RESULT
+from qf_workers import get_executor
+from qf_metrics import Metrics
 import json
+import logging
+import datetime
+import threading
+import time
 
 # Logger init
 the_app_logger = AppLogger("qf-extension")
@@ -39,7 +47,8 @@ def _get_ttm_dividend_record(ticker, for_date):
 
     # Cache look up
     ticker = ticker.upper()
-    cr = CacheDB.lookup_ttm_dividend_by_date(ticker, for_date)
+    with Metrics.timer("cache.lookup"):
+        cr = CacheDB.lookup_ttm_dividend_by_date(ticker, for_date)
     if cr:
         logger.debug("Cache hit for %s %s", ticker, for_date)
         # Turn row into a dict
@@ -48,35 +57,200 @@ def _get_ttm_dividend_record(ticker, for_date):
             r[key.lower()] = cr[key]
         return r
 
-    # Try data sources for dividends
+    # The TTM period is the year ending on the date. If every dividend in
+    # the period is already cached, the sum is computed from the cache.
+    start_date = ttm_start_date(for_date)
+    if CacheDB.is_range_covered(ticker, start_date, for_date, events=True):
+        logger.debug("Dividend event cache hit for %s %s", ticker, for_date)
+        return _ttm_dividend_from_events(ticker, for_date, "cache")
+
+    # A current only data source answers with a recent value it cached and
+    # refreshes it in the background. That is checked before any data source
+    # is asked, so the cell never waits on a fetch.
     data_source_list = QConfiguration.get_datasources_list("dividend")
-    for dsn in data_source_list:
+    r = StaleDividends.get_stale_record(ticker, for_date, data_source_list)
+    if r:
+        return r
+
+    # Try data sources for dividends. All of the data sources
+    # share one deadline for the cell.
+    with cell_deadline(QConfiguration.get_cell_deadline()):
+        for dsn in data_source_list:
+            check_deadline()
+            # A data source at its request quota is skipped
+            if not QuotaLedger.acquire(dsn):
+                continue
+            try:
+                data_source = DataSourceMgr.get_data_source(dsn)
+                window = data_source.get_dividend_range_window(for_date)
+                if window:
+                    # Range mode, one request caches every dividend in the window
+                    with Metrics.timer("source", dsn):
+                        price_range = data_source.get_historical_price_range(ticker, "", window[0], window[1])
+                    CacheDB.insert_price_range(ticker, price_range, window[0], window[1], dsn)
+                    if "dividends" in price_range.keys():
+                        return _ttm_dividend_from_events(ticker, for_date, dsn)
+                    continue
+
+                # Get distributions for previous 12 months from given date
+                with Metrics.timer("source", dsn):
+                    r = data_source.get_dividend_data(ticker, for_date, "1y")
+                if r:
+                    # Verbose debugging. The dump is only built when it will be logged.
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(json.dumps(r))
+                    # Sum distributions
+                    dividend = 0.0
+                    for dist in r:
+                        dividend += float(dist["amount"])
+                    # Create ttm dividend dict as the result
+                    res = {}
+                    res["symbol"] = ticker
+                    res["calcdate"] = for_date
+                    res["amount"] = dividend
+                    res["source"] = dsn
+                    # Cache result
+                    CacheDB.insert_ttm_dividend(ticker, for_date, dividend, dsn)
+                    if data_source.is_current_only():
+                        CacheDB.insert_current_ttm_dividend(ticker, for_date, dividend, dsn)
+                    return res
+            except DeadlineExceeded:
+                logger.error("Deadline exceeded for %s %s using %s", ticker, for_date, dsn)
+                raise
+            except Exception as ex:
+                logger.error("Exception %s", ex)
+                logger.error(str(ex))
+        # The last data source may have run out the clock
+        check_deadline()
+
+    logger.error("No data source for dividend returned a result")
+    return None
+
+class StaleDividends:
+    """
+    Singleton. Stale-while-revalidate for data sources that only have current
+    data (e.g. CNBC). When a newer date is asked for, the latest TTM dividend
+    that data source cached is served at once if it is within the data source's
+    freshness window. A worker then fetches the current value and caches it for the date,
+    so the next recalculation picks it up. A cell never waits on the refresh.
+    """
+    # How long to wait before trying a failed refresh again (seconds)
+    RETRY_FAILED = 5 * 60
+
+    _lock = threading.Lock()
+    # Refreshes in progress keyed by (data source name, symbol, date)
+    _in_flight = set()
+    # Time of the last failed refresh keyed by (data source name, symbol, date)
+    _failed = {}
+
+    @classmethod
+    def get_stale_record(cls, ticker, for_date, data_source_list):
+        """
+        Return a recent TTM dividend cached by one of the current only data sources in a list
+        :param ticker: Equity ticker symbol (upper case)
+        :param for_date: ISO format date
+        :param data_source_list: Data source names in priority order
+        :return: TTM dividend record as a dict or None if stale serving does not apply
+        """
+        for dsn in data_source_list:
+            try:
+                data_source = DataSourceMgr.get_data_source(dsn)
+            except Exception as ex:
+                logger.error("Exception %s", ex)
+                continue
+            if not data_source.is_current_only():
+                continue
+
+            dr = CacheDB.lookup_current_ttm_dividend_on_or_before(ticker, for_date, dsn)
+            if dr is None:
+                continue
+            cached_date, cr = dr
+            age = (datetime.date.fromisoformat(for_date) - datetime.date.fromisoformat(cached_date)).days
+            if age > data_source.get_freshness_days():
+                continue
+
+            logger.debug("Serving %s TTM dividend from %s %s for %s", ticker, dsn, cached_date, for_date)
+            cls._schedule_refresh(ticker, for_date, dsn)
+            return {key.lower(): cr[key] for key in cr.keys()}
+        return None
+
+    @classmethod
+    def _schedule_refresh(cls, ticker, for_date, dsn):
+        """
+        Start a background refresh unless one is running or recently failed
+        :return: None
+        """
+        key = (dsn, ticker, for_date)
+        with cls._lock:
+            if key in cls._in_flight or time.time() - cls._failed.get(key, 0.0) < cls.RETRY_FAILED:
+                return
+            cls._in_flight.add(key)
+        get_executor().submit(cls._refresh, key)
+
+    @classmethod
+    def _refresh(cls, key):
+        """
+        Worker thread. Fetch the current TTM dividend and cache it for the date.
+        :param key: (data source name, symbol, date)
+        :return: None
+        """
+        dsn, ticker, for_date = key
+        ok = False
         try:
-            # Get distributions for previous 12 months from given date
-            r = DataSourceMgr.get_data_source(dsn).get_dividend_data(ticker, for_date, "1y")
-            if r:
-                # Verbose debugging
-                logger.debug(json.dumps(r))
-                # Sum distributions
-                dividend = 0.0
-                for dist in r:
-                    dividend += float(dist["amount"])
-                # Create ttm dividend dict as the result
-                res = {}
-                res["symbol"] = ticker
-                res["calcdate"] = for_date
-                res["amount"] = dividend
-                res["source"] = dsn
-                # Cache result
-                CacheDB.insert_ttm_dividend(ticker, for_date, dividend, dsn)
-                return res
+            if QuotaLedger.acquire(dsn):
+                with cell_deadline(QConfiguration.get_cell_deadline()):
+                    r = DataSourceMgr.get_data_source(dsn).get_dividend_data(ticker, for_date, "1y")
+                if r:
+                    dividend = sum(float(dist["amount"]) for dist in r)
+                    CacheDB.insert_ttm_dividend(ticker, for_date, dividend, dsn)
+                    CacheDB.insert_current_ttm_dividend(ticker, for_date, dividend, dsn)
+                    logger.debug("Refreshed %s TTM dividend for %s from %s", ticker, for_date, dsn)
+                    ok = True
         except Exception as ex:
-            logger.error("Exception %s", ex)
-            logger.error(str(ex))
+            logger.error("Refresh of %s TTM dividend from %s failed: %s", ticker, dsn, str(ex))
+        finally:
+            with cls._lock:
+                cls._in_flight.discard(key)
+                if ok:
+                    cls._failed.pop(key, None)
+                else:
+                    cls._failed[key] = time.time()
 
-    logger.error("No data source for dividend returned a result")
+
+def _ttm_dividend_from_events(ticker, for_date, source):
+    """
+    Sum the cached dividend events in the TTM period ending on a date
+    and cache the result
+    :param ticker: Equity ticker symbol
+    :param for_date: ISO format date
+    :param source: Where the dividend events came from
+    :return: TTM dividend record as a dict
+    """
+    dividend = 0.0
+    for ex_date, amount in CacheDB.lookup_dividend_events(ticker, ttm_start_date(for_date), for_date):
+        dividend += amount
+    res = {}
+    res["symbol"] = ticker
+    res["calcdate"] = for_date
+    res["amount"] = dividend
+    res["source"] = source
+    CacheDB.insert_ttm_dividend(ticker, for_date, dividend, source)
+    return res
+
+
+def cached_ttm_dividend(ticker, for_date):
+    """
+    Return the trailing 12 month dividend for a given date only if it is cached
+    :param ticker: ticker symbol
+    :param for_date: Either ISO format or LibreOffice date as a float
+    :return: the dividend amount or None if it is not cached
+    """
+    cr = CacheDB.lookup_ttm_dividend_by_date(ticker.upper(), normalize_date(for_date))
+    if cr:
+        return cr["Amount"]
     return None
 
+
 def ttm_dividend(ticker, for_date):
     """
     Return the trailing 12 month dividend for a given date
@@ -88,7 +262,192 @@ def ttm_dividend(ticker, for_date):
         r = _get_ttm_dividend_record(ticker, for_date)
         if r:
             return r["amount"]
+    except DeadlineExceeded:
+        return TIMEOUT_RESULT
     except Exception as ex:
         return str(ex)
 
     return "N/A"
+
+
+def _sliding_ttm_sums(events, for_dates):
+    """
+    Trailing 12 month dividend sums for many dates in one pass. Two pointers
+    walk the events: one adds events as the dates move forward, the other
+    drops events that fall out of the TTM period.
+    :param events: List of (ex-date, amount) tuples in date order
+    :param for_dates: List of ISO format dates in date order
+    :return: List of sums, one per date
+    """
+    sums = []
+    total = 0.0
+    first = 0
+    last = 0
+    for for_date in for_dates:
+        while last < len(events) and events[last][0] <= for_date:
+            total += events[last][1]
+            last += 1
+        start_date = ttm_start_date(for_date)
+        while first < last and events[first][0] < start_date:
+            total -= events[first][1]
+            first += 1
+        # Rounding noise from the subtractions
+        sums.append(round(total, 10) if first < last else 0.0)
+    return sums
+
+
+def ttm_dividends(ticker, for_dates):
+    """
+    Return the trailing 12 month dividends for many dates. The dividend history
+    covering all of the dates is fetched with one range request and each sum
+    is computed from the cached events.
+    :param ticker: ticker symbol (upper case)
+    :param for_dates: List of ISO format dates in date order
+    :return: dict keyed by date. The value is the dividend amount or an error string.
+    """
+    start_date = ttm_start_date(for_dates[0])
+    end_date = for_dates[-1]
+    # The range request and the per date lookups share one cell deadline.
+    # Inside dividend_yields, that is the deadline of the yield cell.
+    with cell_deadline(QConfiguration.get_cell_deadline()):
+        if not CacheDB.is_range_covered(ticker, start_date, end_date, events=True):
+            from qf_hist_quote import ensure_price_range
+            ensure_price_range(ticker, "", start_date, end_date, events=True, source_category="dividend")
+
+        if CacheDB.is_range_covered(ticker, start_date, end_date, events=True):
+            events = CacheDB.lookup_dividend_events(ticker, start_date, end_date)
+            return dict(zip(for_dates, _sliding_ttm_sums(events, for_dates)))
+
+        # No data source returned the history. Each date is looked up on its own
+        # on the worker pool, waiting no longer than what remains of the deadline.
+        check_deadline()
+        logger.debug("Dividend history for %s not available, looking up %d dates", ticker, len(for_dates))
+        import concurrent.futures
+        futures = {get_executor().submit(ttm_dividend, ticker, d): d for d in for_dates}
+        left = remaining()
+        done, not_done = concurrent.futures.wait(futures.keys(), timeout=max(0.0, left) if left is not None else None)
+    amounts = {futures[f]: f.result() for f in done}
+    for f in not_done:
+        amounts[futures[f]] = TIMEOUT_RESULT
+    return amounts
+
+
+def parse_date_cells(date_cells):
+    """
+    Resolve the cells of a range of dates
+    :param date_cells: A 2D sequence of cell values
+    :return: List of (ISO date, error) tuples, one per cell in row order. The date
+    is None for an empty cell or an invalid date. The error is "" or a message.
+    """
+    today = datetime.date.today()
+    cells = []
+    for row in date_cells:
+        for cell in row:
+            if cell is None or cell == "" or cell == 0.0:
+                cells.append((None, ""))
+                continue
+            try:
+                d, iso_date = resolve_date(cell)
+            except (ValueError, OverflowError):
+                cells.append((None, "Invalid date"))
+                continue
+            if d >= today:
+                cells.append((None, "Date must be in the past"))
+            else:
+                cells.append((iso_date, ""))
+    return cells
+
+
+def ttm_dividend_series(ticker, date_cells):
+    """
+    Return the trailing 12 month dividend for each date in a range
+    :param ticker: ticker symbol
+    :param date_cells: A 2D sequence of dates (the cells of a range)
+    :return: A column of values as a tuple of 1 element tuples, one per cell
+    """
+    cells = parse_date_cells(date_cells)
+    for_dates = sorted(set(d for d, error in cells if d))
+    if not for_dates:
+        return (("No dates",),)
+
+    try:
+        amounts = ttm_dividends(ticker.upper(), for_dates)
+    except DeadlineExceeded:
+        return ((TIMEOUT_RESULT,),)
+    except Exception as ex:
+        logger.error("Exception %s", ex)
+        return ((str(ex),),)
+
+    return tuple((amounts[d] if d else error,) for d, error in cells)
+
+
+def dividend_yields(ticker, for_dates):
+    """
+    Return the trailing 12 month dividend yield for many dates: the TTM dividend
+    divided by the close on or before the date. A data source that returns
+    dividends with its prices fills both from one range request.
+    :param ticker: ticker symbol (upper case)
+    :param for_dates: List of ISO format dates in date order
+    :return: dict keyed by date. The value is the yield or an error string.
+    """
+    from qf_hist_quote import closing_price_as_of
+    yields = {}
+    with cell_deadline(QConfiguration.get_cell_deadline()):
+        amounts = ttm_dividends(ticker, for_dates)
+        for for_date in for_dates:
+            # Amounts read back from the cache files are strings
+            try:
+                amount = float(amounts[for_date])
+            except (TypeError, ValueError):
+                # An error string
+                yields[for_date] = amounts[for_date]
+                continue
+            # Answered from the cache when the range request above covered the date
+            close = closing_price_as_of(ticker, "", for_date)
+            try:
+                close = float(close)
+            except (TypeError, ValueError):
+                yields[for_date] = close
+                continue
+            yields[for_date] = amount / close if close > 0.0 else "N/A"
+    return yields
+
+
+def dividend_yield(ticker, for_date):
+    """
+    Return the trailing 12 month dividend yield for a date
+    :param ticker: ticker symbol
+    :param for_date: ISO format date
+    :return: The yield as a fraction or an error string
+    """
+    for_date = normalize_date(for_date)
+    try:
+        return dividend_yields(ticker.upper(), [for_date])[for_date]
+    except DeadlineExceeded:
+        return TIMEOUT_RESULT
+    except Exception as ex:
+        logger.error("Exception %s", ex)
+        return str(ex)
+
+
+def dividend_yield_series(ticker, date_cells):
+    """
+    Return the trailing 12 month dividend yield for each date in a range
+    :param ticker: ticker symbol
+    :param date_cells: A 2D sequence of dates (the cells of a range)
+    :return: A column of values as a tuple of 1 element tuples, one per cell
+    """
+    cells = parse_date_cells(date_cells)
+    for_dates = sorted(set(d for d, error in cells if d))
+    if not for_dates:
+        return (("No dates",),)
+
+    try:
+        yields = dividend_yields(ticker.upper(), for_dates)
+    except DeadlineExceeded:
+        return ((TIMEOUT_RESULT,),)
+    except Exception as ex:
+        logger.error("Exception %s", ex)
+        return ((str(ex),),)
+
+    return tuple((yields[d] if d else error,) for d, error in cells)
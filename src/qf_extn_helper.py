@@ -22,9 +22,9 @@
 #
 
 import datetime
+import functools
 import os
-import inspect
-import xml.etree.ElementTree as etree
+import re
 # from qf_configuration import QConfiguration
 from qf_app_logger import AppLogger
 
@@ -33,11 +33,14 @@ the_app_logger = AppLogger("qf-extension")
 logger = the_app_logger.getAppLogger()
 
 
+@functools.lru_cache(maxsize=1)
 def qf_version():
     """
-    Extract version from description.xml
+    Extract version from description.xml. The file is only parsed the first time.
     :return: Version string n.n.n
     """
+    import inspect
+    import xml.etree.ElementTree as etree
     cmd_folder = os.path.realpath(os.path.abspath
                                   (os.path.split(inspect.getfile
                                                  ( inspect.currentframe() ))[0]))
@@ -56,13 +59,7 @@ def float_to_date_str(float_date):
     :param float_date: ddddd.tttttt where d is days from 1899-12-31 and .tttttt is fraction of 24 hours
     :return:
     """
-    # 25569 = number of days from 1899-12-30 to 1970-1-1
-    # 86400 = number of seconds in a day
-    # seconds = number of seconds from 1970-1-1 00:00:00
-    seconds = (int(float_date) - 25569) * 86400
-    d = datetime.datetime.utcfromtimestamp(seconds)
-    eff_date = d.strftime("%Y-%m-%d")
-    return eff_date
+    return _serial_to_iso(int(float_date))
 
 def date_str_to_float(date_str):
     """
@@ -80,6 +77,74 @@ def date_str_to_float(date_str):
     # since 1899-12-31 and .tttttt is the fractional portion of a day.
     return float_date
 
+# Strict ISO date. fromisoformat alone also accepts forms like 2022-W01-1.
+_ISO_DATE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+# LO Calc date serial numbers count days from 1899-12-30
+_SERIAL_BASE_ORDINAL = datetime.date(1899, 12, 30).toordinal()
+# ISO strings for every serial number from 1900-01-01 through 2100-12-31,
+# built on first use. Serial numbers outside the table are converted the long way.
+_SERIAL_FIRST = datetime.date(1900, 1, 1).toordinal() - _SERIAL_BASE_ORDINAL
+_SERIAL_LAST = datetime.date(2100, 12, 31).toordinal() - _SERIAL_BASE_ORDINAL
+_serial_table = None
+
+def _serial_to_iso(serial):
+    """
+    Convert an integer LO Calc date serial number to an ISO date string
+    :param serial: Days since 1899-12-30
+    :return: yyyy-mm-dd
+    """
+    global _serial_table
+    if _SERIAL_FIRST <= serial <= _SERIAL_LAST:
+        if _serial_table is None:
+            _serial_table = [datetime.date.fromordinal(n + _SERIAL_BASE_ORDINAL).isoformat()
+                             for n in range(_SERIAL_FIRST, _SERIAL_LAST + 1)]
+        return _serial_table[serial - _SERIAL_FIRST]
+    return datetime.date.fromordinal(serial + _SERIAL_BASE_ORDINAL).isoformat()
+
+@functools.lru_cache(maxsize=4096)
+def _resolve_date_string(date_str):
+    """
+    Resolve a date string. Results are memoized because a sheet tends to
+    use the same few dates over and over.
+    :param date_str: ISO format YYYY-MM-DD or US format m/d/yy
+    :return: Tuple (datetime.date, ISO string)
+    """
+    if _ISO_DATE.match(date_str):
+        try:
+            return datetime.date.fromisoformat(date_str), date_str
+        except ValueError:
+            pass
+    try:
+        d = datetime.datetime.strptime(date_str, "%Y-%m-%d").date()
+        return d, d.isoformat()
+    except ValueError:
+        pass
+    try:
+        # Try date as mm/dd/yy
+        d = datetime.datetime.strptime(date_str, "%m/%d/%y").date()
+        return d, d.isoformat()
+    except ValueError:
+        pass
+    raise ValueError("Unsupported date format type: {0} value: {1}".format(type(date_str), date_str))
+
+def resolve_date(tgtdate):
+    """
+    Resolve an LO Calc date to a date object and an ISO string. This is the one
+    place where dates coming from a sheet are parsed.
+    :param tgtdate: The date can be a float or a string. Floats are
+    in an Excel format (see float_to_date-str() above). Strings are
+    in ISO format YYYYY-MM-DD or US format m/d/yy.
+    :return: Tuple (datetime.date, ISO string). Raises ValueError if the
+    date can not be resolved, or OverflowError if a float date is far out of range.
+    """
+    if type(tgtdate) == float:
+        serial = int(tgtdate)
+        return datetime.date.fromordinal(serial + _SERIAL_BASE_ORDINAL), _serial_to_iso(serial)
+    elif type(tgtdate) == str and tgtdate != "":
+        return _resolve_date_string(tgtdate)
+    raise ValueError("Unsupported date format type: {0} value: {1}".format(type(tgtdate), tgtdate))
+
 def normalize_date(tgtdate):
     """
     Normalize an LO Calc date to an ISO formatted string
@@ -91,31 +156,93 @@ def normalize_date(tgtdate):
     if type(tgtdate) == float:
         if tgtdate == 0.0:
             return None
-        return float_to_date_str(tgtdate)
+        return _serial_to_iso(int(tgtdate))
     elif type(tgtdate) == str and tgtdate != "":
-        # Assumed to be a string in ISO format (YYYY-MM-DD).
-        try:
-            dt = datetime.datetime.strptime(tgtdate, "%Y-%m-%d")
-            return tgtdate
-        except Exception:
-            pass
-        try:
-            # Try date as mm/dd/yy
-            dt = datetime.datetime.strptime(tgtdate, "%m/%d/%y")
-            return dt.strftime("%Y-%m-%d")
-        except Exception:
-            pass
+        return _resolve_date_string(tgtdate)[1]
     elif tgtdate is None or tgtdate == "":
         return tgtdate
 
     raise ValueError("Unsupported date format type: {0} value: {1}".format(type(tgtdate), tgtdate))
 
+def add_days(iso_date, days):
+    """
+    Date arithmetic on ISO format dates
+    :param iso_date: yyyy-mm-dd
+    :param days: Number of days to add (may be negative)
+    :return: yyyy-mm-dd
+    """
+    dt = datetime.datetime.strptime(iso_date, "%Y-%m-%d") + datetime.timedelta(days=days)
+    return dt.strftime("%Y-%m-%d")
+
+
+def ttm_start_date(for_date):
+    """
+    Return the first date of the trailing 12 month (TTM) period ending on a
+    given date. The period is 365 days including both ends.
+    :param for_date: ISO format date
+    :return: ISO format date
+    """
+    return add_days(for_date, -364)
+
+def month_window(for_date, months):
+    """
+    Compute a window of whole calendar months ending with the month
+    of a given date. The window never extends beyond yesterday.
+    :param for_date: ISO format date yyyy-mm-dd
+    :param months: Number of months in the window
+    :return: Tuple (start date, end date) in ISO format. None if the date
+    is after yesterday, because there is no completed window that contains it.
+    """
+    dt = datetime.datetime.strptime(for_date, "%Y-%m-%d").date()
+    # First day of the earliest month in the window
+    month_index = (dt.year * 12 + dt.month - 1) - (months - 1)
+    start = datetime.date(month_index // 12, month_index % 12 + 1, 1)
+    # Last day of the month of the given date
+    month_index = dt.year * 12 + dt.month
+    end = datetime.date(month_index // 12, month_index % 12 + 1, 1) - datetime.timedelta(days=1)
+    yesterday = datetime.date.today() - datetime.timedelta(days=1)
+    if dt > yesterday:
+        return None
+    end = min(end, yesterday)
+    return start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")
+
+def year_window(for_date, years):
+    """
+    Compute a window of whole calendar years ending with the year
+    of a given date. The window never extends beyond yesterday.
+    :param for_date: ISO format date yyyy-mm-dd
+    :param years: Number of years in the window
+    :return: Tuple (start date, end date) in ISO format. None if the date
+    is after yesterday, because there is no completed window that contains it.
+    """
+    dt = datetime.datetime.strptime(for_date, "%Y-%m-%d").date()
+    start = datetime.date(dt.year - (years - 1), 1, 1)
+    end = datetime.date(dt.year, 12, 31)
+    yesterday = datetime.date.today() - datetime.timedelta(days=1)
+    if dt > yesterday:
+        return None
+    end = min(end, yesterday)
+    return start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")
+
+def iso_to_float_date(iso_date):
+    """
+    Convert an ISO date string to a LibreOffice date as a float
+    (the inverse of float_to_date_str).
+    :param iso_date: yyyy-mm-dd
+    :return: Days since 1899-12-30 as a float
+    """
+    d = datetime.datetime.strptime(iso_date, "%Y-%m-%d").date()
+    return float((d - datetime.date(1899, 12, 30)).days)
+
 def normalize_frequency(frequency):
     """
     Normalize frequency to account for the way LO Calc delivers empty cells
     :param frequency:
     :return:
     """
+    if frequency is None:
+        # Omitted optional argument
+        return None
     if type(frequency) == str:
         return frequency
     elif type(frequency) == float:
@@ -16,16 +16,36 @@
 #
 
 from qf_app_logger import AppLogger
-from qf_extn_helper import normalize_date
+from qf_extn_helper import normalize_date, normalize_frequency, iso_to_float_date, add_days
 from qf_cache_db import CacheDB
 from qf_data_source_mgr import DataSourceMgr
 from qf_configuration import QConfiguration
+from qf_quota import QuotaLedger
+from qf_date_bulk import DateBulkFetcher
+from qf_workers import get_executor
+from qf_deadline import cell_deadline, check_deadline, remaining, DeadlineExceeded, TIMEOUT_RESULT
+from qf_metrics import Metrics
 import json
+import logging
+import datetime
 
 # Logger init
 the_app_logger = AppLogger("qf-extension")
 logger = the_app_logger.getAppLogger()
 
+# Fields that QFPriceHistory can return
+HISTORY_FIELDS = ["date", "open", "high", "low", "close", "volume", "adj_close"]
+DEFAULT_HISTORY_FIELDS = ["date", "open", "high", "low", "close", "volume"]
+# Recognized QFPriceHistory frequencies
+HISTORY_FREQUENCIES = {
+    "d": "d", "daily": "d",
+    "w": "w", "weekly": "w",
+    "m": "m", "monthly": "m"
+}
+# Calendar days fetched before an as-of date when the cache has nothing covering it.
+# Long enough to reach back over a weekend plus a holiday or two.
+ASOF_WINDOW_DAYS = 10
+
 
 def _get_price_record(ticker, category, for_date):
     """
@@ -40,53 +60,278 @@ def _get_price_record(ticker, category, for_date):
 
     # Cache look up
     ticker = ticker.upper()
-    cr = CacheDB.lookup_closing_price_by_date(ticker, for_date)
-    if cr:
+    with Metrics.timer("cache.lookup"):
+        r = _cached_price_record(ticker, for_date)
+    if r:
         logger.debug("Cache hit for %s %s", ticker, for_date)
-        # Turn row into a dict
-        r = {}
-        for key in cr.keys():
-            r[key.lower()] = cr[key]
         return r
+    # A range fetch already covered the date and returned no row for it
+    # (e.g. a holiday). Asking again would download the same range.
+    if CacheDB.is_range_covered(ticker, for_date, for_date):
+        logger.debug("%s has no price on %s", ticker, for_date)
+        return None
 
-    # Try data sources for the category
+    # Try data sources for the category. All of the data sources
+    # share one deadline for the cell.
     data_source_list = QConfiguration.get_datasources_list(category)
-    for dsn in data_source_list:
-        try:
-            r = DataSourceMgr.get_data_source(dsn).get_historical_price_data(ticker, category, for_date)
-            if r:
-                # Verbose debugging
-                logger.debug(json.dumps(r))
-                # Cache result
-                # Not every query returns a volume (e.g. indexes do not)
-                volume = 0
-                if "volume" in r.keys():
-                    volume = r["volume"]
-                CacheDB.insert_ohlc_price(ticker, for_date,
-                                          r["open"], r["high"], r["low"], r["close"], volume,
-                                          0.0, dsn)
-                return r
-        except Exception as ex:
-            logger.error("Exception %s", ex)
-            logger.error(str(ex))
+    with cell_deadline(QConfiguration.get_cell_deadline()):
+        # Many symbols for the same date are served from one download of the day
+        with Metrics.timer("bulk"):
+            r = DateBulkFetcher.get_price_record(ticker, category, for_date)
+        if r:
+            return r
+
+        for dsn in data_source_list:
+            check_deadline()
+            # A data source at its request quota is skipped
+            if not QuotaLedger.acquire(dsn):
+                continue
+            try:
+                data_source = DataSourceMgr.get_data_source(dsn)
+                window = data_source.get_price_range_window(for_date)
+                if window:
+                    # Range mode, one request caches the whole window
+                    r = _get_range_price_record(data_source, dsn, ticker, category, for_date, window)
+                    if r:
+                        return r
+                    continue
+
+                with Metrics.timer("source", dsn):
+                    r = data_source.get_historical_price_data(ticker, category, for_date)
+                if r:
+                    # Verbose debugging. The dump is only built when it will be logged.
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(json.dumps(r))
+                    # Cache result
+                    # Not every query returns a volume (e.g. indexes do not)
+                    volume = 0
+                    if "volume" in r.keys():
+                        volume = r["volume"]
+                    CacheDB.insert_ohlc_price(ticker, for_date,
+                                              r["open"], r["high"], r["low"], r["close"], volume,
+                                              0.0, dsn)
+                    return r
+            except DeadlineExceeded:
+                logger.error("Deadline exceeded for %s %s using %s", ticker, for_date, dsn)
+                raise
+            except Exception as ex:
+                logger.error("Exception %s", ex)
+                logger.error(str(ex))
+        # The last data source may have run out the clock
+        check_deadline()
 
     logger.error("No data source for category %s returned a result", category)
     return None
 
 
-def _get_price(ticker, category, for_date, price_type):
+def _get_range_price_record(data_source, dsn, ticker, category, for_date, window):
+    """
+    Fetch a window of prices from a range mode data source, cache all of it
+    and return the record for the requested date
+    :param data_source: A data source instance
+    :param dsn: Name of the data source
+    :param ticker: Equity ticker symbol
+    :param category: stock, etf, mutf, index
+    :param for_date: ISO format date
+    :param window: (start_date, end_date) in ISO format
+    :return: The price record as a dict or None if the window did not contain the date
+    """
+    start_date, end_date = window
+    with Metrics.timer("source", dsn):
+        price_range = data_source.get_historical_price_range(ticker, category, start_date, end_date)
+    CacheDB.insert_price_range(ticker, price_range, start_date, end_date, dsn)
+
+    for r in price_range["prices"]:
+        if r["date"] == for_date:
+            return r
+
+    logger.debug("%s %s is not in the range %s to %s returned by %s", ticker, for_date, start_date, end_date, dsn)
+    return None
+
+
+def _cached_price_record(ticker, for_date):
+    """
+    Return the cached price record for a symbol/date as a dict with lower case keys
+    :param ticker: Equity ticker symbol (upper case)
+    :param for_date: ISO format date
+    :return: dict or None
+    """
+    cr = CacheDB.lookup_closing_price_by_date(ticker, for_date)
+    if cr is None:
+        return None
+    return {key.lower(): cr[key] for key in cr.keys()}
+
+
+def cached_price(ticker, for_date, price_type):
+    """
+    Return a price only if it is cached
+    :param ticker: Equity ticker symbol
+    :param for_date: Either ISO format or LibreOffice date as a float
+    :param price_type: open, close, high, low, volume
+    :return: The price or None if it is not cached
+    """
+    r = _cached_price_record(ticker.upper(), normalize_date(for_date))
+    if r:
+        return r[price_type]
+    return None
+
+
+def get_price_records(tickers, category, for_date):
+    """
+    Return the price records for many symbols on one date. The whole batch
+    goes through the cache in one pass. The misses are served by a bulk
+    download when possible and the rest are fetched concurrently.
+    :param tickers: List of equity ticker symbols
+    :param category: stock, etf, mutf, index
+    :param for_date: Either ISO format or LibreOffice date as a float
+    :return: dict keyed by upper case ticker. The value is a price record dict,
+    None if no data source returned a result, TIMEOUT_RESULT or an error message.
+    """
+    for_date = normalize_date(for_date)
+    records = {}
+    misses = []
+    for ticker in tickers:
+        ticker = ticker.upper()
+        if ticker in records:
+            continue
+        records[ticker] = _cached_price_record(ticker, for_date)
+        if records[ticker] is None and not CacheDB.is_range_covered(ticker, for_date, for_date):
+            misses.append(ticker)
+    logger.debug("Batch for %s: %d symbols, %d cache misses", for_date, len(records), len(misses))
+    if not misses:
+        return records
+
+    deadline = QConfiguration.get_cell_deadline()
+    with cell_deadline(deadline):
+        try:
+            bulk = DateBulkFetcher.get_price_records(misses, category, for_date)
+        except DeadlineExceeded:
+            bulk = {}
+        records.update(bulk)
+        misses = [t for t in misses if t not in bulk]
+        if not misses:
+            return records
+
+        # Each worker runs the normal single symbol lookup with its own deadline.
+        # The batch waits no longer than what is left of the cell deadline
+        # after the bulk download.
+        import concurrent.futures
+        executor = get_executor()
+        futures = {executor.submit(_get_price_record, t, category, for_date): t for t in misses}
+        left = remaining()
+        done, not_done = concurrent.futures.wait(futures.keys(), timeout=max(0.0, left) if left is not None else None)
+        for f in done:
+            try:
+                records[futures[f]] = f.result()
+            except DeadlineExceeded:
+                records[futures[f]] = TIMEOUT_RESULT
+            except Exception as ex:
+                records[futures[f]] = str(ex)
+        for f in not_done:
+            # The worker keeps going and caches its result for the next recalc
+            records[futures[f]] = TIMEOUT_RESULT
+    return records
+
+
+def _get_prices(tickers, category, for_date, price_type):
+    """
+    Batch form of _get_price
+    :param tickers: A 2D sequence of ticker symbols (the cells of a range)
+    :param category: stock, etf, mutf, index
+    :param for_date: Either ISO format or LibreOffice date as a float
+    :param price_type: open, close, high, low, volume
+    :return: A column of values as a tuple of 1 element tuples, one per cell
+    """
+    cells = []
+    for row in tickers:
+        for cell in row:
+            cells.append(cell.strip() if type(cell) == str else "")
+
+    try:
+        records = get_price_records([c for c in cells if c], category, for_date)
+    except Exception as ex:
+        return ((str(ex),),)
+
+    column = []
+    for c in cells:
+        if not c:
+            column.append(("",))
+            continue
+        r = records[c.upper()]
+        if type(r) == dict:
+            column.append((r[price_type],))
+        elif r is None:
+            column.append(("N/A",))
+        else:
+            column.append((r,))
+    return tuple(column)
+
+
+def closing_prices(tickers, category, for_date):
     """
+    :param tickers: A 2D sequence of ticker symbols
+    :param category: stock, etf, mutf, index
+    :param for_date: Either ISO format or LibreOffice date as a float
+    :return: A column of closing prices
+    """
+    return _get_prices(tickers, category, for_date, "close")
+
+
+def opening_prices(tickers, category, for_date):
+    """
+    :param tickers: A 2D sequence of ticker symbols
+    :param category: stock, etf, mutf, index
+    :param for_date: Either ISO format or LibreOffice date as a float
+    :return: A column of opening prices
+    """
+    return _get_prices(tickers, category, for_date, "open")
+
+
+def high_prices(tickers, category, for_date):
+    """
+    :param tickers: A 2D sequence of ticker symbols
+    :param category: stock, etf, mutf, index
+    :param for_date: Either ISO format or LibreOffice date as a float
+    :return: A column of high prices
+    """
+    return _get_prices(tickers, category, for_date, "high")
+
 
+def low_prices(tickers, category, for_date):
+    """
+    :param tickers: A 2D sequence of ticker symbols
+    :param category: stock, etf, mutf, index
+    :param for_date: Either ISO format or LibreOffice date as a float
+    :return: A column of low prices
+    """
+    return _get_prices(tickers, category, for_date, "low")
+
+
+def daily_volumes(tickers, category, for_date):
+    """
+    :param tickers: A 2D sequence of ticker symbols
+    :param category: stock, etf, mutf, index
+    :param for_date: Either ISO format or LibreOffice date as a float
+    :return: A column of day volumes
+    """
+    return _get_prices(tickers, category, for_date, "volume")
+
+
+def get_price(ticker, category, for_date, price_type):
+    """
+    Return one price (or the volume) of a symbol for a date
     :param ticker: Equity ticker symbol
     :param category: Required for WSJ. Not used with Stooq
     :param for_date: Either ISO format or LibreOffice date as a float
-    :param price_type: open, close, high, low
-    :return: The closing price for the given date
+    :param price_type: open, close, high, low, volume
+    :return: The price for the given date
     """
     try:
         r = _get_price_record(ticker, category, for_date)
         if r:
             return r[price_type]
+    except DeadlineExceeded:
+        return TIMEOUT_RESULT
     except Exception as ex:
         return str(ex)
 
@@ -101,7 +346,7 @@ def closing_price(ticker, category, for_date):
     :param for_date: Either ISO format or LibreOffice date as a float
     :return: The closing price for the given date
     """
-    return _get_price(ticker, category, for_date, "close")
+    return get_price(ticker, category, for_date, "close")
 
 
 def opening_price(ticker, category, for_date):
@@ -112,7 +357,7 @@ def opening_price(ticker, category, for_date):
     :param for_date: Either ISO format or LibreOffice date as a float
     :return: The closing price for the given date
     """
-    return _get_price(ticker, category, for_date, "open")
+    return get_price(ticker, category, for_date, "open")
 
 
 def high_price(ticker, category, for_date):
@@ -123,7 +368,7 @@ def high_price(ticker, category, for_date):
     :param for_date: Either ISO format or LibreOffice date as a float
     :return: The closing price for the given date
     """
-    return _get_price(ticker, category, for_date, "high")
+    return get_price(ticker, category, for_date, "high")
 
 
 def low_price(ticker, category, for_date):
@@ -134,7 +379,7 @@ def low_price(ticker, category, for_date):
     :param for_date: Either ISO format or LibreOffice date as a float
     :return: The closing price for the given date
     """
-    return _get_price(ticker, category, for_date, "low")
+    return get_price(ticker, category, for_date, "low")
 
 
 def daily_volume(ticker, category, for_date):
@@ -145,4 +390,269 @@ def daily_volume(ticker, category, for_date):
     :param for_date: Either ISO format or LibreOffice date as a float
     :return: The closing price for the given date
     """
-    return _get_price(ticker, category, for_date, "volume")
+    return get_price(ticker, category, for_date, "volume")
+
+
+def _get_price_record_as_of(ticker, category, for_date):
+    """
+    Return the latest price record on or before a date (e.g. the Friday close
+    for a month end that falls on a weekend). The cache answers when it has a
+    record for the date or the days after its latest record have been fetched.
+    Otherwise a small window of days ending on the date is fetched.
+    :param ticker: Equity ticker symbol
+    :param category: stock, etf, mutf, index
+    :param for_date: Either ISO format or LibreOffice date as a float
+    :return: The price record as a dict (its date key is the trading day) or None
+    """
+    for_date = normalize_date(for_date)
+    ticker = ticker.upper()
+
+    r = CacheDB.lookup_price_on_or_before(ticker, for_date)
+    if r and (r["date"] == for_date or CacheDB.is_range_covered(ticker, add_days(r["date"], 1), for_date)):
+        logger.debug("Cache hit for %s as of %s on %s", ticker, for_date, r["date"])
+        return r
+
+    window_start = add_days(for_date, -ASOF_WINDOW_DAYS)
+    with cell_deadline(QConfiguration.get_cell_deadline()):
+        if ensure_price_range(ticker, category, window_start, for_date):
+            r = CacheDB.lookup_price_on_or_before(ticker, for_date)
+            if r and r["date"] >= window_start:
+                return r
+            return None
+
+        # No range capable data source answered. Walk back over the weekdays
+        # of the window one request at a time.
+        d = datetime.date.fromisoformat(for_date)
+        for i in range(ASOF_WINDOW_DAYS + 1):
+            day = d - datetime.timedelta(days=i)
+            if day.weekday() >= 5:
+                continue
+            check_deadline()
+            r = _get_price_record(ticker, category, day.isoformat())
+            if r:
+                r = dict(r)
+                r["date"] = day.isoformat()
+                return r
+    return None
+
+
+def _get_price_as_of(ticker, category, for_date, price_type):
+    """
+    Return one field of the latest price record on or before a date
+    :param ticker: Equity ticker symbol
+    :param category: stock, etf, mutf, index
+    :param for_date: Either ISO format or LibreOffice date as a float
+    :param price_type: open, close, high, low, volume
+    :return: The price or an error string
+    """
+    try:
+        r = _get_price_record_as_of(ticker, category, for_date)
+        if r:
+            return r[price_type]
+    except DeadlineExceeded:
+        return TIMEOUT_RESULT
+    except Exception as ex:
+        return str(ex)
+
+    return "N/A"
+
+
+def closing_price_as_of(ticker, category, for_date):
+    """
+    :param ticker: Equity ticker symbol
+    :param category: stock, etf, mutf, index
+    :param for_date: Either ISO format or LibreOffice date as a float
+    :return: The closing price on or before the given date
+    """
+    return _get_price_as_of(ticker, category, for_date, "close")
+
+
+def opening_price_as_of(ticker, category, for_date):
+    """
+    :param ticker: Equity ticker symbol
+    :param category: stock, etf, mutf, index
+    :param for_date: Either ISO format or LibreOffice date as a float
+    :return: The opening price on or before the given date
+    """
+    return _get_price_as_of(ticker, category, for_date, "open")
+
+
+def high_price_as_of(ticker, category, for_date):
+    """
+    :param ticker: Equity ticker symbol
+    :param category: stock, etf, mutf, index
+    :param for_date: Either ISO format or LibreOffice date as a float
+    :return: The high price on or before the given date
+    """
+    return _get_price_as_of(ticker, category, for_date, "high")
+
+
+def low_price_as_of(ticker, category, for_date):
+    """
+    :param ticker: Equity ticker symbol
+    :param category: stock, etf, mutf, index
+    :param for_date: Either ISO format or LibreOffice date as a float
+    :return: The low price on or before the given date
+    """
+    return _get_price_as_of(ticker, category, for_date, "low")
+
+
+def daily_volume_as_of(ticker, category, for_date):
+    """
+    :param ticker: Equity ticker symbol
+    :param category: stock, etf, mutf, index
+    :param for_date: Either ISO format or LibreOffice date as a float
+    :return: The trading volume on or before the given date
+    """
+    return _get_price_as_of(ticker, category, for_date, "volume")
+
+
+def ensure_price_range(ticker, category, start_date, end_date, events=False, source_category=None):
+    """
+    Make sure every trading day in a date range is in the cache. The parts of the
+    range that have not been fetched are covered by a single range request.
+    Must be called within a cell deadline.
+    :param ticker: Equity ticker symbol (upper case)
+    :param category: stock, etf, mutf, index
+    :param start_date: ISO format date
+    :param end_date: ISO format date
+    :param events: If True, the dividends and splits of the range must be cached as well
+    :param source_category: The category whose data source list is used (e.g. dividend).
+    The default is category.
+    :return: True if the range is covered
+    """
+    gaps = CacheDB.get_uncovered_ranges(ticker, start_date, end_date, events=events)
+    if not gaps:
+        logger.debug("Cache covers %s %s to %s", ticker, start_date, end_date)
+        return True
+
+    # One request spanning all of the gaps
+    fetch_start = gaps[0][0]
+    fetch_end = gaps[-1][1]
+    if source_category is None:
+        source_category = category
+    for dsn in QConfiguration.get_datasources_list(source_category):
+        check_deadline()
+        if not QuotaLedger.acquire(dsn):
+            continue
+        try:
+            data_source = DataSourceMgr.get_data_source(dsn)
+            with Metrics.timer("source", dsn):
+                price_range = data_source.get_historical_price_range(ticker, category, fetch_start, fetch_end)
+            if not price_range["prices"]:
+                continue
+            CacheDB.insert_price_range(ticker, price_range, fetch_start, fetch_end, dsn)
+            if events and "dividends" not in price_range.keys():
+                # The prices are useful, but another data source has to supply the events
+                continue
+            return True
+        except NotImplementedError:
+            # Not a range capable data source
+            continue
+        except DeadlineExceeded:
+            logger.error("Deadline exceeded for %s %s to %s using %s", ticker, fetch_start, fetch_end, dsn)
+            raise
+        except Exception as ex:
+            logger.error("Exception %s", ex)
+            logger.error(str(ex))
+
+    logger.error("No data source for category %s returned a range for %s", category, ticker)
+    return False
+
+
+def _aggregate_prices(prices, frequency):
+    """
+    Roll daily prices up to weekly or monthly bars. Each bar is dated with its
+    last trading day.
+    :param prices: Daily price dicts in date order
+    :param frequency: d, w or m
+    :return: List of price dicts in date order
+    """
+    if frequency == "d":
+        return prices
+
+    bars = []
+    bar_key = None
+    for p in prices:
+        if frequency == "w":
+            key = datetime.date.fromisoformat(p["date"]).isocalendar()[0:2]
+        else:
+            key = p["date"][0:7]
+        if key != bar_key:
+            bar_key = key
+            bars.append(dict(p))
+            continue
+        bar = bars[-1]
+        bar["date"] = p["date"]
+        bar["high"] = max(bar["high"], p["high"])
+        bar["low"] = min(bar["low"], p["low"])
+        bar["close"] = p["close"]
+        bar["adj_close"] = p["adj_close"]
+        bar["volume"] += p["volume"]
+    return bars
+
+
+def _parse_history_fields(fields):
+    """
+    Parse the fields argument of QFPriceHistory
+    :param fields: Comma separated list of field names. Empty means the default fields.
+    :return: List of field names
+    """
+    fields = normalize_frequency(fields)
+    if not fields:
+        return DEFAULT_HISTORY_FIELDS
+    field_list = [f.strip().lower() for f in fields.split(",") if f.strip()]
+    for f in field_list:
+        if f not in HISTORY_FIELDS:
+            raise ValueError("Invalid field {0}".format(f))
+    return field_list
+
+
+def price_history(ticker, category, start_date, end_date, fields, frequency):
+    """
+    Return a block of historical prices. The first row holds the field names.
+    Dates are returned as LO Calc dates.
+    :param ticker: Equity ticker symbol
+    :param category: stock, etf, mutf, index
+    :param start_date: Either ISO format or LibreOffice date as a float
+    :param end_date: Either ISO format or LibreOffice date as a float
+    :param fields: Comma separated list of fields (see HISTORY_FIELDS)
+    :param frequency: d, w, m (or daily, weekly, monthly). Default is daily.
+    :return: Tuple of row tuples. Errors are returned as a single cell.
+    """
+    try:
+        start_date = normalize_date(start_date)
+        end_date = normalize_date(end_date)
+        if not start_date or not end_date:
+            return (("Invalid date",),)
+        field_list = _parse_history_fields(fields)
+        frequency = normalize_frequency(frequency)
+        if not frequency:
+            frequency = "d"
+        if frequency.lower() not in HISTORY_FREQUENCIES.keys():
+            return (("Invalid frequency",),)
+        frequency = HISTORY_FREQUENCIES[frequency.lower()]
+
+        # Only completed days are cached
+        yesterday = (datetime.date.today() - datetime.timedelta(days=1)).isoformat()
+        end_date = min(end_date, yesterday)
+        if start_date > end_date:
+            return (("Invalid date range",),)
+
+        ticker = ticker.upper()
+        with cell_deadline(QConfiguration.get_cell_deadline()):
+            ensure_price_range(ticker, category, start_date, end_date)
+        prices = _aggregate_prices(CacheDB.lookup_prices(ticker, start_date, end_date), frequency)
+    except DeadlineExceeded:
+        return ((TIMEOUT_RESULT,),)
+    except Exception as ex:
+        logger.error("Exception %s", ex)
+        return ((str(ex),),)
+
+    if not prices:
+        return (("N/A",),)
+
+    rows = [tuple(field_list)]
+    for p in prices:
+        rows.append(tuple(iso_to_float_date(p["date"]) if f == "date" else p[f] for f in field_list))
+    return tuple(rows)
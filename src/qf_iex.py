@@ -17,6 +17,7 @@
 #
 
 from qf_app_logger import AppLogger
+from qf_url_helpers import open_url, read_content
 from qf_data_source_base import DataSourceBase
 from qf_extn_helper import normalize_date
 from datetime import datetime, timedelta
@@ -74,8 +75,8 @@ class IEXDataSource(DataSourceBase):
         url = "https://api.iextrading.com/1.0/stock/{0}/chart/{1}".format(symbol.upper(), period)
         logger.debug("Calling %s", url)
         try:
-            with urllib.request.urlopen(url) as testfile:
-                json_data = testfile.read().decode()
+            with open_url(url, "iex") as testfile:
+                json_data = read_content(testfile, "iex")
                 res = json.loads(json_data)
                 # IEX returns a list of dicts where each dict is a day.
                 # Useful data in each dict is date, OHLC and volume
@@ -123,8 +124,8 @@ class IEXDataSource(DataSourceBase):
 
         filtered_list = []
         try:
-            with urllib.request.urlopen(url) as testfile:
-                json_data = testfile.read().decode()
+            with open_url(url, "iex") as testfile:
+                json_data = read_content(testfile, "iex")
                 # IEX returns a list of dicts where each dict is a dividend distribution.
                 res = json.loads(json_data)
 
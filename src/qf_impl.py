@@ -27,6 +27,7 @@ try:
     import inspect
     import threading
     import datetime
+    import logging
     import unohelper
     from com.qf.api.localc import XQFinance
 
@@ -39,27 +40,20 @@ try:
 
     # Local imports go here
     from qf_app_logger import AppLogger
-    import xml.etree.ElementTree as etree
-    from qf_configuration import QConfiguration
-    from qf_extn_helper import qf_version, normalize_date
+    from qf_extn_helper import qf_version, resolve_date
     # These imports were moved to the methods that use them as a form of late binding.
     # On Windows 10 they cause an obscure error if Sqlite3 is not available.
+    # They also keep the extension quick to load.
     # import qf_hist_quote
     # import qf_dividends
     # from qf_data_source_mgr import DataSourceMgr
+    # from qf_configuration import QConfiguration
 
     # Logger init
     the_app_logger = AppLogger("qf-extension")
     logger = the_app_logger.getAppLogger()
     # Log embedded Python version
     logger.info("Using Python %s", sys.version)
-    # Extract extension version from description.xml
-    _qf_version = qf_version()
-    logger.info("QF-LOCalc Version: %s", _qf_version)
-    # After logger
-    logger.debug("Dumping evnironment")
-    for key in os.environ.keys():
-        logger.debug("[%s]=%s", key, os.environ[key])
 except Exception as ex:
     # Emergency debugging to cover for the fact that LibreOffice is terrible at debugging...
     # The first choice of location for the emergency log is the environment setting
@@ -77,114 +71,480 @@ except Exception as ex:
     fh.close()
     exit(666)
 
+# Startup work that is deferred until the first function call
+_started = False
+_start_lock = threading.Lock()
+
+
+def _startup():
+    """
+    Load the configuration and log the startup information. Done once,
+    on the first function call, instead of when the extension is loaded.
+    :return: None
+    """
+    global _started
+    if _started:
+        return
+    with _start_lock:
+        if _started:
+            return
+        from qf_configuration import QConfiguration
+        from qf_metrics import Metrics
+        from qf_profiler import Profiler
+        logger.info("QF-LOCalc Version: %s", qf_version())
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Dumping evnironment")
+            for key in os.environ.keys():
+                logger.debug("[%s]=%s", key, os.environ[key])
+        Metrics.configure(QConfiguration.qf_metrics_conf)
+        Profiler.configure(QConfiguration.qf_profile_conf)
+        if Metrics.is_enabled() or Profiler.is_enabled():
+            _instrument()
+        _started = True
+
+
+def _instrument():
+    """
+    Replace each QF function with a timed and/or profiled version, and the
+    parameter validation with a timed version. Only done when metrics or
+    profiling are on, so there is no cost when they are off.
+    :return: None
+    """
+    from qf_metrics import Metrics
+    from qf_profiler import Profiler
+    methods = vars(QFImpl)
+    for name in [n for n in methods.keys() if n.startswith("QF")]:
+        method = methods[name]
+        if Metrics.is_enabled():
+            method = Metrics.timed("QFImpl." + name, method)
+        if Profiler.is_enabled():
+            method = Profiler.profiled("QFImpl." + name, method)
+        setattr(QFImpl, name, method)
+    if Metrics.is_enabled():
+        setattr(QFImpl, "_QFImpl__validate_parms",
+                Metrics.timed("validate.parms", methods["_QFImpl__validate_parms"]))
+        setattr(QFImpl, "_QFImpl__validate_range",
+                Metrics.timed("validate.range", methods["_QFImpl__validate_range"]))
+
+
 class QFImpl(unohelper.Base, XQFinance):
     """Define the main class for the QFinance LO Calc extension """
     def __init__( self, ctx ):
         self.ctx = ctx
         logger.debug("QFImpl initialized")
-        logger.debug("self: %s", str(self))
-        logger.debug("ctx: %s", str(ctx))
+        logger.debug("self: %s", self)
+        logger.debug("ctx: %s", ctx)
 
     def QFVersion(self):
-        logger.debug("QFVersion called %s", _qf_version)
-        return _qf_version
+        _startup()
+        logger.debug("QFVersion called %s", qf_version())
+        return qf_version()
 
     def QFDataSource(self, category):
+        _startup()
+        from qf_configuration import QConfiguration
         if category and category in QConfiguration.qf_data_sources.keys():
-            logger.debug("QFDataSource called for category %s: %s", category, str(QConfiguration.qf_data_sources[category]))
+            logger.debug("QFDataSource called for category %s: %s", category, QConfiguration.qf_data_sources[category])
             return str(QConfiguration.qf_data_sources[category])
 
         # The default is the data source list for stocks
-        logger.debug("QFDataSource called for default category: %s", str(QConfiguration.qf_data_sources["stock"]))
+        logger.debug("QFDataSource called for default category: %s", QConfiguration.qf_data_sources["stock"])
         return str(QConfiguration.qf_data_sources["stock"])
 
     def QFClosingPrice(self, symbol, category, fordate):
+        _startup()
         import qf_hist_quote
         valid = self.__validate_parms(symbol, category, fordate)
         if (valid[0]):
             logger.debug("QFClosingPrice called %s %s %s", symbol, category, fordate)
-            return qf_hist_quote.closing_price(symbol, category, fordate)
+            return qf_hist_quote.closing_price(symbol, category, valid[1])
         return valid[1]
 
     def QFOpeningPrice(self, symbol, category, fordate):
+        _startup()
         import qf_hist_quote
         logger.debug("QFOpeningPrice called %s %s %s", symbol, category, fordate)
         valid = self.__validate_parms(symbol, category, fordate)
         if (valid[0]):
-            return qf_hist_quote.opening_price(symbol, category, fordate)
+            return qf_hist_quote.opening_price(symbol, category, valid[1])
         return valid[1]
 
     def QFHighPrice(self, symbol, category, fordate):
+        _startup()
         import qf_hist_quote
         logger.debug("QFHighPrice called %s %s %s", symbol, category, fordate)
         valid = self.__validate_parms(symbol, category, fordate)
         if (valid[0]):
-            return qf_hist_quote.high_price(symbol, category, fordate)
+            return qf_hist_quote.high_price(symbol, category, valid[1])
         return valid[1]
 
     def QFLowPrice(self, symbol, category, fordate):
+        _startup()
         import qf_hist_quote
         logger.debug("QFLowPrice called %s %s %s", symbol, category, fordate)
         valid = self.__validate_parms(symbol, category, fordate)
         if (valid[0]):
-            return qf_hist_quote.low_price(symbol, category, fordate)
+            return qf_hist_quote.low_price(symbol, category, valid[1])
         return valid[1]
 
     def QFDayVolume(self, symbol, category, fordate):
+        _startup()
         import qf_hist_quote
         logger.debug("QFDayVolume called %s %s %s", symbol, category, fordate)
         valid = self.__validate_parms(symbol, category, fordate)
         if (valid[0]):
-            return qf_hist_quote.daily_volume(symbol, category, fordate)
+            return qf_hist_quote.daily_volume(symbol, category, valid[1])
         return valid[1]
 
     def QFTTMDividend(self, symbol, fordate):
+        _startup()
         import qf_dividends
         logger.debug("QFTTMDividend called %s %s", symbol, fordate)
         valid = self.__validate_parms(symbol, "", fordate)
         if (valid[0]):
-            return qf_dividends.ttm_dividend(symbol, fordate)
+            return qf_dividends.ttm_dividend(symbol, valid[1])
         return valid[1]
 
+    def QFClosingPriceAsOf(self, symbol, category, fordate):
+        _startup()
+        import qf_hist_quote
+        logger.debug("QFClosingPriceAsOf called %s %s %s", symbol, category, fordate)
+        valid = self.__validate_parms(symbol, category, fordate)
+        if (valid[0]):
+            return qf_hist_quote.closing_price_as_of(symbol, category, valid[1])
+        return valid[1]
+
+    def QFOpeningPriceAsOf(self, symbol, category, fordate):
+        _startup()
+        import qf_hist_quote
+        logger.debug("QFOpeningPriceAsOf called %s %s %s", symbol, category, fordate)
+        valid = self.__validate_parms(symbol, category, fordate)
+        if (valid[0]):
+            return qf_hist_quote.opening_price_as_of(symbol, category, valid[1])
+        return valid[1]
+
+    def QFHighPriceAsOf(self, symbol, category, fordate):
+        _startup()
+        import qf_hist_quote
+        logger.debug("QFHighPriceAsOf called %s %s %s", symbol, category, fordate)
+        valid = self.__validate_parms(symbol, category, fordate)
+        if (valid[0]):
+            return qf_hist_quote.high_price_as_of(symbol, category, valid[1])
+        return valid[1]
+
+    def QFLowPriceAsOf(self, symbol, category, fordate):
+        _startup()
+        import qf_hist_quote
+        logger.debug("QFLowPriceAsOf called %s %s %s", symbol, category, fordate)
+        valid = self.__validate_parms(symbol, category, fordate)
+        if (valid[0]):
+            return qf_hist_quote.low_price_as_of(symbol, category, valid[1])
+        return valid[1]
+
+    def QFDayVolumeAsOf(self, symbol, category, fordate):
+        _startup()
+        import qf_hist_quote
+        logger.debug("QFDayVolumeAsOf called %s %s %s", symbol, category, fordate)
+        valid = self.__validate_parms(symbol, category, fordate)
+        if (valid[0]):
+            return qf_hist_quote.daily_volume_as_of(symbol, category, valid[1])
+        return valid[1]
+
+    def QFTTMDividendSeries(self, symbol, dates):
+        _startup()
+        import qf_dividends
+        logger.debug("QFTTMDividendSeries called %s %s", symbol, dates)
+        if not symbol:
+            return (("Invalid ticker symbol",),)
+        return qf_dividends.ttm_dividend_series(symbol, dates)
+
+    def QFDividendYield(self, symbol, fordate):
+        _startup()
+        import qf_dividends
+        logger.debug("QFDividendYield called %s %s", symbol, fordate)
+        valid = self.__validate_parms(symbol, "", fordate)
+        if (valid[0]):
+            return qf_dividends.dividend_yield(symbol, valid[1])
+        return valid[1]
+
+    def QFDividendYieldSeries(self, symbol, dates):
+        _startup()
+        import qf_dividends
+        logger.debug("QFDividendYieldSeries called %s %s", symbol, dates)
+        if not symbol:
+            return (("Invalid ticker symbol",),)
+        return qf_dividends.dividend_yield_series(symbol, dates)
+
+    def QFClosingPriceAsync(self, symbol, category, fordate):
+        _startup()
+        logger.debug("QFClosingPriceAsync called %s %s %s", symbol, category, fordate)
+        return self.__async_price(symbol, category, fordate, "close")
+
+    def QFOpeningPriceAsync(self, symbol, category, fordate):
+        _startup()
+        logger.debug("QFOpeningPriceAsync called %s %s %s", symbol, category, fordate)
+        return self.__async_price(symbol, category, fordate, "open")
+
+    def QFHighPriceAsync(self, symbol, category, fordate):
+        _startup()
+        logger.debug("QFHighPriceAsync called %s %s %s", symbol, category, fordate)
+        return self.__async_price(symbol, category, fordate, "high")
+
+    def QFLowPriceAsync(self, symbol, category, fordate):
+        _startup()
+        logger.debug("QFLowPriceAsync called %s %s %s", symbol, category, fordate)
+        return self.__async_price(symbol, category, fordate, "low")
+
+    def QFDayVolumeAsync(self, symbol, category, fordate):
+        _startup()
+        logger.debug("QFDayVolumeAsync called %s %s %s", symbol, category, fordate)
+        return self.__async_price(symbol, category, fordate, "volume")
+
+    def QFTTMDividendAsync(self, symbol, fordate):
+        _startup()
+        import qf_dividends
+        from qf_async import AsyncResults
+        logger.debug("QFTTMDividendAsync called %s %s", symbol, fordate)
+        valid = self.__validate_parms(symbol, "", fordate)
+        if not valid[0]:
+            return AsyncResults.completed_result(valid[1])
+        iso_date = valid[1]
+        return AsyncResults.get_result(("ttmdividend", symbol.upper(), iso_date),
+                                       lambda: qf_dividends.cached_ttm_dividend(symbol, iso_date),
+                                       lambda: qf_dividends.ttm_dividend(symbol, iso_date))
+
+    def __async_price(self, symbol, category, fordate, price_type):
+        """
+        Common implementation of the async price functions
+        :param symbol: Ticker symbol
+        :param category: "", stock, etf, mutf, mutualfund or index
+        :param fordate: yyyy-mm-dd or mm/dd/yy or LOCalc float date
+        :param price_type: open, close, high, low, volume
+        :return: An XVolatileResult
+        """
+        import qf_hist_quote
+        from qf_async import AsyncResults
+        valid = self.__validate_parms(symbol, category, fordate)
+        if not valid[0]:
+            return AsyncResults.completed_result(valid[1])
+        iso_date = valid[1]
+        return AsyncResults.get_result((price_type, symbol.upper(), category.lower(), iso_date),
+                                       lambda: qf_hist_quote.cached_price(symbol, iso_date, price_type),
+                                       lambda: qf_hist_quote.get_price(symbol, category, iso_date, price_type))
+
+    def QFClosingPrices(self, symbols, category, fordate):
+        _startup()
+        import qf_hist_quote
+        logger.debug("QFClosingPrices called %s %s %s", symbols, category, fordate)
+        valid = self.__validate_category_and_date(category, fordate)
+        if (valid[0]):
+            return qf_hist_quote.closing_prices(symbols, category, valid[1])
+        return ((valid[1],),)
+
+    def QFOpeningPrices(self, symbols, category, fordate):
+        _startup()
+        import qf_hist_quote
+        logger.debug("QFOpeningPrices called %s %s %s", symbols, category, fordate)
+        valid = self.__validate_category_and_date(category, fordate)
+        if (valid[0]):
+            return qf_hist_quote.opening_prices(symbols, category, valid[1])
+        return ((valid[1],),)
+
+    def QFHighPrices(self, symbols, category, fordate):
+        _startup()
+        import qf_hist_quote
+        logger.debug("QFHighPrices called %s %s %s", symbols, category, fordate)
+        valid = self.__validate_category_and_date(category, fordate)
+        if (valid[0]):
+            return qf_hist_quote.high_prices(symbols, category, valid[1])
+        return ((valid[1],),)
+
+    def QFLowPrices(self, symbols, category, fordate):
+        _startup()
+        import qf_hist_quote
+        logger.debug("QFLowPrices called %s %s %s", symbols, category, fordate)
+        valid = self.__validate_category_and_date(category, fordate)
+        if (valid[0]):
+            return qf_hist_quote.low_prices(symbols, category, valid[1])
+        return ((valid[1],),)
+
+    def QFDayVolumes(self, symbols, category, fordate):
+        _startup()
+        import qf_hist_quote
+        logger.debug("QFDayVolumes called %s %s %s", symbols, category, fordate)
+        valid = self.__validate_category_and_date(category, fordate)
+        if (valid[0]):
+            return qf_hist_quote.daily_volumes(symbols, category, valid[1])
+        return ((valid[1],),)
+
+    def QFPrefetch(self, symbols, startdate, enddate, category):
+        _startup()
+        import qf_prefetch
+        from qf_async import AsyncResults
+        logger.debug("QFPrefetch called %s %s %s %s", symbols, startdate, enddate, category)
+        # The category is optional
+        if type(category) != str:
+            category = ""
+        valid = self.__validate_category_and_date(category, startdate)
+        if not valid[0]:
+            return AsyncResults.completed_result(valid[1])
+        start_date = valid[1]
+        try:
+            end_date = resolve_date(enddate)[1]
+        except (ValueError, OverflowError):
+            return AsyncResults.completed_result("Invalid date")
+        return qf_prefetch.prefetch(symbols, category, start_date, end_date)
+
+    def QFPriceHistory(self, symbol, category, startdate, enddate, fields, frequency):
+        _startup()
+        import qf_hist_quote
+        logger.debug("QFPriceHistory called %s %s %s %s %s %s", symbol, category, startdate, enddate, fields, frequency)
+        if not symbol:
+            return (("Invalid ticker symbol",),)
+        if category.lower() not in ["", "stock", "etf", "mutf", "mutualfund", "index"]:
+            return (("Invalid category",),)
+        return qf_hist_quote.price_history(symbol, category, startdate, enddate, fields, frequency)
+
+    def QFReturn(self, symbol, startdate, enddate, category):
+        _startup()
+        import qf_analytics
+        logger.debug("QFReturn called %s %s %s %s", symbol, startdate, enddate, category)
+        valid = self.__validate_range(symbol, category, startdate, enddate)
+        if not valid[0]:
+            return valid[1]
+        return qf_analytics.price_return(symbol, valid[1][0], valid[1][1], valid[1][2])
+
+    def QFVolatility(self, symbol, startdate, enddate, window, category):
+        _startup()
+        import qf_analytics
+        logger.debug("QFVolatility called %s %s %s %s %s", symbol, startdate, enddate, window, category)
+        valid = self.__validate_range(symbol, category, startdate, enddate)
+        if not valid[0]:
+            return ((valid[1],),)
+        return qf_analytics.volatility(symbol, valid[1][0], valid[1][1], valid[1][2], window)
+
+    def QFMovingAverage(self, symbol, startdate, enddate, window, category):
+        _startup()
+        import qf_analytics
+        logger.debug("QFMovingAverage called %s %s %s %s %s", symbol, startdate, enddate, window, category)
+        valid = self.__validate_range(symbol, category, startdate, enddate)
+        if not valid[0]:
+            return ((valid[1],),)
+        return qf_analytics.moving_average(symbol, valid[1][0], valid[1][1], valid[1][2], window)
+
+    def QFMaxDrawdown(self, symbol, startdate, enddate, window, category):
+        _startup()
+        import qf_analytics
+        logger.debug("QFMaxDrawdown called %s %s %s %s %s", symbol, startdate, enddate, window, category)
+        valid = self.__validate_range(symbol, category, startdate, enddate)
+        if not valid[0]:
+            return ((valid[1],),)
+        return qf_analytics.max_drawdown(symbol, valid[1][0], valid[1][1], valid[1][2], window)
+
+    def QFTotalReturn(self, symbol, startdate, enddate, category):
+        _startup()
+        import qf_analytics
+        logger.debug("QFTotalReturn called %s %s %s %s", symbol, startdate, enddate, category)
+        valid = self.__validate_range(symbol, category, startdate, enddate)
+        if not valid[0]:
+            return valid[1]
+        return qf_analytics.total_return(symbol, valid[1][0], valid[1][1], valid[1][2])
+
+    def QFTotalReturnSeries(self, symbol, startdate, enddate, category):
+        _startup()
+        import qf_analytics
+        logger.debug("QFTotalReturnSeries called %s %s %s %s", symbol, startdate, enddate, category)
+        valid = self.__validate_range(symbol, category, startdate, enddate)
+        if not valid[0]:
+            return ((valid[1],),)
+        return qf_analytics.total_return_series(symbol, valid[1][0], valid[1][1], valid[1][2])
+
+    def QFPortfolioValue(self, symbols, quantities, fordate, category):
+        _startup()
+        import qf_portfolio
+        logger.debug("QFPortfolioValue called %s %s %s %s", symbols, quantities, fordate, category)
+        # The category is optional
+        if type(category) != str:
+            category = ""
+        valid = self.__validate_category_and_date(category, fordate)
+        if not valid[0]:
+            return valid[1]
+        return qf_portfolio.portfolio_value(symbols, quantities, category, valid[1])
+
+    def QFRank(self, symbols, metric, startdate, enddate, category):
+        _startup()
+        import qf_portfolio
+        logger.debug("QFRank called %s %s %s %s %s", symbols, metric, startdate, enddate, category)
+        # The category is optional
+        if type(category) != str:
+            category = ""
+        valid = self.__validate_category_and_date(category, startdate)
+        if not valid[0]:
+            return ((valid[1],),)
+        try:
+            end_date = resolve_date(enddate)[1]
+        except (ValueError, OverflowError):
+            return (("Invalid date",),)
+        return qf_portfolio.rank(symbols, metric, category, valid[1], end_date)
+
     def __validate_parms(self, symbol, category, fordate):
         """
         Validate historical function parameters
         :param symbol: Not blank
         :param category: "", stock, etf, mutf, mutualfund or index
         :param fordate: yyyy-mm-dd or mm/dd/yy or LOCalc float date
-        :return: (valid, message)
+        :return: (valid, message). When valid, the message is the date in ISO format.
         """
         if not symbol:
             return (False, "Invalid ticker symbol")
+        return self.__validate_category_and_date(category, fordate)
+
+    def __validate_range(self, symbol, category, startdate, enddate):
+        """
+        Validate the parameters of functions over a date range
+        :param symbol: Not blank
+        :param category: Optional. "", stock, etf, mutf, mutualfund or index
+        :param startdate: yyyy-mm-dd or mm/dd/yy or LOCalc float date
+        :param enddate: yyyy-mm-dd or mm/dd/yy or LOCalc float date
+        :return: (valid, message). When valid, the message is (category, start date, end date)
+        with ISO format dates.
+        """
+        # The category is optional
+        if type(category) != str:
+            category = ""
+        valid = self.__validate_parms(symbol, category, startdate)
+        if not valid[0]:
+            return valid
+        try:
+            end_date = resolve_date(enddate)[1]
+        except (ValueError, OverflowError):
+            return (False, "Invalid date")
+        return (True, (category, valid[1], end_date))
+
+    def __validate_category_and_date(self, category, fordate):
+        """
+        Validate the category and date parameters of historical functions
+        :param category: "", stock, etf, mutf, mutualfund or index
+        :param fordate: yyyy-mm-dd or mm/dd/yy or LOCalc float date
+        :return: (valid, message). When valid, the message is the date in ISO format.
+        """
         if category.lower() not in ["", "stock", "etf", "mutf", "mutualfund", "index"]:
             return (False, "Invalid category")
-        if type(fordate) == float:
-            # Date is a LOCalc float date
-            normalized_dt = normalize_date(fordate)
-            dt = datetime.datetime.strptime(normalized_dt, "%Y-%m-%d")
-            d = datetime.date(dt.year, dt.month, dt.day)
-            if datetime.date.today() <= d:
-                # The date cannot be in the future
-                return (False, "Date must be in the past")
-        elif type(fordate) == str and fordate != "":
-            # Assumed to be a string in ISO format (YYYY-MM-DD).
+        if type(fordate) == float or (type(fordate) == str and fordate != ""):
             try:
-                dt = datetime.datetime.strptime(fordate, "%Y-%m-%d")
-            except Exception:
-                try:
-                    # Try date as mm/dd/yy
-                    dt = datetime.datetime.strptime(fordate, "%m/%d/%y")
-                except Exception:
-                    # Failed both date format checks
-                    return (False, "Invalid date")
-            d = datetime.date(dt.year, dt.month, dt.day)
+                d, iso_date = resolve_date(fordate)
+            except (ValueError, OverflowError):
+                return (False, "Invalid date")
+            if d.year < 1900:
+                # An empty cell is delivered as 0.0
+                return (False, "Invalid date")
             if datetime.date.today() <= d:
                 # The date cannot be in the future
                 return (False, "Date must be in the past")
         else:
             return (False, "Invalid date type or format")
         # All checks passed
-        return (True, "")
+        return (True, iso_date)
 
 #
 # Boiler plate code for adding an instance of the extension
@@ -0,0 +1,239 @@
+# coding: utf-8
+#
+# qf_metrics - latency histograms for functions, data sources and the cache
+# Copyright © 2022  Dave Hocker (email: Qalydon17@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import json
+import math
+import time
+import atexit
+import datetime
+import functools
+import threading
+from qf_app_logger import AppLogger
+from qf_home import find_home
+
+# Logger init
+the_app_logger = AppLogger("qf-extension")
+logger = the_app_logger.getAppLogger()
+
+# Name of the metrics file written to the home directory
+METRICS_FILE_NAME = "qf-metrics.json"
+
+
+class _Histogram:
+    """
+    Latency histogram with power of 2 millisecond buckets. Bucket n counts
+    the samples in [2**(n-1), 2**n) ms. Bucket 0 counts everything under 1 ms.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+        self.buckets = {}
+
+    def add(self, ms):
+        self.count += 1
+        self.total += ms
+        if self.min is None or ms < self.min:
+            self.min = ms
+        if ms > self.max:
+            self.max = ms
+        b = math.frexp(ms)[1] if ms >= 1.0 else 0
+        self.buckets[b] = self.buckets.get(b, 0) + 1
+
+    def _percentile(self, p):
+        """
+        Estimate a percentile as the upper bound of the bucket holding it
+        :param p: 0 to 100
+        :return: ms
+        """
+        target = math.ceil(self.count * p / 100.0)
+        seen = 0
+        for b in sorted(self.buckets.keys()):
+            seen += self.buckets[b]
+            if seen >= target:
+                return min(float(2 ** b), self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total_ms": round(self.total, 3),
+            "mean_ms": round(self.total / self.count, 3),
+            "min_ms": round(self.min, 3),
+            "max_ms": round(self.max, 3),
+            "p50_ms": round(self._percentile(50), 3),
+            "p95_ms": round(self._percentile(95), 3),
+            "p99_ms": round(self._percentile(99), 3),
+            "buckets": {"<{0}ms".format(2 ** b): self.buckets[b] for b in sorted(self.buckets.keys())}
+        }
+
+
+class _NullTimer:
+    """
+    The timer handed out when metrics are off. It does nothing.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+class _Timer:
+    """
+    Times a with block and records it in a histogram
+    """
+    def __init__(self, name):
+        self._name = name
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        Metrics.record(self._name, time.perf_counter() - self._start)
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+class Metrics:
+    """
+    Singleton. Collects latency histograms keyed by stage name (e.g. QFImpl.QFClosingPrice,
+    source.yahoo, cache.lookup) and periodically writes them to the metrics file.
+    The histograms are cumulative from the time LibreOffice started.
+    """
+    _lock = threading.Lock()
+    _enabled = False
+    _histograms = {}
+    _interval = 60
+    _dump_thread = None
+    _file_path = None
+
+    @classmethod
+    def configure(cls, metrics_conf):
+        """
+        Turn metrics on or off based on the metricsconf section of qf.conf
+        :param metrics_conf: The metrics configuration dict
+        :return: None
+        """
+        if not metrics_conf.get("enabled", False):
+            cls._enabled = False
+            return
+        cls._interval = max(1, int(metrics_conf.get("interval", 60)))
+        cls._file_path = os.path.join(find_home(), METRICS_FILE_NAME)
+        cls._enabled = True
+        with cls._lock:
+            if cls._dump_thread is None:
+                cls._dump_thread = threading.Thread(target=cls._dump_loop, name="qf-metrics", daemon=True)
+                cls._dump_thread.start()
+                atexit.register(cls.dump)
+        logger.info("Latency metrics are written to %s every %d sec", cls._file_path, cls._interval)
+
+    @classmethod
+    def is_enabled(cls):
+        return cls._enabled
+
+    @classmethod
+    def timer(cls, stage, key=None):
+        """
+        Return a context manager that times a stage. When metrics are off,
+        a shared do-nothing timer is returned.
+        :param stage: Stage name (e.g. source)
+        :param key: Optional qualifier (e.g. the data source name)
+        :return: A context manager
+        """
+        if not cls._enabled:
+            return _null_timer
+        return _Timer(stage if key is None else "{0}.{1}".format(stage, key))
+
+    @classmethod
+    def timed(cls, name, func):
+        """
+        Wrap a function so every call is timed
+        :param name: Histogram name
+        :param func: The function to be wrapped
+        :return: The wrapper
+        """
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                cls.record(name, time.perf_counter() - start)
+        return wrapper
+
+    @classmethod
+    def record(cls, name, seconds):
+        """
+        Add a sample to a histogram
+        :param name: Histogram name
+        :param seconds: Elapsed time in seconds
+        :return: None
+        """
+        with cls._lock:
+            h = cls._histograms.get(name)
+            if h is None:
+                h = _Histogram()
+                cls._histograms[name] = h
+            h.add(seconds * 1000.0)
+
+    @classmethod
+    def get_histograms(cls):
+        """
+        Return a snapshot of all of the histograms
+        :return: dict keyed by histogram name
+        """
+        with cls._lock:
+            return {name: h.to_dict() for name, h in sorted(cls._histograms.items())}
+
+    @classmethod
+    def dump(cls):
+        """
+        Write the histograms to the metrics file
+        :return: None
+        """
+        if cls._file_path is None:
+            return
+        metrics = {
+            "written": datetime.datetime.now().isoformat(timespec="seconds"),
+            "histograms": cls.get_histograms()
+        }
+        try:
+            temp_path = cls._file_path + ".tmp"
+            with open(temp_path, "w") as mf:
+                json.dump(metrics, mf, indent=4)
+            os.replace(temp_path, cls._file_path)
+        except Exception as ex:
+            logger.error("Unable to write metrics file %s: %s", cls._file_path, str(ex))
+
+    @classmethod
+    def _dump_loop(cls):
+        """
+        Dump thread. Writes the metrics file every interval while metrics are on.
+        :return: None
+        """
+        while True:
+            time.sleep(cls._interval)
+            if cls._enabled:
+                cls.dump()
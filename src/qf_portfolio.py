@@ -0,0 +1,139 @@
+# coding: utf-8
+#
+# qf_portfolio - cross-sectional functions over a range of symbols
+# Copyright © 2022  Dave Hocker (email: Qalydon17@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from qf_app_logger import AppLogger
+from qf_cache_db import CacheDB
+from qf_hist_quote import get_price_records
+from qf_analytics import METRICS, normalize_range, cached_close_series
+from qf_prefetch import Prefetcher
+from qf_deadline import TIMEOUT_RESULT
+
+# Logger init
+the_app_logger = AppLogger("qf-extension")
+logger = the_app_logger.getAppLogger()
+
+
+def _cells(range_values):
+    """
+    Flatten the cells of a range in row order
+    :param range_values: A 2D sequence of cell values
+    :return: List of cell values
+    """
+    return [cell for row in range_values for cell in row]
+
+
+def portfolio_value(tickers, quantities, category, for_date):
+    """
+    Sum of quantity times closing price for a range of holdings. All of the
+    symbols go through the cache in one pass and the misses are fetched together.
+    :param tickers: A 2D sequence of ticker symbols (the cells of a range)
+    :param quantities: A 2D sequence of quantities the same size as tickers
+    :param category: stock, etf, mutf, index
+    :param for_date: ISO format date
+    :return: The value or an error string
+    """
+    symbols = _cells(tickers)
+    amounts = _cells(quantities)
+    if len(symbols) != len(amounts):
+        return "Symbols and quantities do not match"
+
+    holdings = []
+    for symbol, quantity in zip(symbols, amounts):
+        if type(symbol) != str or not symbol.strip():
+            continue
+        if type(quantity) not in [float, int]:
+            return "Invalid quantity for {0}".format(symbol.strip())
+        holdings.append((symbol.strip().upper(), quantity))
+    if not holdings:
+        return "No symbols"
+
+    try:
+        records = get_price_records([h[0] for h in holdings], category, for_date)
+    except Exception as ex:
+        logger.error("Exception %s", ex)
+        return str(ex)
+
+    value = 0.0
+    for symbol, quantity in holdings:
+        r = records[symbol]
+        if type(r) != dict:
+            if r == TIMEOUT_RESULT:
+                return TIMEOUT_RESULT
+            return "N/A for {0}".format(symbol)
+        value += quantity * float(r["close"])
+    return value
+
+
+def rank(tickers, metric, category, start_date, end_date):
+    """
+    Rank a range of symbols on a statistic of their closing prices over a date
+    range. Rank 1 is the largest value and ties share a rank. The ranges missing
+    from the cache are fetched concurrently with one request per symbol.
+    :param tickers: A 2D sequence of ticker symbols (the cells of a range)
+    :param metric: return, totalreturn, volatility or maxdrawdown
+    :param category: stock, etf, mutf, index
+    :param start_date: ISO format date
+    :param end_date: ISO format date
+    :return: A column of ranks as a tuple of 1 element tuples, one per cell
+    """
+    metric = metric.strip().lower().replace(" ", "").replace("_", "") if type(metric) == str else ""
+    if metric not in METRICS:
+        return (("Invalid metric",),)
+    compute, events = METRICS[metric]
+
+    cells = [c.strip().upper() if type(c) == str else "" for c in _cells(tickers)]
+    symbols = sorted(set(c for c in cells if c))
+    if not symbols:
+        return (("No symbols",),)
+
+    try:
+        start_date, end_date = normalize_range(start_date, end_date)
+        Prefetcher.prefetch(symbols, category, start_date, end_date, events=events)
+    except Exception as ex:
+        logger.error("Exception %s", ex)
+        return ((str(ex),),)
+
+    values = {}
+    for symbol in symbols:
+        if not CacheDB.is_range_covered(symbol, start_date, end_date, events=events):
+            if Prefetcher.is_pending(symbol, category, start_date, end_date, events):
+                # Still being fetched. It is ranked on the next recalc.
+                values[symbol] = TIMEOUT_RESULT
+            else:
+                values[symbol] = "N/A"
+            continue
+        dates, closes = cached_close_series(symbol, start_date, end_date)
+        v = compute(symbol, dates, closes) if len(closes) >= 2 else None
+        values[symbol] = v if v is not None else "N/A"
+
+    ranked = sorted((v for v in values.values() if type(v) == float), reverse=True)
+    # Competition ranking: the rank of a value is 1 + the number of larger values
+    ranks = {}
+    for i, v in enumerate(ranked):
+        if v not in ranks:
+            ranks[v] = float(i + 1)
+
+    column = []
+    for c in cells:
+        if not c:
+            column.append(("",))
+        elif type(values[c]) == float:
+            column.append((ranks[values[c]],))
+        else:
+            column.append((values[c],))
+    return tuple(column)
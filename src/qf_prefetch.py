@@ -0,0 +1,221 @@
+# coding: utf-8
+#
+# qf_prefetch - warm the cache for a block of symbols and dates
+# Copyright © 2022  Dave Hocker (email: Qalydon17@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import threading
+import datetime
+import concurrent.futures
+from qf_app_logger import AppLogger
+from qf_configuration import QConfiguration
+from qf_cache_db import CacheDB
+from qf_hist_quote import ensure_price_range
+from qf_deadline import cell_deadline, remaining, DeadlineExceeded
+from qf_workers import get_executor
+
+# Logger init
+the_app_logger = AppLogger("qf-extension")
+logger = the_app_logger.getAppLogger()
+
+
+class _Progress:
+    """
+    Tracks the range requests of one prefetch. Each request reports to it
+    as it completes, and the status is passed on to a watcher (the cell).
+    """
+    def __init__(self, total, cached, futures):
+        self._lock = threading.Lock()
+        self._total = total
+        self._cached = cached
+        self._failed = 0
+        self._futures = list(futures)
+        self._pending = len(self._futures)
+        self._on_status = None
+        for future in self._futures:
+            future.add_done_callback(self._done)
+
+    def _done(self, future):
+        try:
+            ok = future.result()
+        except Exception:
+            ok = False
+        with self._lock:
+            self._pending -= 1
+            if ok:
+                self._cached += 1
+            else:
+                self._failed += 1
+            if self._on_status is not None:
+                self._on_status(self._status())
+
+    def _status(self):
+        """
+        Format the status shown in the prefetch cell. Must be called with the lock held.
+        :return: e.g. "38 of 40 cached, 2 failed"
+        """
+        status = "{0} of {1} cached".format(self._cached, self._total)
+        if self._failed:
+            status += ", {0} failed".format(self._failed)
+        if self._pending:
+            status += ", {0} pending".format(self._pending)
+        return status
+
+    def status(self):
+        with self._lock:
+            return self._status()
+
+    def watch(self, on_status):
+        """
+        Pass the current status, and every change to it, to a callable
+        :param on_status: Called with the status string
+        :return: None
+        """
+        with self._lock:
+            self._on_status = on_status
+            on_status(self._status())
+
+    def wait(self, timeout):
+        """
+        Wait for the range requests to complete
+        :param timeout: Seconds or None to wait as long as it takes
+        :return: None
+        """
+        concurrent.futures.wait(self._futures, timeout=timeout)
+
+
+class Prefetcher:
+    """
+    Singleton. Plans the missing (symbol, date) pairs of a block in one pass over
+    the cache and fills each symbol's gaps with one range request. The requests
+    run on the worker pool. A prefetch waits at most what remains of the cell
+    deadline; anything still running after that finishes in the background.
+    """
+    _lock = threading.Lock()
+    # Range requests in progress keyed by (symbol, category, start, end, events)
+    _in_flight = {}
+
+    @classmethod
+    def start(cls, tickers, category, start_date, end_date, events=False):
+        """
+        Start the range requests for every symbol with gaps in the date range
+        :param tickers: List of ticker symbols
+        :param category: stock, etf, mutf, index
+        :param start_date: ISO format date
+        :param end_date: ISO format date
+        :param events: If True, the dividends and splits of the range are fetched as well
+        :return: A _Progress or None if the date range is invalid
+        """
+        # Only completed days are cached
+        yesterday = (datetime.date.today() - datetime.timedelta(days=1)).isoformat()
+        end_date = min(end_date, yesterday)
+        if start_date > end_date:
+            return None
+
+        symbols = sorted(set(t.upper() for t in tickers))
+        # One pass over the cache to find the symbols with gaps
+        missing = [s for s in symbols if CacheDB.get_uncovered_ranges(s, start_date, end_date, events=events)]
+        logger.debug("Prefetch %s to %s: %d symbols, %d with gaps", start_date, end_date, len(symbols), len(missing))
+
+        futures = []
+        executor = get_executor()
+        with cls._lock:
+            for symbol in missing:
+                key = (symbol, category, start_date, end_date, events)
+                future = cls._in_flight.get(key)
+                if future is None:
+                    future = executor.submit(cls._fetch, key)
+                    cls._in_flight[key] = future
+                futures.append(future)
+        return _Progress(len(symbols), len(symbols) - len(missing), futures)
+
+    @classmethod
+    def prefetch(cls, tickers, category, start_date, end_date, events=False):
+        """
+        Make sure every symbol has prices for the whole date range in the cache.
+        Waits for the requests until the cell deadline runs out.
+        :param tickers: List of ticker symbols
+        :param category: stock, etf, mutf, index
+        :param start_date: ISO format date
+        :param end_date: ISO format date
+        :param events: If True, the dividends and splits of the range are fetched as well
+        :return: A status string for the cell
+        """
+        progress = cls.start(tickers, category, start_date, end_date, events=events)
+        if progress is None:
+            return "Invalid date range"
+        with cell_deadline(QConfiguration.get_cell_deadline()):
+            progress.wait(remaining())
+        return progress.status()
+
+    @classmethod
+    def _fetch(cls, key):
+        """
+        Worker thread. Fill the gaps of one symbol.
+        :param key: (symbol, category, start date, end date, events)
+        :return: True if the range is covered
+        """
+        symbol, category, start_date, end_date, events = key
+        try:
+            with cell_deadline(QConfiguration.get_cell_deadline()):
+                return ensure_price_range(symbol, category, start_date, end_date, events=events)
+        except DeadlineExceeded:
+            logger.error("Prefetch of %s timed out", symbol)
+            return False
+        except Exception as ex:
+            logger.error("Prefetch of %s failed: %s", symbol, str(ex))
+            return False
+        finally:
+            with cls._lock:
+                cls._in_flight.pop(key, None)
+
+    @classmethod
+    def is_pending(cls, symbol, category, start_date, end_date, events=False):
+        """
+        Answers the question: is a prefetch of this range still running?
+        :return: True or False
+        """
+        with cls._lock:
+            return (symbol, category, start_date, end_date, events) in cls._in_flight
+
+
+def prefetch(tickers, category, start_date, end_date):
+    """
+    Warm the cache for a block of symbols and dates. The cell does not wait
+    for the requests. It shows the status and is updated as each request completes.
+    :param tickers: A 2D sequence of ticker symbols (the cells of a range)
+    :param category: stock, etf, mutf, index
+    :param start_date: ISO format date
+    :param end_date: ISO format date
+    :return: An XVolatileResult
+    """
+    from qf_async import AsyncResults
+    symbols = []
+    for row in tickers:
+        for cell in row:
+            if type(cell) == str and cell.strip():
+                symbols.append(cell.strip())
+    if not symbols:
+        return AsyncResults.completed_result("No symbols")
+    try:
+        progress = Prefetcher.start(symbols, category, start_date, end_date)
+        if progress is None:
+            return AsyncResults.completed_result("Invalid date range")
+        result = AsyncResults.completed_result(progress.status())
+        progress.watch(result.set_value)
+        return result
+    except Exception as ex:
+        logger.error("Exception %s", ex)
+        return AsyncResults.completed_result(str(ex))
@@ -0,0 +1,53 @@
+# coding: utf-8
+#
+# qf_profile_macro - Python macro that writes the profile of QF function calls
+# Copyright © 2022  Dave Hocker (email: Qalydon17@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# The macro appears under Tools > Macros > Run Macro... > My Macros > qf-localc.oxt > qf_profile_macro
+#
+
+import sys
+import uno
+
+# The extension identifier from description.xml
+EXTENSION_ID = "com.qf.api.localc"
+
+
+def _add_extension_path():
+    """
+    Macros run in their own module space. Make the extension's
+    Python modules importable.
+    :return: None
+    """
+    ctx = XSCRIPTCONTEXT.getComponentContext()
+    pip = ctx.getByName("/singletons/com.sun.star.deployment.PackageInformationProvider")
+    ext_path = uno.fileUrlToSystemPath(pip.getPackageLocation(EXTENSION_ID))
+    if ext_path not in sys.path:
+        sys.path.append(ext_path)
+
+
+def QFWriteProfile(*args):
+    """
+    Write the profile collected so far to the log directory
+    without waiting for LibreOffice to close
+    :return: None
+    """
+    _add_extension_path()
+    from qf_profiler import Profiler
+    if Profiler.is_enabled():
+        Profiler.write()
+
+
+g_exportedScripts = (QFWriteProfile,)
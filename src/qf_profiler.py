@@ -0,0 +1,200 @@
+# coding: utf-8
+#
+# qf_profiler - profiling of QF function calls
+# Copyright © 2022  Dave Hocker (email: Qalydon17@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import time
+import atexit
+import pstats
+import cProfile
+import functools
+import threading
+from qf_app_logger import AppLogger
+from qf_home import find_home
+
+# Logger init
+the_app_logger = AppLogger("qf-extension")
+logger = the_app_logger.getAppLogger()
+
+# Environment variable that turns profiling on without editing qf.conf
+PROFILE_ENV_VAR = "QF_LOCALC_PROFILE"
+# Names of the files written to the home directory
+PSTATS_FILE_NAME = "qf-profile.pstats"
+COLLAPSED_FILE_NAME = "qf-profile.collapsed"
+
+
+def _frame_label(frame):
+    """
+    Name a stack frame for the collapsed stack file
+    :param frame: A Python frame
+    :return: module:function
+    """
+    code = frame.f_code
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return "{0}:{1}".format(module, code.co_name)
+
+
+class Profiler:
+    """
+    Singleton. When profiling is on, every QF function call is run under cProfile
+    and the results are added to one set of statistics. At the same time a sampling
+    thread records the call stack of each thread that is inside a QF function.
+    The statistics are written to qf-profile.pstats and the stack samples to
+    qf-profile.collapsed (one "frame;frame;frame count" line per stack, the input
+    format of flamegraph.pl and speedscope) when LibreOffice closes or when
+    the QFWriteProfile macro is run.
+    """
+    _lock = threading.Lock()
+    _enabled = False
+    _interval = 0.005
+    # Aggregated pstats.Stats of all profiled calls
+    _stats = None
+    # Number of profiled calls by function name
+    _calls = {}
+    # Collapsed stack sample counts keyed by stack
+    _samples = {}
+    # The function being profiled on each thread, keyed by thread id
+    _active = {}
+    # Marks a thread that is already inside a profiled call
+    _local = threading.local()
+    # Code object shared by all of the wrappers. The sampler stops walking a stack there.
+    _wrapper_code = None
+    _sampler_thread = None
+
+    @classmethod
+    def configure(cls, profile_conf):
+        """
+        Turn profiling on or off based on the profileconf section of qf.conf
+        and the QF_LOCALC_PROFILE environment variable
+        :param profile_conf: The profile configuration dict
+        :return: None
+        """
+        env = os.environ.get(PROFILE_ENV_VAR, "").strip().lower()
+        if not profile_conf.get("enabled", False) and env not in ["1", "true", "yes", "on"]:
+            cls._enabled = False
+            return
+        cls._interval = max(0.001, float(profile_conf.get("interval", 0.005)))
+        cls._enabled = True
+        with cls._lock:
+            if cls._sampler_thread is None:
+                cls._sampler_thread = threading.Thread(target=cls._sample_loop, name="qf-profiler", daemon=True)
+                cls._sampler_thread.start()
+                atexit.register(cls.write)
+        logger.info("Profiling is on. Profiles are written to %s", find_home())
+
+    @classmethod
+    def is_enabled(cls):
+        return cls._enabled
+
+    @classmethod
+    def profiled(cls, name, func):
+        """
+        Wrap a function so every call is profiled. A call made from inside
+        another profiled call is part of the outer call's profile.
+        :param name: Name of the function (e.g. QFImpl.QFClosingPrice)
+        :param func: The function to be wrapped
+        :return: The wrapper
+        """
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if getattr(cls._local, "active", False):
+                return func(*args, **kwargs)
+            cls._local.active = True
+            thread_id = threading.get_ident()
+            with cls._lock:
+                cls._active[thread_id] = name
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiler (e.g. a debugger) owns this thread
+                profile = None
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if profile is not None:
+                    profile.disable()
+                with cls._lock:
+                    del cls._active[thread_id]
+                    cls._calls[name] = cls._calls.get(name, 0) + 1
+                    if profile is not None:
+                        if cls._stats is None:
+                            cls._stats = pstats.Stats(profile)
+                        else:
+                            cls._stats.add(profile)
+                cls._local.active = False
+
+        cls._wrapper_code = wrapper.__code__
+        return wrapper
+
+    @classmethod
+    def _sample_loop(cls):
+        """
+        Sampling thread. Records the stack of every thread that is inside a QF function.
+        :return: None
+        """
+        while True:
+            time.sleep(cls._interval)
+            with cls._lock:
+                active = dict(cls._active)
+            if not active:
+                continue
+            frames = sys._current_frames()
+            stacks = []
+            for thread_id, name in active.items():
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                # Walk out to the profiling wrapper. Everything outside it is LibreOffice.
+                while frame is not None and frame.f_code is not cls._wrapper_code:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                stack.append(name)
+                stacks.append(";".join(reversed(stack)))
+            del frames
+            with cls._lock:
+                for stack in stacks:
+                    cls._samples[stack] = cls._samples.get(stack, 0) + 1
+
+    @classmethod
+    def write(cls):
+        """
+        Write the profile statistics and the collapsed stack samples to the home directory
+        :return: A list of the files written
+        """
+        home = find_home()
+        pstats_path = os.path.join(home, PSTATS_FILE_NAME)
+        collapsed_path = os.path.join(home, COLLAPSED_FILE_NAME)
+        written = []
+        calls = {}
+        try:
+            with cls._lock:
+                if cls._stats is not None:
+                    cls._stats.dump_stats(pstats_path)
+                    written.append(pstats_path)
+                samples = dict(cls._samples)
+                calls = dict(cls._calls)
+            with open(collapsed_path, "w") as cf:
+                for stack in sorted(samples.keys()):
+                    cf.write("{0} {1}\n".format(stack, samples[stack]))
+            written.append(collapsed_path)
+        except Exception as ex:
+            logger.error("Unable to write profile: %s", str(ex))
+        logger.info("Profile of %d calls written to %s", sum(calls.values()), ", ".join(written))
+        return written
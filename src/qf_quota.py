@@ -0,0 +1,235 @@
+# coding: utf-8
+#
+# qf_quota - request quota ledger for data sources with request limits
+# Copyright © 2022  Dave Hocker (email: Qalydon17@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import json
+import time
+import atexit
+import threading
+from qf_app_logger import AppLogger
+from qf_configuration import QConfiguration
+from qf_deadline import remaining
+
+# Logger init
+the_app_logger = AppLogger("qf-extension")
+logger = the_app_logger.getAppLogger()
+
+
+class QuotaLedger:
+    """
+    Singleton. Keeps a persistent record of the requests made to each data source
+    that has a quota (see quotaconf in qf.conf). The record survives restarts of
+    LibreOffice, so a quota used up in one session is respected in the next.
+    """
+    # Quota windows in seconds
+    WINDOWS = {
+        "perminute": 60,
+        "hourly": 60 * 60,
+        "daily": 24 * 60 * 60
+    }
+
+    # Ledger changes are written at most this often (seconds) and when LibreOffice closes
+    SAVE_DELAY = 5.0
+
+    _lock = threading.Lock()
+    # Request times keyed by data source name
+    _ledger = None
+    _file_path = None
+    # A save is scheduled
+    _save_timer = None
+    # Slots reserved by acquire on this thread, keyed by data source name.
+    # The next request the thread makes to the data source uses the slot.
+    _reserved = threading.local()
+
+    @classmethod
+    def _load(cls):
+        """
+        Load the ledger file. Must be called with the lock held.
+        :return: None
+        """
+        if cls._ledger is not None:
+            return
+        cls._file_path = os.path.join(QConfiguration.file_path, "quota_ledger.json")
+        try:
+            with open(cls._file_path, "r") as lf:
+                cls._ledger = json.load(lf)
+        except FileNotFoundError:
+            cls._ledger = {}
+        except Exception as ex:
+            logger.error("Unable to load quota ledger %s: %s", cls._file_path, str(ex))
+            cls._ledger = {}
+        atexit.register(cls.flush)
+
+    @classmethod
+    def _save(cls):
+        """
+        Save the ledger file. Must be called with the lock held.
+        :return: None
+        """
+        try:
+            temp_path = cls._file_path + ".tmp"
+            with open(temp_path, "w") as lf:
+                json.dump(cls._ledger, lf)
+            os.replace(temp_path, cls._file_path)
+        except Exception as ex:
+            logger.error("Unable to save quota ledger %s: %s", cls._file_path, str(ex))
+
+    @classmethod
+    def _schedule_save(cls):
+        """
+        Schedule a save of the ledger file. Requests that come in before the
+        save happens are written with it. Must be called with the lock held.
+        :return: None
+        """
+        if cls._save_timer is None:
+            cls._save_timer = threading.Timer(cls.SAVE_DELAY, cls.flush)
+            cls._save_timer.daemon = True
+            cls._save_timer.start()
+
+    @classmethod
+    def flush(cls):
+        """
+        Write any unsaved ledger changes to the ledger file
+        :return: None
+        """
+        with cls._lock:
+            if cls._save_timer is None:
+                return
+            cls._save_timer.cancel()
+            cls._save_timer = None
+            cls._save()
+
+    @classmethod
+    def _get_requests(cls, data_source_name, now):
+        """
+        Return the recent request times for a data source, dropping any that
+        are older than the longest window. Must be called with the lock held.
+        :param data_source_name:
+        :param now: Current time
+        :return: List of request times
+        """
+        cls._load()
+        oldest = now - max(cls.WINDOWS.values())
+        requests = [t for t in cls._ledger.get(data_source_name, []) if t > oldest]
+        cls._ledger[data_source_name] = requests
+        return requests
+
+    @classmethod
+    def _add_request(cls, data_source_name, now):
+        """
+        Count a request. Must be called with the lock held.
+        :param data_source_name:
+        :param now: Current time
+        :return: None
+        """
+        cls._get_requests(data_source_name, now).append(now)
+        cls._schedule_save()
+
+    @classmethod
+    def record_request(cls, data_source_name):
+        """
+        Count a request against the quota of a data source. A request that
+        uses a slot reserved by acquire was counted when the slot was reserved.
+        :param data_source_name:
+        :return: None
+        """
+        if not QConfiguration.get_quota(data_source_name):
+            # No quota, nothing to count
+            return
+        reserved = getattr(cls._reserved, "slots", {})
+        if reserved.get(data_source_name, 0) > 0:
+            reserved[data_source_name] -= 1
+            return
+        with cls._lock:
+            cls._add_request(data_source_name, time.time())
+
+    @classmethod
+    def _wait_time(cls, data_source_name, quota, now):
+        """
+        How long until a data source has room for another request.
+        Must be called with the lock held.
+        :param data_source_name:
+        :param quota: The quota of the data source
+        :param now: Current time
+        :return: Seconds to wait. 0.0 means a request can be made now.
+        """
+        reserve = int(quota.get("reserve", 0))
+        wait = 0.0
+        requests = cls._get_requests(data_source_name, now)
+        for window_name, window in cls.WINDOWS.items():
+            if window_name not in quota.keys():
+                continue
+            limit = max(int(quota[window_name]) - reserve, 0)
+            in_window = [t for t in requests if t > now - window]
+            if len(in_window) >= limit:
+                if limit == 0:
+                    return float(window)
+                # Room opens up when enough of the oldest requests age out
+                wait = max(wait, in_window[len(in_window) - limit] + window - now)
+        return wait
+
+    @classmethod
+    def wait_time(cls, data_source_name):
+        """
+        How long until a data source has room for another request
+        :param data_source_name:
+        :return: Seconds to wait. 0.0 means a request can be made now.
+        """
+        quota = QConfiguration.get_quota(data_source_name)
+        if not quota:
+            return 0.0
+        with cls._lock:
+            return cls._wait_time(data_source_name, quota, time.time())
+
+    @classmethod
+    def acquire(cls, data_source_name):
+        """
+        Decide whether a request to a data source should be made now. If the source
+        is at its quota but room opens up within the time remaining for the cell
+        (and within quotaconf maxdefer), the request is deferred until then.
+        Otherwise, the caller should move on to the next data source.
+        When the request can be made, a slot is reserved for it under the same lock
+        that checked the quota, so concurrent callers can not overrun the quota.
+        :param data_source_name:
+        :return: True if the request can be made, False to reroute
+        """
+        quota = QConfiguration.get_quota(data_source_name)
+        if not quota:
+            return True
+
+        max_defer = float(quota.get("maxdefer", 0.0))
+        left = remaining()
+        if left is not None:
+            max_defer = min(max_defer, left)
+        defer_until = time.time() + max_defer
+        while True:
+            with cls._lock:
+                now = time.time()
+                wait = cls._wait_time(data_source_name, quota, now)
+                if wait <= 0.0:
+                    cls._add_request(data_source_name, now)
+                    if not hasattr(cls._reserved, "slots"):
+                        cls._reserved.slots = {}
+                    cls._reserved.slots[data_source_name] = cls._reserved.slots.get(data_source_name, 0) + 1
+                    return True
+            if now + wait > defer_until:
+                logger.info("%s is at its quota for another %d sec", data_source_name, int(wait))
+                return False
+            # Another thread may take the slot first, so check again after the wait
+            logger.info("%s is at its quota, deferring the request %f sec", data_source_name, wait)
+            time.sleep(wait)
@@ -0,0 +1,368 @@
+# coding: utf-8
+#
+# qf_scanner - find every QF formula in a workbook and fetch its data in batches
+# Copyright © 2022  Dave Hocker (email: Qalydon17@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import re
+import datetime
+import concurrent.futures
+from qf_app_logger import AppLogger
+from qf_extn_helper import resolve_date, add_days
+from qf_workers import get_executor
+from qf_hist_quote import ASOF_WINDOW_DAYS
+from qf_dividends import parse_date_cells
+from qf_analytics import METRICS
+
+# Logger init
+the_app_logger = AppLogger("qf-extension")
+logger = the_app_logger.getAppLogger()
+
+# Where the symbol(s), category and date(s) are in the arguments of each function.
+# date: one date per call, asof: the last trading day on or before a date,
+# dividend: TTM dividend for a date, dividendseries: TTM dividends for a range of dates,
+# range: a date range. events marks a range that needs dividends and splits too
+# (for QFRank it depends on the metric argument).
+# A symbols position may hold a single symbol or a range of symbols.
+FUNCTION_ARGS = {
+    "QFCLOSINGPRICE": {"kind": "date", "symbols": 0, "category": 1, "date": 2},
+    "QFOPENINGPRICE": {"kind": "date", "symbols": 0, "category": 1, "date": 2},
+    "QFHIGHPRICE": {"kind": "date", "symbols": 0, "category": 1, "date": 2},
+    "QFLOWPRICE": {"kind": "date", "symbols": 0, "category": 1, "date": 2},
+    "QFDAYVOLUME": {"kind": "date", "symbols": 0, "category": 1, "date": 2},
+    "QFCLOSINGPRICEASYNC": {"kind": "date", "symbols": 0, "category": 1, "date": 2},
+    "QFOPENINGPRICEASYNC": {"kind": "date", "symbols": 0, "category": 1, "date": 2},
+    "QFHIGHPRICEASYNC": {"kind": "date", "symbols": 0, "category": 1, "date": 2},
+    "QFLOWPRICEASYNC": {"kind": "date", "symbols": 0, "category": 1, "date": 2},
+    "QFDAYVOLUMEASYNC": {"kind": "date", "symbols": 0, "category": 1, "date": 2},
+    "QFCLOSINGPRICES": {"kind": "date", "symbols": 0, "category": 1, "date": 2},
+    "QFOPENINGPRICES": {"kind": "date", "symbols": 0, "category": 1, "date": 2},
+    "QFHIGHPRICES": {"kind": "date", "symbols": 0, "category": 1, "date": 2},
+    "QFLOWPRICES": {"kind": "date", "symbols": 0, "category": 1, "date": 2},
+    "QFDAYVOLUMES": {"kind": "date", "symbols": 0, "category": 1, "date": 2},
+    "QFCLOSINGPRICEASOF": {"kind": "asof", "symbols": 0, "category": 1, "date": 2},
+    "QFOPENINGPRICEASOF": {"kind": "asof", "symbols": 0, "category": 1, "date": 2},
+    "QFHIGHPRICEASOF": {"kind": "asof", "symbols": 0, "category": 1, "date": 2},
+    "QFLOWPRICEASOF": {"kind": "asof", "symbols": 0, "category": 1, "date": 2},
+    "QFDAYVOLUMEASOF": {"kind": "asof", "symbols": 0, "category": 1, "date": 2},
+    "QFTTMDIVIDEND": {"kind": "dividend", "symbols": 0, "date": 1},
+    "QFTTMDIVIDENDASYNC": {"kind": "dividend", "symbols": 0, "date": 1},
+    "QFDIVIDENDYIELD": {"kind": "dividend", "symbols": 0, "date": 1},
+    "QFTTMDIVIDENDSERIES": {"kind": "dividendseries", "symbols": 0, "dates": 1},
+    "QFDIVIDENDYIELDSERIES": {"kind": "dividendseries", "symbols": 0, "dates": 1},
+    "QFPRICEHISTORY": {"kind": "range", "symbols": 0, "category": 1, "start": 2, "end": 3},
+    "QFPREFETCH": {"kind": "range", "symbols": 0, "start": 1, "end": 2, "category": 3},
+    "QFRETURN": {"kind": "range", "symbols": 0, "start": 1, "end": 2, "category": 3},
+    "QFVOLATILITY": {"kind": "range", "symbols": 0, "start": 1, "end": 2, "category": 4},
+    "QFMOVINGAVERAGE": {"kind": "range", "symbols": 0, "start": 1, "end": 2, "category": 4},
+    "QFMAXDRAWDOWN": {"kind": "range", "symbols": 0, "start": 1, "end": 2, "category": 4},
+    "QFTOTALRETURN": {"kind": "range", "symbols": 0, "start": 1, "end": 2, "category": 3, "events": True},
+    "QFTOTALRETURNSERIES": {"kind": "range", "symbols": 0, "start": 1, "end": 2, "category": 3, "events": True},
+    "QFPORTFOLIOVALUE": {"kind": "date", "symbols": 0, "date": 2, "category": 3},
+    "QFRANK": {"kind": "range", "symbols": 0, "start": 2, "end": 3, "category": 4, "metric": 1},
+}
+
+# A QF function call. Add-in functions may appear with their programmatic
+# name (e.g. com.qf.api.localc.python.QFImpl.QFClosingPrice).
+_CALL_RE = re.compile(r'(?:[\w]+\.)*(QF\w+)\s*\(', re.IGNORECASE)
+# A cell or range reference, optionally on another sheet (e.g. $Sheet1.$A$1:$A$10)
+_REF_RE = re.compile(r"^(?:(\$?'[^']+'|\$?[\w ]+)\.)?\$?[A-Za-z]{1,3}\$?\d+(?::\$?[A-Za-z]{1,3}\$?\d+)?$")
+_NUMBER_RE = re.compile(r'^[-+]?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?$')
+
+
+class ScanPlan:
+    """
+    The unique set of data needed by the QF formulas of a workbook
+    """
+    def __init__(self):
+        # Symbols by (category, date)
+        self.dates = {}
+        # (symbol, date) pairs
+        self.dividends = set()
+        # Dates by symbol for the dividend series functions
+        self.dividend_series = {}
+        # Symbols by (category, start date, end date, events)
+        self.ranges = {}
+        self.formulas = 0
+        self.skipped = 0
+
+    def add(self, kind, symbols, category, dates, events=False):
+        """
+        Add the data for one function call
+        :param kind: date, asof, dividend, dividendseries or range
+        :param symbols: List of ticker symbols
+        :param category: stock, etf, mutf, index
+        :param dates: (date,), (start date, end date) or for dividendseries
+        a list of dates in ISO format
+        :param events: For a range, True if the dividends and splits are needed too
+        :return: None
+        """
+        symbols = [s.upper() for s in symbols]
+        if kind == "date":
+            self.dates.setdefault((category, dates[0]), set()).update(symbols)
+        elif kind == "asof":
+            # The same window the as-of functions fetch on a cache miss
+            start_date = add_days(dates[0], -ASOF_WINDOW_DAYS)
+            self.ranges.setdefault((category, start_date, dates[0], False), set()).update(symbols)
+        elif kind == "dividend":
+            self.dividends.update((s, dates[0]) for s in symbols)
+        elif kind == "dividendseries":
+            for s in symbols:
+                self.dividend_series.setdefault(s, set()).update(dates)
+        else:
+            self.ranges.setdefault((category, dates[0], dates[1], events), set()).update(symbols)
+
+    def summary(self):
+        return "{0} formulas ({1} skipped): {2} date batches, {3} dividends, {4} dividend series, {5} ranges".format(
+            self.formulas, self.skipped, len(self.dates), len(self.dividends), len(self.dividend_series),
+            len(self.ranges))
+
+
+def split_calls(formula):
+    """
+    Find the QF function calls in a formula
+    :param formula: Formula text (e.g. =QFClosingPrice(A2;"stock";B1)*10)
+    :return: List of (function name in upper case, list of argument strings)
+    """
+    calls = []
+    for m in _CALL_RE.finditer(formula):
+        name = m.group(1).upper()
+        if name not in FUNCTION_ARGS:
+            continue
+        args = _split_args(formula, m.end())
+        if args is not None:
+            calls.append((name, args))
+    return calls
+
+
+def _split_args(formula, start):
+    """
+    Split the arguments of a function call at the top level separators
+    :param formula: Formula text
+    :param start: Index just past the opening parenthesis
+    :return: List of argument strings or None if the call is not closed
+    """
+    args = []
+    depth = 0
+    in_string = False
+    current = start
+    i = start
+    while i < len(formula):
+        c = formula[i]
+        if in_string:
+            if c == '"':
+                if i + 1 < len(formula) and formula[i + 1] == '"':
+                    # Escaped quote
+                    i += 1
+                else:
+                    in_string = False
+        elif c == '"':
+            in_string = True
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            if depth == 0:
+                args.append(formula[current:i].strip())
+                return args
+            depth -= 1
+        elif c in ';,' and depth == 0:
+            args.append(formula[current:i].strip())
+            current = i + 1
+        i += 1
+    return None
+
+
+def evaluate_arg(arg, resolve_ref):
+    """
+    Evaluate a simple argument: a string, a number or a cell/range reference.
+    Expressions are not evaluated.
+    :param arg: Argument text
+    :param resolve_ref: Callable that returns the values of a reference as a
+    list of rows or None if the reference can not be resolved
+    :return: A list of rows of values or None if the argument can not be evaluated
+    """
+    if arg == "":
+        return [[""]]
+    if len(arg) >= 2 and arg[0] == '"' and arg[-1] == '"':
+        return [[arg[1:-1].replace('""', '"')]]
+    if _NUMBER_RE.match(arg):
+        return [[float(arg)]]
+    if _REF_RE.match(arg):
+        return resolve_ref(arg)
+    return None
+
+
+def plan_call(plan, name, args, resolve_ref):
+    """
+    Add the data needed by one function call to a scan plan
+    :param plan: ScanPlan
+    :param name: Function name in upper case
+    :param args: List of argument strings
+    :param resolve_ref: See evaluate_arg
+    :return: True if the call was added
+    """
+    spec = FUNCTION_ARGS[name]
+
+    def value_of(position, default=None):
+        if position >= len(args):
+            return default
+        rows = evaluate_arg(args[position], resolve_ref)
+        if rows is None or not rows or not rows[0]:
+            return None
+        return rows[0][0]
+
+    rows = evaluate_arg(args[spec["symbols"]], resolve_ref) if spec["symbols"] < len(args) else None
+    if rows is None:
+        return False
+    symbols = [v.strip() for row in rows for v in row if type(v) == str and v.strip()]
+    if not symbols:
+        return False
+
+    category = ""
+    if "category" in spec:
+        category = value_of(spec["category"], "")
+        if type(category) != str:
+            # Omitted or not resolvable
+            category = ""
+
+    if "dates" in spec:
+        # A range of dates. Empty and invalid cells are left out.
+        rows = evaluate_arg(args[spec["dates"]], resolve_ref) if spec["dates"] < len(args) else None
+        if rows is None:
+            return False
+        dates = [d for d, error in parse_date_cells(rows) if d]
+        if not dates:
+            return False
+        plan.add(spec["kind"], symbols, category, dates)
+        return True
+
+    events = spec.get("events", False)
+    if "metric" in spec:
+        # The rank metric decides whether dividends are needed
+        metric = value_of(spec["metric"])
+        if type(metric) != str:
+            return False
+        metric = metric.strip().lower().replace(" ", "").replace("_", "")
+        if metric not in METRICS:
+            return False
+        events = METRICS[metric][1]
+
+    date_keys = ["date"] if "date" in spec else ["start", "end"]
+    dates = []
+    for key in date_keys:
+        value = value_of(spec[key])
+        try:
+            d, iso_date = resolve_date(value)
+        except ValueError:
+            return False
+        if key != "end" and d >= datetime.date.today():
+            return False
+        dates.append(iso_date)
+
+    plan.add(spec["kind"], symbols, category, dates, events=events)
+    return True
+
+
+def fetch_plan(plan):
+    """
+    Fetch everything in a scan plan into the cache, batched and concurrently
+    :param plan: ScanPlan
+    :return: None
+    """
+    import qf_hist_quote
+    import qf_dividends
+    import qf_prefetch
+
+    # Many symbols on one date go through the bulk fetcher and worker pool
+    for (category, for_date), symbols in plan.dates.items():
+        logger.debug("Scanner fetching %d symbols for %s %s", len(symbols), category, for_date)
+        qf_hist_quote.get_price_records(sorted(symbols), category, for_date)
+
+    for (category, start_date, end_date, events), symbols in plan.ranges.items():
+        if not events:
+            # The same range fetched with events has the prices as well
+            symbols = symbols - plan.ranges.get((category, start_date, end_date, True), set())
+            if not symbols:
+                continue
+        logger.debug("Scanner fetching %d symbols for %s %s to %s", len(symbols), category, start_date, end_date)
+        qf_prefetch.Prefetcher.prefetch(sorted(symbols), category, start_date, end_date, events=events)
+
+    if plan.dividends or plan.dividend_series:
+        executor = get_executor()
+        futures = [executor.submit(qf_dividends.ttm_dividend, s, d) for s, d in sorted(plan.dividends)]
+        # One dividend history fetch per symbol covers all of its series dates
+        futures += [executor.submit(qf_dividends.ttm_dividends, s, sorted(dates))
+                    for s, dates in sorted(plan.dividend_series.items())]
+        concurrent.futures.wait(futures)
+
+
+def _sheet_resolver(doc, sheet):
+    """
+    Build a reference resolver for formulas on a sheet
+    :param doc: The spreadsheet document
+    :param sheet: The sheet holding the formula
+    :return: Callable for evaluate_arg
+    """
+    def resolve_ref(ref):
+        try:
+            target = sheet
+            i = ref.rfind(".")
+            if i >= 0:
+                target = doc.getSheets().getByName(ref[:i].lstrip("$").strip("'"))
+                ref = ref[i + 1:]
+            return [list(row) for row in target.getCellRangeByName(ref.replace("$", "")).getDataArray()]
+        except Exception as ex:
+            logger.debug("Unable to resolve %s: %s", ref, str(ex))
+            return None
+    return resolve_ref
+
+
+def scan_document(doc):
+    """
+    Walk every sheet of a spreadsheet document and plan the data needed by its QF formulas
+    :param doc: The spreadsheet document (UNO)
+    :return: ScanPlan
+    """
+    import uno
+    formula_flag = uno.getConstantByName("com.sun.star.sheet.CellFlags.FORMULA")
+
+    plan = ScanPlan()
+    sheets = doc.getSheets()
+    for index in range(sheets.getCount()):
+        sheet = sheets.getByIndex(index)
+        resolve_ref = _sheet_resolver(doc, sheet)
+        cells = sheet.queryContentCells(formula_flag).getCells().createEnumeration()
+        while cells.hasMoreElements():
+            formula = cells.nextElement().getFormula()
+            if "QF" not in formula.upper():
+                continue
+            for name, args in split_calls(formula):
+                plan.formulas += 1
+                if not plan_call(plan, name, args, resolve_ref):
+                    plan.skipped += 1
+    return plan
+
+
+def scan_and_recalculate(doc):
+    """
+    Fetch the data for every QF formula in a document and then recalculate it once
+    :param doc: The spreadsheet document (UNO)
+    :return: A summary of the scan
+    """
+    plan = scan_document(doc)
+    logger.info("Workbook scan: %s", plan.summary())
+    fetch_plan(plan)
+    doc.calculateAll()
+    return plan.summary()
@@ -0,0 +1,52 @@
+# coding: utf-8
+#
+# qf_scanner_macro - Python macro that batch-resolves all QF formulas of a workbook
+# Copyright © 2022  Dave Hocker (email: Qalydon17@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# The macro appears under Tools > Macros > Run Macro... > My Macros > qf-localc.oxt > qf_scanner_macro
+#
+
+import sys
+import uno
+
+# The extension identifier from description.xml
+EXTENSION_ID = "com.qf.api.localc"
+
+
+def _add_extension_path():
+    """
+    Macros run in their own module space. Make the extension's
+    Python modules importable.
+    :return: None
+    """
+    ctx = XSCRIPTCONTEXT.getComponentContext()
+    pip = ctx.getByName("/singletons/com.sun.star.deployment.PackageInformationProvider")
+    ext_path = uno.fileUrlToSystemPath(pip.getPackageLocation(EXTENSION_ID))
+    if ext_path not in sys.path:
+        sys.path.append(ext_path)
+
+
+def QFScanAndRecalculate(*args):
+    """
+    Fetch the data for every QF formula in the current workbook,
+    then recalculate the workbook once
+    :return: None
+    """
+    _add_extension_path()
+    import qf_scanner
+    qf_scanner.scan_and_recalculate(XSCRIPTCONTEXT.getDocument())
+
+
+g_exportedScripts = (QFScanAndRecalculate,)
@@ -18,7 +18,10 @@
 
 import urllib.request
 import datetime
+import io
+import zipfile
 from qf_app_logger import AppLogger
+from qf_url_helpers import open_url, read_content, iter_content
 from qf_data_source_base import DataSourceBase
 from qf_configuration import QConfiguration
 
@@ -33,6 +36,28 @@ index_map = {
     "nasdaq": "^ndq"
 }
 
+# Daily bulk file, every symbol for one date. {0} is the date as YYYYMMDD.
+# Can be overridden with bulkurl in stooqconf.
+BULK_URL = "https://stooq.com/db/d/?d={0}&t=d"
+
+
+def _stooq_symbol(ticker):
+    """
+    Map a ticker symbol to the symbol Stooq uses
+    :param ticker: ^dji, ^spx, ^ndq for common indices. Otherwise, a stock symbol.
+    :return: Stooq symbol in lower case
+    """
+    ticker = ticker.lower()
+    if ticker in index_map.keys():
+        return index_map[ticker]
+    # By observation all US tickers end with .us
+    # Here we use the configured postfix
+    # if the ticker does not already have the postfix
+    if not ticker.endswith(QConfiguration.qf_stooq_conf["tickerpostfix"]):
+        ticker += QConfiguration.qf_stooq_conf["tickerpostfix"]
+    return ticker
+
+
 class StooqDataSource(DataSourceBase):
     def __init__(self):
         super(StooqDataSource, self).__init__()
@@ -47,23 +72,14 @@ class StooqDataSource(DataSourceBase):
         :return: OHLC with date in JSON format
         """
         # Remap symbol if necessary
-        ticker = ticker.lower()
-        if ticker in index_map.keys():
-            ticker = index_map[ticker]
-        else:
-            # By observation all US tickers end with .us
-            # Here we use the configured postfix
-            # if the ticker does not already have the postfix
-            if not ticker.endswith(QConfiguration.qf_stooq_conf["tickerpostfix"]):
-                ticker += QConfiguration.qf_stooq_conf["tickerpostfix"]
-            # ticker += ".us"
+        ticker = _stooq_symbol(ticker)
 
         # As of 2018-12-06 this URL consistently returns "No data" as if the request is black-listed
         url = 'https://stooq.com/q/d/l/?s={0}&d1={1}&d2={1}&i=d'.format(ticker, for_date.replace('-', ''))
         logger.debug("Calling %s", url)
         try:
-            with urllib.request.urlopen(url) as testfile:
-                csv_data = testfile.read().decode()
+            with open_url(url, "stooq") as testfile:
+                csv_data = read_content(testfile, "stooq")
                 # This code depends on the first line of the result being the column names
                 # and the second line being the data for the date. All lines after the second
                 # line are ignored.
@@ -101,6 +117,122 @@ class StooqDataSource(DataSourceBase):
 
         return d
 
+    def get_historical_price_range(self, ticker, category, start_date, end_date):
+        """
+        Get historical price data for every trading day in a date range.
+        Stooq does not return dividends or splits.
+        :param ticker: ^dji, ^spx, ^ndq for common indices. Otherwise, a stock symbol.
+        :param category: Not used by Stooq
+        :param start_date: yyyy-mm-dd ISO format
+        :param end_date: yyyy-mm-dd ISO format
+        :return: dict with prices list (see DataSourceBase.get_historical_price_range)
+        """
+        url = 'https://stooq.com/q/d/l/?s={0}&d1={1}&d2={2}&i=d'.format(_stooq_symbol(ticker),
+                                                                        start_date.replace('-', ''),
+                                                                        end_date.replace('-', ''))
+        logger.debug("Calling %s", url)
+        with open_url(url, "stooq") as response:
+            csv_data = read_content(response, "stooq")
+
+        # Date,Open,High,Low,Close,Volume
+        # 2018-12-06,199.61,203.08,198.19,202.68,2991766
+        lines = [line for line in csv_data.splitlines() if line]
+        if len(lines) < 2:
+            logger.error("%s did not return a response", url)
+            return {"prices": []}
+        columns = [c.lower().strip() for c in lines[0].split(',')]
+        if "date" not in columns or "close" not in columns:
+            # e.g. "No data"
+            logger.error("%s returned %s", url, lines[0])
+            return {"prices": []}
+
+        prices = []
+        for line in lines[1:]:
+            fields = line.split(',')
+            r = {}
+            try:
+                for i in range(len(columns)):
+                    if columns[i] == "date":
+                        r["date"] = fields[i]
+                    else:
+                        r[columns[i]] = float(fields[i])
+            except (ValueError, IndexError):
+                continue
+            prices.append(r)
+        return {"prices": prices}
+
+    def get_bulk_symbol(self, ticker, category):
+        """
+        Stooq publishes a daily file with every symbol it carries.
+        Mutual funds are not in it.
+        :param ticker: ^dji, ^spx, ^ndq for common indices. Otherwise, a stock symbol.
+        :param category: stock, etf, mutf or mutualfund, index
+        :return: The upper case Stooq symbol or None
+        """
+        if category.lower() in ["mutf", "mutualfund"]:
+            return None
+        return _stooq_symbol(ticker).upper()
+
+    def get_historical_price_bulk(self, for_date):
+        """
+        Download the daily file for a date. Only US symbols (those with the
+        configured ticker postfix) and indexes are kept.
+        :param for_date: yyyy-mm-dd ISO format
+        :return: A dict keyed by upper case Stooq symbol
+        """
+        url = QConfiguration.qf_stooq_conf.get("bulkurl", BULK_URL).format(for_date.replace('-', ''))
+        logger.debug("Calling %s", url)
+        with open_url(url, "stooq") as response:
+            content = b"".join(iter_content(response, "stooq"))
+
+        # The file may come zipped
+        if content[0:2] == b"PK":
+            with zipfile.ZipFile(io.BytesIO(content)) as zf:
+                content = zf.read(zf.namelist()[0])
+
+        # Data looks like this:
+        # <TICKER>,<PER>,<DATE>,<TIME>,<OPEN>,<HIGH>,<LOW>,<CLOSE>,<VOL>,<OPENINT>
+        # AAPL.US,D,20221130,000000,141.4,148.72,140.55,148.03,111380900,0
+        lines = content.decode("utf-8", errors="replace").splitlines()
+        if len(lines) < 2:
+            logger.error("%s did not return a response", url)
+            return {}
+
+        columns = [c.strip().strip("<>").lower() for c in lines[0].split(",")]
+        try:
+            ticker_col = columns.index("ticker")
+            date_col = columns.index("date")
+        except ValueError:
+            logger.error("%s returned an unrecognized file: %s", url, lines[0])
+            return {}
+        postfix = QConfiguration.qf_stooq_conf["tickerpostfix"].upper()
+        price_cols = [("open", "open"), ("high", "high"), ("low", "low"), ("close", "close"), ("vol", "volume")]
+        price_cols = [(columns.index(c), k) for c, k in price_cols if c in columns]
+
+        day = {}
+        for line in lines[1:]:
+            fields = line.split(",")
+            if len(fields) < len(columns):
+                continue
+            symbol = fields[ticker_col].strip().upper()
+            if not (symbol.endswith(postfix) or symbol.startswith("^")):
+                continue
+            d = fields[date_col].strip()
+            d = "{0}-{1}-{2}".format(d[0:4], d[4:6], d[6:8])
+            if d != for_date:
+                continue
+            r = {"date": d}
+            try:
+                for i, key in price_cols:
+                    r[key] = float(fields[i])
+            except ValueError:
+                continue
+            day[symbol] = r
+
+        logger.debug("%s returned %d symbols for %s", url, len(day), for_date)
+        return day
+
+
 if __name__ == '__main__':
     # ticker = '^dji'
     for_date = '2018-11-30'
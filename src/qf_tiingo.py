@@ -17,10 +17,11 @@
 #
 
 from qf_app_logger import AppLogger
+from qf_url_helpers import open_url, read_content
 from qf_data_source_base import DataSourceBase
 from qf_configuration import QConfiguration
 from qf_tiingo_support import api_key
-from datetime import datetime
+from qf_extn_helper import year_window, ttm_start_date
 import urllib.request
 import json
 
@@ -30,22 +31,18 @@ logger = the_app_logger.getAppLogger()
 
 
 class TiingoDataSource(DataSourceBase):
+    # Range mode default. One request covers a calendar year.
+    _default_range_mode = True
+
     def __init__(self):
         super(TiingoDataSource, self).__init__()
 
-    def get_historical_price_data(self, symbol, category, for_date):
+    @staticmethod
+    def _get_api_token():
         """
-        Call Tiingo API to get the price data for a given symbol on
-        a given date.
-        :param symbol: ticker symbol
-        :param category: Not used. Tiingo only works for stocks, etfs and mutfs.
-        Index is not supported.
-        :param for_date
-        :return:
+        Return the configured API token. If there isn't one, ask for it.
+        :return: The API token
         """
-        if category not in ["", "stock", "etf", "mutf"]:
-            raise ValueError("Tiingo only supports categories stock, etf and mutf")
-
         try:
             apitoken = QConfiguration.qf_tiingo_conf["apitoken"]
         except Exception as ex:
@@ -62,27 +59,122 @@ class TiingoDataSource(DataSourceBase):
                 apitoken = res[1]
             else:
                 raise ValueError("Tiingo requires an API token")
+        return apitoken
+
+    def _get_prices(self, symbol, start_date, end_date):
+        """
+        Call the Tiingo prices end point for a range of dates
+        :param symbol: ticker symbol
+        :param start_date: yyyy-mm-dd
+        :param end_date: yyyy-mm-dd
+        :return: The list of daily rows returned by Tiingo
+        """
+        apitoken = TiingoDataSource._get_api_token()
 
         url = "https://api.tiingo.com/tiingo/daily/{0}/prices?startDate={1}&endDate={2}&token={3}"
-        url = url.format(symbol.upper(), for_date, for_date, apitoken)
+        url = url.format(symbol.upper(), start_date, end_date, apitoken)
 
         # Log URL without API token
         masked_url = "https://api.tiingo.com/tiingo/daily/{0}/prices?startDate={1}&endDate={2}&token={3}"
-        masked_url = masked_url.format(symbol.upper(), for_date, for_date, "*" * len(apitoken))
+        masked_url = masked_url.format(symbol.upper(), start_date, end_date, "*" * len(apitoken))
         logger.debug("Calling %s", masked_url)
 
+        with open_url(url, "tiingo") as testfile:
+            json_data = read_content(testfile, "tiingo")
+            # Tiingo returns a JSON response that is a list.
+            return json.loads(json_data)
+
+    def get_historical_price_data(self, symbol, category, for_date):
+        """
+        Call Tiingo API to get the price data for a given symbol on
+        a given date.
+        :param symbol: ticker symbol
+        :param category: Not used. Tiingo only works for stocks, etfs and mutfs.
+        Index is not supported.
+        :param for_date
+        :return:
+        """
+        if category not in ["", "stock", "etf", "mutf"]:
+            raise ValueError("Tiingo only supports categories stock, etf and mutf")
+
         try:
-            with urllib.request.urlopen(url) as testfile:
-                json_data = testfile.read().decode()
-                res = json.loads(json_data)
-                # Tiingo returns a JSON response that is a list.
-                return res[0]
+            res = self._get_prices(symbol, for_date, for_date)
+            return res[0]
         except Exception as ex:
             logger.error(str(ex))
 
         logger.error("Data for {0} on date {1} was not found".format(symbol.upper(), for_date))
         return {}
 
+    def get_price_range_window(self, for_date):
+        """
+        Range mode. A single request covers the calendar year of the date.
+        :param for_date: yyyy-mm-dd ISO format
+        :return: (start_date, end_date) or None if range mode is off
+        """
+        if not QConfiguration.qf_tiingo_conf.get("rangemode", TiingoDataSource._default_range_mode):
+            return None
+        return year_window(for_date, 1)
+
+    def get_dividend_range_window(self, for_date):
+        """
+        Range mode for dividends. The TTM period for a date can reach
+        back into the previous calendar year, so both years are requested.
+        :param for_date: yyyy-mm-dd ISO format
+        :return: (start_date, end_date) or None if range mode is off
+        """
+        if not QConfiguration.qf_tiingo_conf.get("rangemode", TiingoDataSource._default_range_mode):
+            return None
+        return year_window(for_date, 2)
+
+    def get_historical_price_range(self, symbol, category, start_date, end_date):
+        """
+        Call the Tiingo API for a range of dates. Each row carries the adjusted
+        prices along with the dividend and split (if any) for the day.
+        :param symbol: ticker symbol
+        :param category: Tiingo only works for stocks, etfs and mutfs.
+        :param start_date: yyyy-mm-dd ISO format
+        :param end_date: yyyy-mm-dd ISO format
+        :return: dict of prices, dividends and splits (see DataSourceBase)
+        """
+        if category not in ["", "stock", "etf", "mutf"]:
+            raise ValueError("Tiingo only supports categories stock, etf and mutf")
+
+        prices = []
+        dividends = []
+        splits = []
+        for r in self._get_prices(symbol, start_date, end_date):
+            # Dates look like 2018-11-30T00:00:00.000Z
+            row_date = r["date"][0:10]
+            prices.append({
+                "date": row_date,
+                "open": r["open"],
+                "high": r["high"],
+                "low": r["low"],
+                "close": r["close"],
+                "volume": r.get("volume") or 0,
+                "adj_close": r.get("adjClose") or 0.0
+            })
+            div_cash = float(r.get("divCash") or 0.0)
+            if div_cash != 0.0:
+                dividends.append({"date": row_date, "amount": div_cash})
+            split_factor = float(r.get("splitFactor") or 1.0)
+            if split_factor != 1.0:
+                splits.append({"date": row_date, "numerator": split_factor, "denominator": 1.0})
+
+        return {"prices": prices, "dividends": dividends, "splits": splits}
+
+    def get_dividend_data(self, symbol, for_date, period):
+        """
+        Dividend distributions are taken from the divCash column of the prices end point.
+        :param symbol: ticker symbol
+        :param for_date: yyyy-mm-dd ISO format, period ending date
+        :param period: ignored, only 1y supported
+        :return: list of dividend distributions
+        """
+        price_range = self.get_historical_price_range(symbol, "", ttm_start_date(for_date), for_date)
+        return price_range["dividends"]
+
 
 if __name__ == '__main__':
     # Basic test of Tiingo
@@ -24,12 +24,76 @@ import urllib.error
 
 import ssl
 import json
+import threading
+import time
+import zlib
+import random
+import email.utils
 from qf_app_logger import AppLogger
+from qf_deadline import clip_timeout, check_deadline, remaining
+from qf_configuration import QConfiguration
+from qf_quota import QuotaLedger
+from qf_metrics import Metrics
 
 # Logger init
 the_app_logger = AppLogger("qf-extension")
 logger = the_app_logger.getAppLogger()
 
+# Every request asks for a compressed response
+ACCEPT_ENCODING = "gzip, deflate"
+# Size of the blocks read from a response
+READ_CHUNK_SIZE = 16 * 1024
+# HTTP status codes that are worth retrying (throttling and server errors)
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+
+# The SSL context is built on the first request
+_cacerts_lock = threading.Lock()
+_cacerts_installed = False
+
+
+class TransferStats:
+    """
+    Singleton. Accumulates transfer statistics for each data source.
+    """
+    _lock = threading.Lock()
+    _stats = {}
+
+    @classmethod
+    def record(cls, data_source_name, wire_bytes, content_bytes, decompress_time):
+        """
+        Record the result of one response
+        :param data_source_name: The data source that made the request
+        :param wire_bytes: The number of bytes transferred
+        :param content_bytes: The number of bytes after decompression
+        :param decompress_time: Time spent decompressing in seconds
+        :return: None
+        """
+        with cls._lock:
+            if data_source_name not in cls._stats:
+                cls._stats[data_source_name] = {
+                    "requests": 0,
+                    "wire_bytes": 0,
+                    "content_bytes": 0,
+                    "decompress_time": 0.0
+                }
+            s = cls._stats[data_source_name]
+            s["requests"] += 1
+            s["wire_bytes"] += wire_bytes
+            s["content_bytes"] += content_bytes
+            s["decompress_time"] += decompress_time
+        logger.debug("%s transferred %d bytes (%d decompressed) in %f sec decompression",
+                     data_source_name, wire_bytes, content_bytes, decompress_time)
+
+    @classmethod
+    def get_stats(cls):
+        """
+        Return a copy of the statistics for all data sources
+        :return: dict keyed by data source name
+        """
+        with cls._lock:
+            return {k: dict(v) for k, v in cls._stats.items()}
+
 
 def setup_cacerts(cacerts):
     """
@@ -43,12 +107,212 @@ def setup_cacerts(cacerts):
     urllib.request.install_opener(opener)
 
 
-def exec_request(url_string, parms):
+def _install_cacerts():
+    """
+    Attach the configured certs file to the URL processor, once
+    :return: None
+    """
+    global _cacerts_installed
+    if _cacerts_installed:
+        return
+    with _cacerts_lock:
+        if not _cacerts_installed:
+            setup_cacerts(QConfiguration.cacerts)
+            _cacerts_installed = True
+
+
+def open_url(request, data_source_name):
+    """
+    Open a URL using the connect and read timeouts configured for a data source.
+    Both timeouts are clipped to whatever remains of the current cell deadline.
+    Throttling (429), server errors (5xx) and connection resets are retried
+    with exponential backoff and jitter. A Retry-After header is honored.
+    Retries are never allowed to run past the cell deadline.
+    :param request: A URL string or a urllib.request.Request
+    :param data_source_name: The name of the data source making the request (e.g. yahoo)
+    :return: The response object. It can be used as a context manager.
+    """
+    _install_cacerts()
+    connect_timeout, read_timeout = QConfiguration.get_timeouts(data_source_name)
+    max_retries, backoff, max_backoff = QConfiguration.get_retry_policy(data_source_name)
+
+    if type(request) == str:
+        request = urllib.request.Request(request)
+    if not request.has_header("Accept-encoding"):
+        request.add_header("Accept-Encoding", ACCEPT_ENCODING)
+
+    attempt = 0
+    while True:
+        QuotaLedger.record_request(data_source_name)
+        try:
+            with Metrics.timer("http.connect", data_source_name):
+                response = urllib.request.urlopen(request, timeout=clip_timeout(connect_timeout))
+            break
+        except urllib.error.HTTPError as ex:
+            if ex.code not in RETRY_STATUS_CODES or attempt >= max_retries:
+                raise
+            delay = _retry_after(ex)
+            if delay is None:
+                delay = _backoff_delay(attempt, backoff, max_backoff)
+            ex.close()
+            if delay > max_backoff:
+                # The server wants more time than we are willing to wait.
+                # Let the caller move on to the next data source.
+                logger.error("%s: Retry-After %f sec is too long to wait", data_source_name, delay)
+                raise ex
+            retry_ex = ex
+        except (urllib.error.URLError, ConnectionResetError) as ex:
+            reason = ex.reason if isinstance(ex, urllib.error.URLError) else ex
+            if not isinstance(reason, ConnectionResetError) or attempt >= max_retries:
+                raise
+            delay = _backoff_delay(attempt, backoff, max_backoff)
+            retry_ex = ex
+
+        # The retry has to fit in what is left of the cell deadline
+        left = remaining()
+        if left is not None and delay >= left:
+            logger.error("%s: no time left to retry after %s", data_source_name, str(retry_ex))
+            raise retry_ex
+        attempt += 1
+        logger.warning("%s: %s, retry %d of %d in %f sec",
+                       data_source_name, str(retry_ex), attempt, max_retries, delay)
+        time.sleep(delay)
+
+    # The timeout given to urlopen covers the connect and the wait for the
+    # response headers (urlopen does not return until they arrive). Once the
+    # headers are in, switch the socket over to the read timeout for the body.
+    try:
+        _set_read_timeout(response, clip_timeout(read_timeout), data_source_name)
+    except Exception:
+        response.close()
+        raise
+    return response
+
+
+def _set_read_timeout(response, read_timeout, data_source_name):
+    """
+    Set the timeout used while reading the body of a response.
+    http.client does not expose the socket of a response, so it is found
+    through the socket.SocketIO wrapper. If that ever changes, the connect
+    timeout stays in effect for the body.
+    :param response: A response returned by urlopen
+    :param read_timeout: Timeout in seconds
+    :param data_source_name: The data source that made the request
+    :return: None
+    """
+    raw = getattr(getattr(response, "fp", None), "raw", None)
+    if raw is None:
+        # Not a socket based response (e.g. file: URL)
+        return
+    sock = getattr(raw, "_sock", None)
+    if sock is None or not hasattr(sock, "settimeout"):
+        logger.debug("%s: response socket not found, the connect timeout applies to the read",
+                     data_source_name)
+        return
+    sock.settimeout(read_timeout)
+
+
+def _backoff_delay(attempt, backoff, max_backoff):
+    """
+    Exponential backoff with full jitter
+    :param attempt: Number of retries so far
+    :param backoff: Base delay in seconds
+    :param max_backoff: Upper limit on the delay in seconds
+    :return: Delay in seconds
+    """
+    return random.uniform(0.0, min(max_backoff, backoff * (2 ** attempt)))
+
+
+def _retry_after(http_error):
+    """
+    Decode the Retry-After header of an HTTP error response
+    :param http_error: urllib.error.HTTPError
+    :return: Delay in seconds or None if there is no usable header
+    """
+    value = http_error.headers.get("Retry-After") if http_error.headers else None
+    if not value:
+        return None
+    value = value.strip()
+    # Either a number of seconds or an HTTP date
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except Exception:
+        return None
+
+
+def iter_content(response, data_source_name):
+    """
+    Read a response in chunks, decompressing each chunk as it arrives
+    :param response: A response returned by open_url()
+    :param data_source_name: The data source that made the request
+    :return: A generator of decompressed byte strings
+    """
+    encoding = (response.headers.get("Content-Encoding") or "identity").strip().lower()
+    if encoding in ["gzip", "x-gzip"]:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == "deflate":
+        # Some servers send raw deflate instead of a zlib stream.
+        # That is sorted out on the first chunk.
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS)
+    else:
+        decompressor = None
+
+    wire_bytes = 0
+    content_bytes = 0
+    decompress_time = 0.0
+    first_chunk = True
+    read_start = time.perf_counter()
+    try:
+        while True:
+            check_deadline()
+            chunk = response.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            wire_bytes += len(chunk)
+            if decompressor is not None:
+                start = time.perf_counter()
+                try:
+                    chunk = decompressor.decompress(chunk)
+                except zlib.error:
+                    if not (first_chunk and encoding == "deflate"):
+                        raise
+                    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                    chunk = decompressor.decompress(chunk)
+                decompress_time += time.perf_counter() - start
+            first_chunk = False
+            if chunk:
+                content_bytes += len(chunk)
+                yield chunk
+        if decompressor is not None:
+            chunk = decompressor.flush()
+            if chunk:
+                content_bytes += len(chunk)
+                yield chunk
+    finally:
+        TransferStats.record(data_source_name, wire_bytes, content_bytes, decompress_time)
+        if Metrics.is_enabled():
+            Metrics.record("http.read." + data_source_name, time.perf_counter() - read_start)
+
+
+def read_content(response, data_source_name):
+    """
+    Read and decode an entire response
+    :param response: A response returned by open_url()
+    :param data_source_name: The data source that made the request
+    :return: The response content as a string
+    """
+    charset = response.headers.get_content_charset() or "utf-8"
+    return b"".join(iter_content(response, data_source_name)).decode(charset)
+
+
+def exec_request(url_string, parms, data_source_name="iex"):
     """
      Submit https request to IEX
     :param url_string:
     :param parms:
-    :param cacerts:
+    :param data_source_name: Used to select the request timeouts
     :return: A dict containing results of https GET.
     the results key contains what was returned by the GET request.
     The status_code key is added to return the HTTPS status code.
@@ -62,11 +326,10 @@ def exec_request(url_string, parms):
         else:
             url_enc = url_string
         logger.debug("HTTPS GET: %s", url_enc)
-        response = urllib.request.urlopen(url_enc)
+        response = open_url(url_enc, data_source_name)
         status_code = response.getcode()
         logger.debug("Status code: %d", status_code)
-        res = response.read()
-        res = str(res, "utf-8")
+        res = read_content(response, data_source_name)
     except urllib.error.HTTPError as ex:
         logger.error(ex.msg)
         logger.error(str(ex))
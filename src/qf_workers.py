@@ -0,0 +1,44 @@
+# coding: utf-8
+#
+# qf_workers - shared pool of worker threads for concurrent fetches
+# Copyright © 2022  Dave Hocker (email: Qalydon17@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import threading
+from qf_app_logger import AppLogger
+from qf_configuration import QConfiguration
+
+# Logger init
+the_app_logger = AppLogger("qf-extension")
+logger = the_app_logger.getAppLogger()
+
+_lock = threading.Lock()
+_executor = None
+
+
+def get_executor():
+    """
+    Return the shared thread pool. It is created on first use with
+    workersconf maxworkers threads.
+    :return: A concurrent.futures.ThreadPoolExecutor
+    """
+    global _executor
+    with _lock:
+        if _executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            max_workers = int(QConfiguration.qf_workers_conf["maxworkers"])
+            _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="qf-worker")
+            logger.debug("Created worker pool with %d threads", max_workers)
+        return _executor
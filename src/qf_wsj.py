@@ -28,6 +28,7 @@ import urllib.request
 import datetime
 from qf_data_source_base import DataSourceBase
 from qf_app_logger import AppLogger
+from qf_url_helpers import open_url, read_content
 
 # Logger init
 the_app_logger = AppLogger("qf-extension")
@@ -90,8 +91,8 @@ class WSJDataSource(DataSourceBase):
         logger.debug("Calling %s", url)
 
         try:
-            with urllib.request.urlopen(url) as testfile:
-                csv_data = testfile.read().decode()
+            with open_url(url, "wsj") as testfile:
+                csv_data = read_content(testfile, "wsj")
                 # This code depends on the first line of the result being the column names
                 # and the second line being the data for the date. No attempt is made to
                 # go beyond the second line of the response.
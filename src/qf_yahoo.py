@@ -33,15 +33,108 @@ import json
 import re
 import time
 import datetime
+import threading
+import codecs
 import urllib.request
 from qf_app_logger import AppLogger
+from qf_url_helpers import open_url, iter_content
 from qf_data_source_base import DataSourceBase
 from qf_configuration import QConfiguration
+from qf_extn_helper import month_window
 
 # Logger init
 the_app_logger = AppLogger("qf-extension")
 logger = the_app_logger.getAppLogger()
 
+# The page state is assigned to root.App.main. The price store is one
+# member of the state (context.dispatcher.stores.HistoricalPriceStore).
+_APP_MARKER = "root.App.main = "
+_STORE_KEY = '"HistoricalPriceStore":'
+# Outside of a string only braces and quotes matter. Inside a
+# string only quotes and escapes matter.
+_STRUCTURE_CHARS = re.compile(r'[{}"]')
+_STRING_CHARS = re.compile(r'["\\]')
+
+
+def _extract_price_store(response):
+    """
+    Scan a Yahoo history page as it arrives and decode only the HistoricalPriceStore
+    object. Reading stops as soon as the object is complete, so the rest of the
+    page is never downloaded or parsed.
+    :param response: A response returned by open_url()
+    :return: The HistoricalPriceStore as a dict or None if it was not found
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    buf = ""
+    marker = _APP_MARKER
+    store_start = -1
+    # Brace scanner state
+    pos = 0
+    depth = 0
+    in_string = False
+
+    for chunk in iter_content(response, "yahoo"):
+        buf += decoder.decode(chunk)
+
+        # Look for the app state marker, then the store key inside of it
+        while marker is not None:
+            i = buf.find(marker)
+            if i < 0:
+                # Only keep enough of the buffer to match a marker split across chunks
+                buf = buf[-(len(marker) - 1):]
+                break
+            buf = buf[i + len(marker):]
+            if marker == _APP_MARKER:
+                marker = _STORE_KEY
+            else:
+                marker = None
+        if marker is not None:
+            continue
+
+        if store_start < 0:
+            store_start = buf.find("{")
+            if store_start < 0:
+                continue
+            buf = buf[store_start:]
+            store_start = 0
+
+        # Find the brace that closes the store object
+        while True:
+            if in_string:
+                m = _STRING_CHARS.search(buf, pos)
+                if m is None:
+                    pos = len(buf)
+                    break
+                if m.group() == "\\":
+                    if m.end() >= len(buf):
+                        # The escaped character is in the next chunk
+                        pos = m.start()
+                        break
+                    pos = m.end() + 1
+                    continue
+                in_string = False
+            else:
+                m = _STRUCTURE_CHARS.search(buf, pos)
+                if m is None:
+                    pos = len(buf)
+                    break
+                c = m.group()
+                if c == '"':
+                    in_string = True
+                elif c == "{":
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth == 0:
+                        try:
+                            return json.loads(buf[:m.end()])
+                        except Exception as ex:
+                            logger.error("Unable to decode HistoricalPriceStore: %s", str(ex))
+                            return None
+            pos = m.end()
+
+    return None
+
 
 class YahooDataSource(DataSourceBase):
 
@@ -53,10 +146,11 @@ class YahooDataSource(DataSourceBase):
     }
 
     # Pacing control, hopefully to avoid getting throttled or banned
-    # This value is shared across all instances of the data source
-    # and NO attempt is made to syncrhonize access to it. The
-    # worst outcome is that extra pacing will occur.
+    # This value is shared across all instances of the data source.
+    # Batch lookups run requests on worker threads, so access is
+    # serialized by the pacing lock.
     _last_request_time = datetime.datetime.now()
+    _pacing_lock = threading.Lock()
     _pause = float(QConfiguration.qf_yahoo_conf["pacing"]) # float, seconds (e.g. 0.200)
 
     # Not sure we need the Connection header.
@@ -68,9 +162,71 @@ class YahooDataSource(DataSourceBase):
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/54.0.2840.99 Safari/537.36'
     }
 
+    # Range mode default. The number of months of history requested
+    # for a single date. Zero turns range mode off.
+    _default_range_months = 3
+
     def __init__(self):
         super(YahooDataSource, self).__init__()
 
+    @staticmethod
+    def _unix_date(for_date):
+        """
+        Convert an ISO date to Unix time as Yahoo expects it.
+        The 4 hour adjustment is a mystery (from original code).
+        :param for_date: yyyy-mm-dd ISO format
+        :return: Unix time as an int
+        """
+        four_hours_in_seconds = 14400
+        dt = datetime.datetime.strptime(for_date, "%Y-%m-%d")
+        return int(time.mktime(dt.timetuple())) + four_hours_in_seconds
+
+    def _get_price_store(self, symbol, url):
+        """
+        Request a Yahoo history page and extract its price store
+        :param symbol: ticker symbol (for error reporting)
+        :param url: The history page URL
+        :return: The HistoricalPriceStore dict
+        """
+        req = urllib.request.Request(url, headers=YahooDataSource._headers)
+        logger.debug("Calling %s", url)
+
+        # Apply pacing, avoid getting throttled
+        with YahooDataSource._pacing_lock:
+            elapsed = datetime.datetime.now() - YahooDataSource._last_request_time
+            if elapsed.total_seconds() < YahooDataSource._pause:
+                time.sleep(YahooDataSource._pause)
+                logger.debug("Pacing %f...", YahooDataSource._pause)
+            YahooDataSource._last_request_time = datetime.datetime.now()
+
+        # Send the request and extract the price data as the response arrives.
+        # This page scraping technique is highly subject to breakage. It is likely
+        # that changes will be required at the least expected time :-)
+        try:
+            with open_url(req, "yahoo") as page_source:
+                data = _extract_price_store(page_source)
+        except Exception as ex:
+            logger.error(ex)
+            raise ex
+
+        if data is None or "prices" not in data.keys():
+            logger.error("HistoricalPriceStore was not found")
+            msg = 'No data fetched for symbol {} using {}'
+            raise ValueError(msg.format(symbol, "Yahoo"))
+        return data
+
+    @staticmethod
+    def _exchange_utc_offset(data):
+        """
+        Return the exchange's UTC offset from a price store
+        :param data: The HistoricalPriceStore dict
+        :return: Offset in seconds (0 if the store does not have one)
+        """
+        try:
+            return int(data["timeZone"]["gmtOffset"])
+        except (KeyError, TypeError, ValueError):
+            return 0
+
     def get_historical_price_data(self, symbol, category, for_date):
         """
         Essentially a page scrape of a Yahoo page containing historical data
@@ -85,40 +241,14 @@ class YahooDataSource(DataSourceBase):
         if ticker in YahooDataSource._index_map.keys():
             symbol = YahooDataSource._index_map[ticker]
 
-        # Convert for_date to Unix time.  The 4 hour adjustment is a mystery (from original code).
-        four_hours_in_seconds = 14400
-        dt = datetime.datetime.strptime(for_date, "%Y-%m-%d")
-        unix_for_date = int(time.mktime(dt.timetuple()))
-        unix_for_date += four_hours_in_seconds
+        unix_for_date = YahooDataSource._unix_date(for_date)
 
         url = "https://finance.yahoo.com/quote/{}/history?period1={}&period2={}&interval=1d&filter=history&frequency=1d"
         url = url.format(symbol, unix_for_date, unix_for_date)
         # url => https://finance.yahoo.com/quote/AAPL/history?period1=1519753902&period2=1551289902&interval=1d&filter=history&frequency=1d
-        req = urllib.request.Request(url, headers=YahooDataSource._headers)
-        logger.debug("Calling %s", url)
+        data = self._get_price_store(symbol, url)
 
-        # Apply pacing, avoid getting throttled
-        elapsed = datetime.datetime.now() - YahooDataSource._last_request_time
-        if elapsed.total_seconds() < YahooDataSource._pause:
-            time.sleep(YahooDataSource._pause)
-            logger.debug("Pacing %f...", YahooDataSource._pause)
-        YahooDataSource._last_request_time = datetime.datetime.now()
-
-        # Send the request and read the response
         try:
-            with urllib.request.urlopen(req) as page_source:
-                resp = page_source.read().decode()
-        except Exception as ex:
-            logger.error(ex)
-            raise ex
-
-        # This page scraping technique is highly subject to breakage. It is likely
-        # that changes will be required at the least expected time :-)
-        # Here is some regex magic. It finds the data rows in the middle of the web page.
-        ptrn = r'root\.App\.main = (.*?);\n}\(this\)\);'
-        try:
-            j = json.loads(re.search(ptrn, resp, re.DOTALL).group(1))
-            data = j['context']['dispatcher']['stores']['HistoricalPriceStore']
             # return the first row of data (we only asked for one date)
             prices = data['prices'][0]
         except Exception as ex:
@@ -135,6 +265,87 @@ class YahooDataSource(DataSourceBase):
 
         return prices
 
+    def get_price_range_window(self, for_date):
+        """
+        Range mode. Request whole months of history for a single date.
+        :param for_date: yyyy-mm-dd ISO format
+        :return: (start_date, end_date) or None if range mode is off
+        """
+        months = int(QConfiguration.qf_yahoo_conf.get("rangemonths", YahooDataSource._default_range_months))
+        if months <= 0:
+            return None
+        return month_window(for_date, months)
+
+    def get_historical_price_range(self, symbol, category, start_date, end_date):
+        """
+        Page scrape of a Yahoo history page covering a range of dates. The page
+        carries dividend and split rows along with the price rows.
+        :param symbol: ticker symbol
+        :param category: not used
+        :param start_date: yyyy-mm-dd ISO format
+        :param end_date: yyyy-mm-dd ISO format
+        :return: dict of prices, dividends and splits (see DataSourceBase)
+        """
+        # Normalize ticker symbol if it's an index
+        ticker = symbol.lower()
+        if ticker in YahooDataSource._index_map.keys():
+            symbol = YahooDataSource._index_map[ticker]
+
+        # period2 is exclusive, so ask for the day after the end date
+        one_day_in_seconds = 86400
+        url = "https://finance.yahoo.com/quote/{}/history?period1={}&period2={}&interval=1d&filter=history&frequency=1d"
+        url = url.format(symbol, YahooDataSource._unix_date(start_date),
+                         YahooDataSource._unix_date(end_date) + one_day_in_seconds)
+        data = self._get_price_store(symbol, url)
+
+        rows = data["prices"]
+        if not rows:
+            return {"prices": [], "dividends": [], "splits": []}
+
+        # Yahoo dates are Unix times at the start of the exchange's trading day.
+        # They are converted with the exchange's UTC offset from the store, never
+        # the user's, so every row lands on the exchange's calendar day. Without
+        # an offset UTC is used, which is right for the US exchanges.
+        # A DST change inside the window moves a time by an hour, never by a day.
+        epoch_ordinal = datetime.date(1970, 1, 1).toordinal()
+        utc_offset = YahooDataSource._exchange_utc_offset(data)
+        seconds_per_day = 86400
+        date_cache = {}
+
+        def iso_date(unix_time):
+            day = (int(unix_time) + utc_offset) // seconds_per_day
+            if day not in date_cache:
+                date_cache[day] = datetime.date.fromordinal(epoch_ordinal + day).isoformat()
+            return date_cache[day]
+
+        prices = []
+        dividends = []
+        splits = []
+        for r in rows:
+            row_type = r.get("type", "").lower()
+            if row_type == "dividend":
+                dividends.append({"date": iso_date(r["date"]), "amount": float(r["amount"])})
+            elif row_type == "split":
+                splits.append({"date": iso_date(r["date"]),
+                               "numerator": float(r["numerator"]),
+                               "denominator": float(r["denominator"])})
+            elif not row_type and r.get("close") is not None:
+                prices.append({
+                    "date": iso_date(r["date"]),
+                    "open": r["open"],
+                    "high": r["high"],
+                    "low": r["low"],
+                    "close": r["close"],
+                    "volume": r.get("volume") or 0,
+                    "adj_close": r.get("adjclose") or 0.0
+                })
+
+        # Yahoo returns the newest row first
+        prices.reverse()
+        dividends.reverse()
+        splits.reverse()
+        return {"prices": prices, "dividends": dividends, "splits": splits}
+
     def get_dividend_data(self, symbol, for_date, period):
         """
         Essentially a page scrape of a Yahoo page containing historical data
@@ -143,45 +354,13 @@ class YahooDataSource(DataSourceBase):
         :return: dict of dividend records for period
         """
 
-        # Convert for_date to Unix time.  The 4 hour adjustment is a mystery (from original code).
-        four_hours_in_seconds = 14400
-        dt = datetime.datetime.strptime(for_date, "%Y-%m-%d")
-        unix_end_date = int(time.mktime(dt.timetuple()))
-        unix_end_date += four_hours_in_seconds
+        unix_end_date = YahooDataSource._unix_date(for_date)
         # TODO Convert period into number of days
         unix_start_date = unix_end_date - (365 * 24 * 60 * 60)
 
         url = "https://finance.yahoo.com/quote/{}/history?period1={}&period2={}&interval=div%7Csplit&filter=div&frequency={}"
         url = url.format(symbol, unix_start_date, unix_end_date, period)
-        req = urllib.request.Request(url, headers=YahooDataSource._headers)
-        logger.debug("Calling %s", url)
-
-        # Apply pacing, avoid getting throttled
-        elapsed = datetime.datetime.now() - YahooDataSource._last_request_time
-        if elapsed.total_seconds() < YahooDataSource._pause:
-            time.sleep(YahooDataSource._pause)
-            logger.debug("Pacing %f...", YahooDataSource._pause)
-        YahooDataSource._last_request_time = datetime.datetime.now()
-
-        # Send the request and read the response
-        try:
-            with urllib.request.urlopen(req) as page_source:
-                resp = page_source.read().decode()
-        except Exception as ex:
-            logger.error(ex)
-            raise ex
-
-        # This page scraping technique is highly subject to breakage. It is likely
-        # that changes will be required at the least expected time :-)
-        # Here is some regex magic. It finds the data rows in the middle of the web page.
-        ptrn = r'root\.App\.main = (.*?);\n}\(this\)\);'
-        try:
-            j = json.loads(re.search(ptrn, resp, re.DOTALL).group(1))
-            data = j['context']['dispatcher']['stores']['HistoricalPriceStore']
-        except Exception as ex:
-            logger.error(ex)
-            msg = 'No data fetched for symbol {} using {}'
-            raise ValueError(msg.format(symbol, "Yahoo"))
+        data = self._get_price_store(symbol, url)
 
         # Select all dividend records
         dividends = []